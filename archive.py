@@ -0,0 +1,49 @@
+"""
+This module reads & writes the archives which the retention policy moves old
+issues into: one gzip compressed file per month, with a line of JSON for each
+issue, holding its url, date, html & search text.
+"""
+import gzip
+import json
+import os
+
+
+def archive_path(directory, month):
+    """
+    :param directory: str
+    :param month: str, YYYY-MM
+    :return: str, path of that month's archive
+    """
+    return os.path.join(directory, f'issues-{month}.jsonl.gz')
+
+
+def append_issues(directory, month, issues):
+    """
+    Appends issues to the month's archive as a new gzip member, then syncs it
+    to disk, so that they can safely be removed from the database.  If that
+    removal never happens, the next run appends the same issues again;
+    read_issues yields both copies.
+    :param directory: str
+    :param month: str, YYYY-MM
+    :param issues: list of dicts with url, date, html & text keys
+    :return: str, path of the archive
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = archive_path(directory, month)
+    with open(path, 'ab') as file:
+        with gzip.GzipFile(fileobj=file, mode='wb') as archive:
+            for issue in issues:
+                archive.write(json.dumps(issue).encode('utf-8') + b'\n')
+        file.flush()
+        os.fsync(file.fileno())
+    return path
+
+
+def read_issues(path):
+    """
+    :param path: str, archive written by append_issues
+    :yield: dict with url, date, html & text keys, in the order archived
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            yield json.loads(line)
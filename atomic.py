@@ -0,0 +1,29 @@
+"""
+This module contains replacing, which writes a file under a temporary name
+and renames it over the real one once it is complete, so that another
+process, or a crash, never leaves part of a file behind.
+"""
+from contextlib import contextmanager
+import os
+import threading
+
+
+@contextmanager
+def replacing(path, mode='wb'):
+    """
+    Opens a temporary file next to path for the with block to write, then
+    replaces path with it in one step.  The temporary name is unique to the
+    process & thread, so that concurrent writers don't share one.  If the
+    block raises, the temporary file is removed and path is left as it was.
+    :param path: str
+    :param mode: str, 'wb' or 'w'
+    :yield: file obj
+    """
+    temp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp, mode) as file:
+            yield file
+        os.replace(temp, path)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
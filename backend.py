@@ -0,0 +1,520 @@
+"""
+This module contains Backend, the storage interface used by Feed, and
+MemoryBackend, which keeps everything in memory.  Database is the sqlite
+implementation.  MemoryBackend lets benchmarks & tests run refreshes without
+waiting on sqlite; nothing it holds outlives the process.
+"""
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+import sqlite3
+import threading
+import time
+import uuid
+
+from query import parse
+
+
+class Backend(ABC):
+    """
+    Everything Feed needs to store & look up users, search terms, issues &
+    hits.  Database's methods of the same names document their behaviour,
+    which every backend must share.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            print(f'{exc_type} - {exc_val} {exc_tb}')
+
+    @abstractmethod
+    def create_tables(self):
+        """
+        Prepares the backend for use, keeping anything already stored
+        """
+
+    @abstractmethod
+    def close(self):
+        """
+        Releases whatever the backend holds open
+        """
+
+    @abstractmethod
+    def add_user(self, name, email_address):
+        """
+        Adds a user, raising if their email address is already stored
+        """
+
+    @abstractmethod
+    def remove_user(self, email_address):
+        """
+        Removes a user, their search terms & their hits
+        """
+
+    @abstractmethod
+    def get_users(self):
+        """
+        :return: list of (name, email address) tuples
+        """
+
+    @abstractmethod
+    def get_subscriptions(self):
+        """
+        :return: list of (name, email address, search term or None) tuples
+        """
+
+    @abstractmethod
+    def add_search_term(self, email_address, search_term, max_distance=None):
+        """
+        Adds a search term for a user, raising ValueError if it can't be parsed
+        """
+
+    @abstractmethod
+    def remove_search_term(self, email_address, term):
+        """
+        Removes one of a user's search terms
+        """
+
+    @abstractmethod
+    def get_term_set_version(self):
+        """
+        :return: 2-tuple, str id of the backend & int term set version
+        """
+
+    @abstractmethod
+    def get_term_distances(self):
+        """
+        :return: dict of search term to the number of typos tolerated
+        """
+
+    @abstractmethod
+    def get_search_terms(self, email_address):
+        """
+        :return: list of str, a user's search terms
+        """
+
+    @abstractmethod
+    def record_term_hits(self, terms):
+        """
+        Counts an issue as searched for every term, & as a hit for terms
+        """
+
+    @abstractmethod
+    def get_term_stats(self):
+        """
+        :return: list of 6-tuples, statistics for each search term
+        """
+
+    @abstractmethod
+    def add_url_html(self, url, html=None, issue_date=None, text=None):
+        """
+        Stores a finished issue
+        """
+
+    @abstractmethod
+    def get_urls(self):
+        """
+        :return: list of str, urls of every issue stored or queued
+        """
+
+    @abstractmethod
+    def queue_issues(self, issues):
+        """
+        Queues (url, date) pairs for refresh to claim
+        """
+
+    @abstractmethod
+    def claim_issues(self, worker, limit, lease):
+        """
+        :return: list of (url, date) tuples, the queued issues claimed for worker
+        """
+
+    @abstractmethod
+    def claim_unfinished(self, worker, limit, lease):
+        """
+        :return: list of (url, date, status, search text) tuples, unfinished issues
+        """
+
+    @abstractmethod
+    def renew_claim(self, url, worker, lease):
+        """
+        :return: bool, False if worker lost the claim or it ran out, else it is extended
+        """
+
+    @abstractmethod
+    def complete_issue(self, url, worker, html, text):
+        """
+        :return: bool, False if worker lost the claim, else the html & text are stored
+        """
+
+    @abstractmethod
+    def record_matches(self, url, worker, hits):
+        """
+        :return: bool, False if worker lost the claim, else the hits are recorded
+        """
+
+    @abstractmethod
+    def get_unsent_alerts(self, url):
+        """
+        :return: list of (email address, hits) tuples still to be sent
+        """
+
+    @abstractmethod
+    def mark_sent(self, email_address, url, worker=None):
+        """
+        :return: bool, False if the alert wasn't recorded as sent, because
+        worker no longer holds the issue's claim
+        """
+
+    @abstractmethod
+    def finish_issue(self, url, worker):
+        """
+        :return: bool, whether the issue was still claimed by worker
+        """
+
+    @abstractmethod
+    def release_issues(self, worker):
+        """
+        :return: int, number of worker's claims given up
+        """
+
+    @abstractmethod
+    def iter_issues(self, since=None, until=None, url=None, batch_size=100):
+        """
+        Yields stored issues, oldest first, a batch at a time
+        """
+
+    @abstractmethod
+    def add_user_issue(self, email_address, url, terms=None):
+        """
+        Records a hit for a user, unless already recorded
+        """
+
+    @abstractmethod
+    def new_user_issues(self, pairs):
+        """
+        :return: list of the (email address, url) pairs not yet recorded
+        """
+
+    @abstractmethod
+    def add_user_issues(self, rows):
+        """
+        :return: int, number of the hits in rows which weren't already recorded
+        """
+
+    @abstractmethod
+    def get_user_issues(self, email_address):
+        """
+        :return: list of str, urls of a user's hits
+        """
+
+
+class MemoryBackend(Backend):
+    """
+    Backend holding everything in dicts, which keep the order things were
+    added in, as ids do in Database.  Duplicate users & issues raise
+    sqlite3.IntegrityError, as they do with Database, so callers needn't
+    care which backend they're using.  A lock makes it safe to share between
+    threads, the way several processes can share a database file.  Methods
+    without docstrings behave as documented on Backend & Database.
+    """
+
+    def __init__(self):
+        self._users = {}  # Email address to name
+        self._user_terms = {}  # Email address to list of terms
+        self._terms = {}  # Term to max_distance
+        self._term_stats = {}  # Term to [since, scanned_from, hits, last_hit]
+        self._scanned = 0  # Issues ever searched, see Database.create_tables
+        self._issues = {}  # Url to dict of the issues table's columns
+        self._user_issues = {}  # (email address, url) to [matched_at, terms, sent]
+        self._id = uuid.uuid4().hex
+        self._term_set_version = 0
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}()'
+
+    def create_tables(self):
+        """
+        Nothing to create
+        :return: None
+        """
+
+    def close(self):
+        """
+        Nothing to close, the data stays available
+        :return: None
+        """
+
+    def add_user(self, name, email_address):
+        with self._lock:
+            if email_address in self._users:
+                raise sqlite3.IntegrityError('UNIQUE constraint failed: users.email_address')
+            self._users[email_address] = name
+            self._user_terms[email_address] = []
+
+    def remove_user(self, email_address):
+        with self._lock:
+            self._users.pop(email_address, None)
+            self._user_terms.pop(email_address, None)
+            for key in [key for key in self._user_issues if key[0] == email_address]:
+                del self._user_issues[key]
+            self._remove_orphan_terms()
+            self._term_set_version += 1
+
+    def get_users(self):
+        with self._lock:
+            return [(name, email_address) for email_address, name in self._users.items()]
+
+    def get_subscriptions(self):
+        with self._lock:
+            return [(name, email_address, term)
+                    for email_address, name in self._users.items()
+                    for term in self._user_terms[email_address] or [None]]
+
+    def add_search_term(self, email_address, search_term, max_distance=None):
+        parse(search_term)
+        with self._lock:
+            if email_address not in self._users:
+                return
+            self._terms.setdefault(search_term, None)
+            if max_distance is not None:
+                self._terms[search_term] = max_distance
+            self._term_stats.setdefault(search_term,
+                                        [date.today().isoformat(), self._scanned, 0, None])
+            if search_term not in self._user_terms[email_address]:
+                self._user_terms[email_address].append(search_term)
+            self._term_set_version += 1
+
+    def remove_search_term(self, email_address, term):
+        with self._lock:
+            if term in self._user_terms.get(email_address, []):
+                self._user_terms[email_address].remove(term)
+            self._remove_orphan_terms()
+            self._term_set_version += 1
+
+    def get_term_set_version(self):
+        with self._lock:
+            return self._id, self._term_set_version
+
+    def _remove_orphan_terms(self):
+        """
+        Deletes terms, & their statistics, which no longer belong to any user
+        :return: None
+        """
+        used = {term for terms in self._user_terms.values() for term in terms}
+        for term in [term for term in self._terms if term not in used]:
+            del self._terms[term]
+            self._term_stats.pop(term, None)
+
+    def get_term_distances(self):
+        with self._lock:
+            return {term: distance for term, distance in self._terms.items()
+                    if distance is not None}
+
+    def get_search_terms(self, email_address):
+        with self._lock:
+            return list(self._user_terms.get(email_address, []))
+
+    def record_term_hits(self, terms):
+        with self._lock:
+            self._record_term_hits(terms)
+
+    def _record_term_hits(self, terms):
+        """
+        record_term_hits, for callers already holding the lock
+        """
+        self._scanned += 1
+        now = datetime.now().isoformat(' ', 'seconds')
+        for term in terms:
+            if term in self._term_stats:
+                self._term_stats[term][2] += 1
+                self._term_stats[term][3] = now
+
+    def get_term_stats(self):
+        with self._lock:
+            users = {}
+            for terms in self._user_terms.values():
+                for term in terms:
+                    users[term] = users.get(term, 0) + 1
+            stats = [(term, users.get(term, 0), since, self._scanned - scanned_from, hits,
+                      last_hit)
+                     for term, (since, scanned_from, hits, last_hit)
+                     in self._term_stats.items()]
+        return sorted(stats, key=lambda row: (row[4] / max(row[3], 1), -row[3], row[0]))
+
+    def add_url_html(self, url, html=None, issue_date=None, text=None):
+        with self._lock:
+            if url in self._issues:
+                raise sqlite3.IntegrityError('UNIQUE constraint failed: issues.url')
+            self._issues[url] = self._issue(issue_date, html or None, text, 'done')
+
+    @staticmethod
+    def _issue(issue_date, html, text, status):
+        """
+        :return: dict, a row of the issues table
+        """
+        return {'date': issue_date or date.today().isoformat(), 'html': html,
+                'text': text, 'status': status, 'claimed_by': None,
+                'lease_expires': None}
+
+    def get_urls(self):
+        with self._lock:
+            return list(self._issues)
+
+    def queue_issues(self, issues):
+        with self._lock:
+            for url, issue_date in issues:
+                if url not in self._issues:
+                    self._issues[url] = self._issue(issue_date, None, None, 'new')
+
+    def claim_issues(self, worker, limit, lease):
+        now = time.time()
+        return [(url, issue['date']) for url, issue, _ in self._claim(
+            lambda issue: issue['status'] == 'new' or (
+                issue['status'] == 'claimed' and issue['lease_expires'] < now),
+            worker, limit, now + lease, 'claimed')]
+
+    def claim_unfinished(self, worker, limit, lease):
+        now = time.time()
+        return [(url, issue['date'], status, issue['text']) for url, issue, status in
+                self._claim(lambda issue: issue['status'] in ('stored', 'matched') and (
+                    issue['claimed_by'] is None or issue['lease_expires'] < now),
+                            worker, limit, now + lease)]
+
+    def _claim(self, condition, worker, limit, expires, status=None):
+        """
+        :param condition: callable taking an issue dict, True for those which
+        may be claimed
+        :return: list of 3-tuples, url, issue dict & its previous status
+        """
+        claimed = []
+        with self._lock:
+            for url, issue in self._issues.items():
+                if len(claimed) == limit:
+                    break
+                if condition(issue):
+                    claimed.append((url, issue, issue['status']))
+                    issue.update(status=status or issue['status'], claimed_by=worker,
+                                 lease_expires=expires)
+        return claimed
+
+    def _holds(self, url, worker, status):
+        """
+        :return: dict, url's issue, or None unless it has status & is claimed
+        by worker
+        """
+        issue = self._issues.get(url)
+        if issue is None or issue['status'] != status or issue['claimed_by'] != worker:
+            return None
+        return issue
+
+    def renew_claim(self, url, worker, lease):
+        now = time.time()
+        with self._lock:
+            issue = self._issues.get(url)
+            if issue is None or issue['claimed_by'] != worker or \
+                    issue['lease_expires'] is None or issue['lease_expires'] <= now:
+                return False
+            issue['lease_expires'] = now + lease
+            return True
+
+    def complete_issue(self, url, worker, html, text):
+        with self._lock:
+            issue = self._holds(url, worker, 'claimed')
+            if issue is None:
+                return False
+            issue.update(html=html or None, text=text, status='stored')
+            return True
+
+    def record_matches(self, url, worker, hits):
+        with self._lock:
+            issue = self._holds(url, worker, 'stored')
+            if issue is None:
+                return False
+            issue['status'] = 'matched'
+            for email_address, terms in hits:
+                if email_address in self._users:
+                    self._add_user_issue(email_address, url, terms, sent=False)
+            self._record_term_hits({term for _, terms in hits for term in terms})
+            return True
+
+    def get_unsent_alerts(self, url):
+        with self._lock:
+            return [(email_address, list(terms or []))
+                    for (email_address, issue_url), (_, terms, sent) in self._user_issues.items()
+                    if issue_url == url and not sent]
+
+    def mark_sent(self, email_address, url, worker=None):
+        with self._lock:
+            if (email_address, url) not in self._user_issues or (
+                    worker is not None and self._issues[url]['claimed_by'] != worker):
+                return False
+            self._user_issues[email_address, url][2] = True
+            return True
+
+    def finish_issue(self, url, worker):
+        with self._lock:
+            issue = self._holds(url, worker, 'matched')
+            if issue is None:
+                return False
+            issue.update(status='done', claimed_by=None, lease_expires=None)
+            return True
+
+    def release_issues(self, worker):
+        released = 0
+        with self._lock:
+            for issue in self._issues.values():
+                if issue['claimed_by'] == worker and issue['status'] != 'done':
+                    if issue['status'] == 'claimed':
+                        issue['status'] = 'new'
+                    issue.update(claimed_by=None, lease_expires=None)
+                    released += 1
+        return released
+
+    def iter_issues(self, since=None, until=None, url=None, batch_size=100):
+        with self._lock:
+            rows = [(issue_url, issue['html'], issue['text'])
+                    for issue_url, issue in self._issues.items()
+                    if issue['html'] is not None
+                    and (not since or issue['date'] >= since)
+                    and (not until or issue['date'] <= until)
+                    and (not url or url in issue_url)]
+        yield from rows
+
+    def add_user_issue(self, email_address, url, terms=None):
+        with self._lock:
+            if email_address not in self._users:
+                raise ValueError('Invalid Email address')
+            if url not in self._issues:
+                raise ValueError('Invalid URL')
+            self._add_user_issue(email_address, url, terms)
+
+    def _add_user_issue(self, email_address, url, terms, sent=True):
+        """
+        :return: bool, False if the user issue was already recorded
+        """
+        if (email_address, url) in self._user_issues:
+            return False
+        self._user_issues[email_address, url] = [
+            date.today().isoformat(), None if terms is None else list(terms), sent]
+        return True
+
+    def new_user_issues(self, pairs):
+        with self._lock:
+            return [pair for pair in pairs if tuple(pair) not in self._user_issues]
+
+    def add_user_issues(self, rows):
+        added = 0
+        with self._lock:
+            for row in rows:
+                email_address, url = row[0], row[1]
+                if email_address in self._users and url in self._issues:
+                    added += self._add_user_issue(email_address, url,
+                                                  row[2] if len(row) > 2 else None)
+        return added
+
+    def get_user_issues(self, email_address):
+        with self._lock:
+            return [url for user, url in self._user_issues if user == email_address]
@@ -0,0 +1,234 @@
+#! /usr/bin/python3.6
+"""
+This module contains benchmarks for the project's hot paths.  Run it with the
+name of a benchmark, e.g. `py benchmarks.py matcher`, or with no arguments
+to run them all.
+"""
+import argparse
+import asyncio
+import os
+import random
+import string
+import tempfile
+import time
+
+import feedparser as fp
+
+from backend import MemoryBackend
+from configuration import Config
+from database import Database
+from feed import Feed, User
+from matcher import Matcher
+from rss import parse_feed
+
+WORDS = ['BANK', 'COUNCIL', 'LIMITED', 'SCOTLAND', 'EDINBURGH', 'GLASGOW',
+         'HOLDINGS', 'TRUSTEES', 'PARTNERSHIP', 'MINISTERS', 'PETITION',
+         'REVENUE', 'CUSTOMS', 'ROYAL', 'CITY', 'ADVOCATE', 'LORD', 'ESTATES']
+
+
+def synthetic_name(rand):
+    """
+    :param rand: random.Random
+    :return: str, party name in the style found in court rolls
+    """
+    surname = ''.join(rand.choice(string.ascii_uppercase)
+                      for _ in range(rand.randint(4, 9)))
+    return ' '.join([surname] + rand.sample(WORDS, rand.randint(1, 3)))
+
+
+def synthetic_roll(entries, seed=0):
+    """
+    :param entries: int, number of cases in the roll
+    :param seed: int
+    :return: str, upper-cased court roll text
+    """
+    rand = random.Random(seed)
+    return '\n'.join(f'{num}. {synthetic_name(rand)} v {synthetic_name(rand)} '
+                     f'(A{rand.randint(1, 999)}/17)' for num in range(entries))
+
+
+def synthetic_users(user_count, terms_per_user, seed=1):
+    """
+    Builds users whose terms mostly don't appear in the roll, with a popular
+    term shared by every user, as happens with big banks & councils
+    :param user_count: int
+    :param terms_per_user: int
+    :param seed: int
+    :return: list of User obj
+    """
+    rand = random.Random(seed)
+    return [User(f'user {num}', f'user{num}@example.com',
+                 [synthetic_name(rand) for _ in range(terms_per_user)]
+                 + ['ROYAL BANK OF SCOTLAND'])
+            for num in range(user_count)]
+
+
+def timed(func, repeat):
+    """
+    :param func: callable taking no arguments
+    :param repeat: int
+    :return: float, fastest of repeat runs in seconds
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_matcher(args):
+    """
+    Compares exact & fuzzy matching of one court roll against every term
+    :param args: parser.parse_args() namespace
+    :return: None
+    """
+    text = synthetic_roll(args.entries)
+    users = synthetic_users(args.users, args.terms)
+    exact, fuzzy = Matcher(users), Matcher(users, fuzzy=True)
+    print(f'Matching {len(text) / 1024:.0f} KiB of text against '
+          f'{len(exact)} unique terms')
+    exact_time = timed(lambda: exact.match(text), args.repeat)
+    fuzzy_time = timed(lambda: fuzzy.match(text), args.repeat)
+    print(f'exact: {exact_time * 1000:8.1f} ms')
+    print(f'fuzzy: {fuzzy_time * 1000:8.1f} ms '
+          f'({fuzzy_time / exact_time:.1f}x exact)')
+
+
+def synthetic_feed(items, seed=2):
+    """
+    :param items: int, number of issues in the feed
+    :param seed: int
+    :return: bytes, RSS document in the style of the court roll feed
+    """
+    rand = random.Random(seed)
+    entries = ''.join(
+        f'<item><title>Court of Session Rolls {num}</title>'
+        f'<link>https://www.scotcourts.gov.uk/rolls/{num}</link>'
+        f'<guid isPermaLink="false">{num}</guid>'
+        f'<description>&lt;p&gt;{synthetic_name(rand)}&lt;/p&gt;</description>'
+        f'<pubDate>Thu, 19 Oct 2017 0{num % 10}:00:00 GMT</pubDate></item>'
+        for num in range(items))
+    return (f'<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+            f'<title>Court Rolls</title>{entries}</channel></rss>').encode()
+
+
+def bench_feed(args):
+    """
+    Compares the streaming feed parser with feedparser, on a synthetic feed &
+    any saved samples given with --feed_sample
+    :param args: parser.parse_args() namespace
+    :return: None
+    """
+    samples = [('synthetic', synthetic_feed(args.entries))]
+    for path in args.feed_sample:
+        with open(path, 'rb') as file:
+            samples.append((path, file.read()))
+    for name, content in samples:
+        print(f'{name}: {len(content) / 1024:.0f} KiB, '
+              f'{len(parse_feed(content))} entries')
+        fast_time = timed(lambda: parse_feed(content), args.repeat)
+        slow_time = timed(lambda: fp.parse(content), args.repeat)
+        print(f'parse_feed: {fast_time * 1000:8.1f} ms')
+        print(f'feedparser: {slow_time * 1000:8.1f} ms '
+              f'({slow_time / fast_time:.1f}x parse_feed)')
+
+
+def store_issues(backend, users, texts):
+    """
+    Runs texts through the storage & matching steps of a refresh, claiming,
+    storing & matching each issue as refresh does, without downloading,
+    parsing or emailing
+    :param backend: Backend obj, with the users' tables created
+    :param users: list of User obj
+    :param texts: list of str, one per issue
+    :return: None
+    """
+    feed = Feed(backend)
+    for user in users:
+        feed.add_user(user.name, user.email_address)
+        for term in user.search_terms:
+            feed.add_search_term(user.email_address, term)
+    matcher = feed.matcher()
+    feed.queue_issues([(f'issue/{num}', None) for num in range(len(texts))])
+    loop = asyncio.new_event_loop()
+    try:
+        for num, (url, _) in enumerate(feed.claim_issues(feed.worker, len(texts), 60)):
+            feed.complete_issue(url, feed.worker, '', texts[num])
+            loop.run_until_complete(feed._record_matches(url, texts[num], matcher))
+    finally:
+        loop.close()
+
+
+def bench_storage(args):
+    """
+    Compares refreshing issues into sqlite with refreshing them into memory,
+    which leaves only the cost of matching
+    :param args: parser.parse_args() namespace
+    :return: None
+    """
+    texts = [synthetic_roll(args.entries // 10, seed=num) for num in range(args.issues)]
+    users = synthetic_users(args.users, args.terms)
+    directory = tempfile.mkdtemp()
+
+    def sqlite():
+        path = os.path.join(directory, f'{time.perf_counter()}.db')
+        database = Database(path)
+        database.create_tables()
+        store_issues(database, users, texts)
+        database.close()
+
+    print(f'Storing & matching {args.issues} issues for {len(users)} users')
+    sqlite_time = timed(sqlite, args.repeat)
+    memory_time = timed(lambda: store_issues(MemoryBackend(), users, texts), args.repeat)
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    print(f'memory: {memory_time * 1000:8.1f} ms')
+    print(f'sqlite: {sqlite_time * 1000:8.1f} ms '
+          f'({sqlite_time / memory_time:.1f}x memory)')
+
+
+BENCHMARKS = {
+    'matcher': bench_matcher,
+    'feed': bench_feed,
+    'storage': bench_storage,
+}
+
+
+def main():
+    """
+    Handles CLI interactions
+    :return: None
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*',
+                        help=f'Benchmarks to run, out of {", ".join(BENCHMARKS)}.'
+                        ' Defaults to all of them')
+    parser.add_argument('--entries', type=int, default=2000,
+                        help='Number of cases in each synthetic court roll, '
+                        'or issues in the synthetic feed')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--terms', type=int, default=10,
+                        help='Number of search terms per user')
+    parser.add_argument('--issues', type=int, default=100,
+                        help='Number of issues stored by the storage benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--feed_sample', action='append', default=[],
+                        help='Saved feed document to include in the feed '
+                        'benchmark, may be repeated')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'Unknown benchmarks: {", ".join(sorted(unknown))}')
+    # Benchmarks build their own matchers, so mustn't load or overwrite the
+    # real matcher cache, or write their statistics over the real metrics
+    Config.matcher_cache = None
+    Config.metrics_file = None
+    for name in args.benchmarks or BENCHMARKS:
+        print(f'== {name}')
+        BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+This module contains ResponseCache, an on-disk cache of downloaded pages used
+by Feed._fetch.  Each page is kept in its own file, named after a hash of its
+url, next to a JSON file holding the url and the ETag & Last-Modified headers
+used to revalidate it.  A page's modification time records when it was last
+used, so that the least recently used pages can be evicted once the cache
+grows past its size limit.
+"""
+from hashlib import sha256
+import json
+import os
+import threading
+
+from atomic import replacing
+
+
+class ResponseCache:
+    """
+    Raw page content keyed by url.  The total size of the pages is kept
+    as they are stored, so the directory is only listed when a page takes
+    the cache over max_bytes.  Pages stored by other processes only count
+    from then on.
+    """
+
+    def __init__(self, directory, max_bytes):
+        """
+        :param directory: str, created if missing
+        :param max_bytes: int, total size of the cached pages above which the
+        least recently used are evicted
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._total = None  # Size of the pages, None until the first evict
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.directory!r}, {self.max_bytes})'
+
+    def _path(self, url):
+        """
+        :param url: str
+        :return: str, path of the page's content, without extension
+        """
+        return os.path.join(self.directory, sha256(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """
+        :param url: str
+        :return: bytes, the cached page, or None if url isn't cached
+        """
+        path = self._path(url)
+        try:
+            with open(path + '.body', 'rb') as file:
+                content = file.read()
+            os.utime(path + '.body')
+        except FileNotFoundError:
+            return None
+        return content
+
+    def validators(self, url):
+        """
+        :param url: str
+        :return: dict of request headers asking the server to only send the
+        page if it has changed since it was cached, empty if it isn't cached
+        """
+        try:
+            with open(self._path(url) + '.json') as file:
+                meta = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def put(self, url, content, headers):
+        """
+        Stores a page, each file being written under a temporary name then
+        renamed, so that a crash or another process never sees part of one,
+        then evicts pages if the cache no longer fits in max_bytes
+        :param url: str
+        :param content: bytes
+        :param headers: dict-like, the response headers
+        :return: None
+        """
+        path = self._path(url)
+        try:
+            replaced = os.stat(path + '.body').st_size
+        except FileNotFoundError:
+            replaced = 0
+        meta = {'url': url, 'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified')}
+        for extension, data in (('.json', json.dumps(meta).encode('utf-8')),
+                                ('.body', content)):
+            with replacing(path + extension) as file:
+                file.write(data)
+        with self._lock:
+            if self._total is not None:
+                self._total += len(content) - replaced
+                if self._total <= self.max_bytes:
+                    return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used pages until the rest fit in max_bytes
+        :return: int, number of pages removed
+        """
+        pages = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.body'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                pages.append((stat.st_mtime, stat.st_size, entry.path[:-len('.body')]))
+        total = sum(size for _, size, _ in pages)
+        removed = 0
+        for _, size, path in sorted(pages):
+            if total <= self.max_bytes:
+                break
+            for extension in ('.body', '.json'):
+                try:
+                    os.remove(path + extension)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            removed += 1
+        with self._lock:
+            self._total = total
+        return removed
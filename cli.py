@@ -3,10 +3,17 @@
 This module contains the CLI functionality for the project.
 """
 import argparse
+from datetime import datetime
+import os
 import sqlite3
+import sys
+import time
 
 from configuration import Config
+from database import EXPORTS
+from export import FORMATS, write_export
 from feed import Feed
+import metrics
 
 
 def main():
@@ -33,7 +40,12 @@ def main():
 
     parser.add_argument('--add_term', help='Search term to add.  Use with --email'
                         ' to add a search term to the user associated with '
-                        ' the email address.')
+                        ' the email address.  Quoted phrases may be combined'
+                        ' with AND, OR, NOT, parentheses and W/n (within n '
+                        'words), e.g. \'"SMITH" W/5 "JONES"\'')
+    parser.add_argument('--distance', type=int, help='Number of typos to '
+                        'tolerate when fuzzy matching the search term.  Use '
+                        'with --add_term.')
     parser.add_argument('-t', '--terms_from_file', help='Add search terms '
                         'from file.  Must be used with --email')
     parser.add_argument('-g', '--get_terms', help='Get all search terms '
@@ -48,6 +60,66 @@ def main():
     parser.add_argument('--start', action='store_true',
                         help='Runs the program, refreshing the rss feed and '
                         'sending emails, if needed')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keeps running, refreshing the rss feed every '
+                        'Config.refresh_interval seconds until stopped with '
+                        'Ctrl-C.  Serves statistics at '
+                        'http://127.0.0.1:<port>/metrics if '
+                        'Config.metrics_port is set')
+    parser.add_argument('--budget', type=float, help='Use with --start or '
+                        '--daemon to stop each refresh after this many '
+                        'seconds.  The next refresh carries on where it '
+                        'stopped')
+    parser.add_argument('--reprocess', action='store_true',
+                        help='Matches issues already in the database against '
+                        'the current search terms, recording new hits without '
+                        'sending emails.  Can be narrowed down with --since, '
+                        '--until and --url')
+    parser.add_argument('--since', type=iso_date, help='Only issues dated on '
+                        'or after this date, in YYYY-MM-DD format.  With '
+                        '--export hits, only hits found on or after it')
+    parser.add_argument('--until', type=iso_date, help='Only issues dated on '
+                        'or before this date, in YYYY-MM-DD format')
+    parser.add_argument('--url', help='Only issues whose URL contains this')
+    parser.add_argument('--dry_run', action='store_true', help='Use with '
+                        '--reprocess to report new hits without recording them')
+    parser.add_argument('--workers', type=int, help='Number of processes used '
+                        'by --reprocess')
+    parser.add_argument('--backfill_text', action='store_true',
+                        help='Stores search text for issues downloaded before '
+                        'it was stored alongside their html')
+    parser.add_argument('--history', help='Lists the court roll issues in '
+                        'which a user\'s search terms were found, newest first.'
+                        '  Type --history followed by the email address')
+    parser.add_argument('--before', type=int, help='Use with --history to '
+                        'show the page of hits following the one that ended '
+                        'with this hit number')
+    parser.add_argument('--limit', type=int, help='Number of hits shown by '
+                        '--history at a time, 20 by default')
+    parser.add_argument('--export', choices=list(EXPORTS), help='Writes out '
+                        'every user, search term or hit, as CSV by default.  '
+                        'Hits can be narrowed down with --since')
+    parser.add_argument('--format', choices=FORMATS, help='Format used by '
+                        '--export, csv or jsonl (one JSON object per line)')
+    parser.add_argument('--output', help='File written by --export, instead of '
+                        'the screen')
+    parser.add_argument('--after', type=int, help='Use with --export to only '
+                        'write rows with a greater id, e.g. the last id of the '
+                        'previous export')
+    parser.add_argument('--term_stats', action='store_true',
+                        help='Lists every search term with the number of '
+                        'issues searched since it was added and how many it '
+                        'was found in, starting with those never found')
+    parser.add_argument('--maintenance', action='store_true',
+                        help='Moves issues older than Config.retention_months '
+                        'into compressed archives, keeping their URLs and '
+                        'hits, then shrinks the database file.  Safe to run '
+                        'while the program is running')
+    parser.add_argument('--full', action='store_true',
+                        help='Use with --maintenance on a database created by '
+                        'an older version, to rebuild it once so that space '
+                        'can be freed.  Blocks the program while it runs, so '
+                        'is skipped if a refresh is running')
     args = parser.parse_args()
 
     if args.list_users:
@@ -61,7 +133,21 @@ def main():
     if args.email:
         email(args=args)
     if args.start:
-        start()
+        start(budget=args.budget)
+    if args.daemon:
+        daemon(budget=args.budget)
+    if args.backfill_text:
+        backfill_text()
+    if args.reprocess:
+        reprocess(args=args)
+    if args.history:
+        history(args=args)
+    if args.export:
+        export(args=args)
+    if args.term_stats:
+        term_stats()
+    if args.maintenance:
+        maintenance(full=args.full)
     if not [arg for arg in args.__dict__ if args.__dict__[arg]]:
         parser.print_help()
 
@@ -135,18 +221,31 @@ def email(args):
         add_user(name=args.name, email_address=args.email)
 
     if args.add_term:
-        Feed(Config.database).add_search_term(email_address=args.email,
-                                              search_term=args.add_term.upper())
+        add_term(args.email, args.add_term.upper(), max_distance=args.distance)
     if args.terms_from_file:
         with open(args.terms_from_file) as file:
             for line in file:
-                Feed(Config.database).add_search_term(email_address=args.email,
-                                                      search_term=line.strip().upper())
+                add_term(args.email, line.strip().upper())
     if args.remove_term:
         Feed(Config.database).remove_search_term(email_address=args.email,
                                                  term=args.remove_term)
 
 
+def add_term(email_address, term, max_distance=None):
+    """
+    :param email_address: str
+    :param term: str, search term or expression
+    :param max_distance: int
+    :return: None
+    """
+    try:
+        Feed(Config.database).add_search_term(email_address=email_address,
+                                              search_term=term,
+                                              max_distance=max_distance)
+    except ValueError as error:
+        print(f'Invalid search term: {error}')
+
+
 def add_user(name, email_address):
     """
     :param name: str
@@ -160,14 +259,165 @@ def add_user(name, email_address):
         print(f'{email_address} already in database!')
 
 
-def start():
+def iso_date(value):
+    """
+    argparse type for dates
+    :param value: str
+    :return: str, value if it is a valid YYYY-MM-DD date
+    """
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is not a YYYY-MM-DD date')
+    return value
+
+
+def backfill_text():
+    """
+    :return: None
+    """
+    with Feed(Config.database) as feed:
+        print(f'Backfilled search text for {feed.backfill_text()} issues')
+
+
+def reprocess(args):
+    """
+    :param args: parser.parse_args() namespace
+    :return: None
+    """
+    with Feed(Config.database) as feed:
+        report = feed.reprocess(since=args.since, until=args.until, url=args.url,
+                                dry_run=args.dry_run, workers=args.workers)
+    print(f'Scanned {report["issues"]} issues, found {report["hits"]} hits')
+    verb = 'Would record' if args.dry_run else 'Recorded'
+    print(f'{verb} {len(report["new"])} new hits')
+    for email_address, url in report['new']:
+        print(f'{email_address} -- {url}')
+
+
+def history(args):
+    """
+    Prints a page of a user's hits
+    :param args: parser.parse_args() namespace
+    :return: None
+    """
+    limit = args.limit or 20
+    hits = Feed(Config.database).get_hit_history(args.history, before_id=args.before,
+                                                 limit=limit)
+    if not hits:
+        print(f'No more hits for {args.history}' if args.before
+              else f'No hits for {args.history}')
+        return
+    print(f'Hits for {args.history}:')
+    for hit_id, url, issue_date, matched_at, terms in hits:
+        print(f'{hit_id}. {issue_date or "unknown date"} -- {url}')
+        if matched_at:
+            print(f'    found {matched_at}: {", ".join(terms or [])}')
+    if len(hits) == limit:
+        print(f'For more, add --before {hits[-1][0]}')
+
+
+def export(args):
+    """
+    Streams a dataset to --output, or to stdout, printing a summary to stderr
+    so that it can't end up in the export.  --output is written to a .part
+    file which replaces it once the export succeeds, so a failed export
+    leaves any earlier one in place.
+    :param args: parser.parse_args() namespace
+    :return: None
+    """
+    rows = Feed(Config.database).export_rows(args.export, after_id=args.after or 0,
+                                             since=args.since)
+    try:
+        if args.output:
+            partial = f'{args.output}.part'
+            try:
+                with open(partial, 'w', newline='', encoding='utf-8') as file:
+                    count, last_id = write_export(rows, file, args.format or 'csv')
+                os.replace(partial, args.output)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+        else:
+            count, last_id = write_export(rows, sys.stdout, args.format or 'csv')
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return
+    print(f'Exported {count} {args.export}', file=sys.stderr)
+    if last_id is not None:
+        print(f'To export only newer {args.export} next time, add --after {last_id}',
+              file=sys.stderr)
+
+
+def term_stats():
+    """
+    Prints how often each search term is found, so that terms which never
+    match, or match almost every issue, can be spotted
+    :return: None
+    """
+    stats = Feed(Config.database).get_term_stats()
+    if not stats:
+        print('No search terms in database')
+        return
+    print('Term -- users -- issues found in / searched, since -- last found')
+    for term, users, since, scanned, hits, last_hit in stats:
+        share = f' ({hits / scanned:.0%})' if scanned else ''
+        print(f'{term} -- {users} -- {hits} / {scanned}{share}, since {since} '
+              f'-- {last_hit or "never"}')
+
+
+def maintenance(full=False):
+    """
+    :param full: bool, allows the database to be rebuilt
+    :return: None
+    """
+    with Feed(Config.database) as feed:
+        report = feed.maintain(full=full)
+    if report['cutoff']:
+        print(f'Archived {report["archived"]} issues dated before {report["cutoff"]}')
+        for path in report['files']:
+            print(path)
+    if report['pages'] is None:
+        print('The database has to be rebuilt once before space can be freed.  '
+              'Run --maintenance --full while no refresh is running')
+    else:
+        print(f'Freed {report["pages"]} database pages')
+
+
+def daemon(budget=None):
+    """
+    Refreshes the feed every Config.refresh_interval seconds.  A failed
+    refresh is reported and retried at the next interval.
+    :param budget: float, seconds after which each refresh stops
+    :return: None
+    """
+    server = None
+    if Config.metrics_port:
+        server = metrics.REGISTRY.serve(Config.metrics_port)
+        print(f'Serving metrics at http://127.0.0.1:{Config.metrics_port}/metrics')
+    try:
+        while True:
+            try:
+                start(budget=budget)
+            except Exception as error:
+                print(f'Refresh failed: {error}')
+            time.sleep(Config.refresh_interval)
+    except KeyboardInterrupt:
+        print('Stopped')
+    finally:
+        if server:
+            server.shutdown()
+
+
+def start(budget=None):
     """
     Calls the table creation and refresh methods.
+    :param budget: float, seconds after which the refresh stops
     :return: None
     """
     print('Running...')
     with Feed(Config.database) as feed:
-        feed.refresh()
+        feed.refresh(budget=budget)
 
 
 if __name__ == '__main__':
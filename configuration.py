@@ -13,3 +13,113 @@ class Config:
     host = 'smtp.gmail.com'
     port = '587'
     database = path.join(path.dirname(__file__), 'data.db')
+
+    # Court roll downloads
+    max_page_bytes = 5 * 1024 * 1024  # Issues larger than this are skipped
+    chunk_size = 64 * 1024
+    connect_timeout = 10  # seconds
+    read_timeout = 30  # seconds
+
+    # Downloaded pages are cached in cache_dir, None turns the cache off.
+    # Cached pages are only downloaded again if the server says they've
+    # changed, and the least recently used are evicted once the cache is
+    # bigger than cache_max_bytes.  cache_replay never touches the network,
+    # so that a run can be reproduced offline; pages which aren't cached are
+    # skipped, and alerts are recorded as sent without being mailed, so
+    # replay against a copy of the database.
+    cache_dir = None
+    cache_max_bytes = 500 * 1024 * 1024
+    cache_replay = False
+
+    # New issues are queued in the database, then claimed by refreshes
+    # claim_batch_size at a time, so that several processes can share the
+    # work.  Claims last claim_lease seconds; issues claimed by a process
+    # which crashed are picked up again once the lease runs out.
+    claim_batch_size = 10
+    claim_lease = 15 * 60  # seconds
+
+    # Number of users or search terms listed at a time by manager.py
+    menu_page_size = 20
+
+    # A refresh stops after refresh_budget seconds, None for no limit.  Issues
+    # taking longer than fetch_timeout, parse_timeout or match_timeout
+    # seconds to download, parse or search are left for the next run, and
+    # an alert taking longer than notify_timeout to send fails the refresh.
+    # Each issue's progress is saved as it goes, so the next run carries on
+    # exactly where the last one stopped.
+    refresh_budget = None  # seconds
+    fetch_timeout = 120  # seconds
+    parse_timeout = 60  # seconds
+    match_timeout = 60  # seconds
+    notify_timeout = 60  # seconds
+
+    # Number of issues allowed to wait between each stage of a refresh
+    pipeline_queue_size = 2
+
+    # Issues are downloaded over up to fetch_max_concurrency connections per
+    # host.  Downloads start one at a time and add connections while the
+    # server keeps up; 429 or 5xx responses, timeouts and responses taking
+    # fetch_slow_factor times longer than the fastest halve the number.  At
+    # most fetch_rate requests are started per second, in bursts of up to
+    # fetch_burst.  429 & 5xx responses are retried fetch_retries times,
+    # after the server's Retry-After or fetch_backoff seconds, doubling.
+    fetch_max_concurrency = 4
+    fetch_rate = 2.0
+    fetch_burst = 4
+    fetch_slow_factor = 4
+    fetch_retries = 3
+    fetch_backoff = 1.0  # seconds
+
+    # Fuzzy matching also finds search terms spelt with different spacing,
+    # punctuation or up to fuzzy_max_distance typos.  Terms added with their
+    # own distance use that instead.  It is several times slower than exact
+    # matching; run `benchmarks.py matcher` to compare the two.
+    fuzzy_matching = False
+    fuzzy_max_distance = 1
+
+    # Alerts quote the text around the first snippet_count places each term
+    # was found, up to snippet_chars characters either side, under the
+    # heading of the court or section it was found in.  Headings are the
+    # elements of the roll matching the CSS selector heading_selector.
+    snippet_count = 3
+    snippet_chars = 80
+    heading_selector = 'h1, h2, h3, h4, h5, h6'
+
+    # The Matcher built from every user's search terms is saved to
+    # matcher_cache, and loaded instead of being built again until search
+    # terms are added or removed; None turns this off.
+    matcher_cache = path.join(path.dirname(__file__), 'matcher.cache')
+
+    # Users with the same search terms found in an issue are sent their
+    # alerts together, up to alert_batch_size over each connection to the
+    # mail server.
+    alert_batch_size = 50
+
+    # Worker processes used by cli.py --reprocess, None uses every CPU
+    reprocess_workers = None
+
+    # Each issue's search text is stored next to its html, zlib compressed
+    # if set.  Existing issues are backfilled this many at a time.
+    compress_text = True
+    backfill_batch_size = 100
+
+    # cli.py --maintenance moves the html & search text of issues older than
+    # retention_months into monthly gzip archives in archive_dir, keeping
+    # their urls & hits, then hands the freed space back to the filesystem
+    # vacuum_pages pages at a time.  None keeps every issue in the database.
+    retention_months = 12
+    archive_dir = path.join(path.dirname(__file__), 'archive')
+    vacuum_pages = 256
+
+    # Seconds to wait for another connection to finish writing, so that
+    # maintenance & a refresh can run at the same time
+    busy_timeout = 30
+
+    # Refresh & alert statistics are written to metrics_file after each
+    # refresh, in the Prometheus text format; None to turn this off.  In
+    # cli.py --daemon mode the feed is refreshed every refresh_interval
+    # seconds and, if metrics_port is set, the statistics are also served at
+    # http://127.0.0.1:<metrics_port>/metrics
+    metrics_file = path.join(path.dirname(__file__), 'metrics.prom')
+    refresh_interval = 60 * 60  # seconds
+    metrics_port = None
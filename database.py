@@ -1,62 +1,261 @@
 """
 This module contains a single class, Database, which handles connections and
-queries to the sqlite database
+queries to the sqlite database.  It is the Backend used by Feed by default.
 """
+from datetime import date, datetime
+import json
+import re
 import sqlite3
+import time
+import uuid
+import zlib
 
+from backend import Backend
+from configuration import Config
+from query import parse
 
-class Database:
+
+EXPORTS = {
+    'users': ('SELECT id, name, email_address FROM users WHERE id > ?', None),
+    'terms': ('SELECT ut.id, u.email_address, t.term, t.max_distance '
+              'FROM user_terms ut JOIN users u ON ut.user_id = u.id '
+              'JOIN terms t ON ut.term_id = t.id WHERE ut.id > ?', None),
+    'hits': ('SELECT ui.id, u.name, u.email_address, i.url, i.date AS issue_date, '
+             'ui.matched_at, ui.terms, ui.sent FROM user_issues ui '
+             'JOIN users u ON ui.user_id = u.id '
+             'JOIN issues i ON ui.issue_id = i.id WHERE ui.id > ? '
+             'AND ui.id < COALESCE((SELECT MIN(id) FROM user_issues WHERE sent = 0), '
+             'ui.id + 1)',
+             'COALESCE(ui.matched_at, i.date) >= ?'),
+}  # Query & date filter for each dataset export_rows can stream; hits stop
+# short of the first alert still to be mailed, so that a later export's
+# after_id never skips it
+_MONTHS = ['january', 'february', 'march', 'april', 'may', 'june', 'july',
+           'august', 'september', 'october', 'november', 'december']
+_URL_DATES = [
+    re.compile(r'(?<!\d)(?P<year>(?:19|20)\d\d)[-_/]?(?P<month>\d\d)[-_/]?(?P<day>\d\d)(?!\d)'),
+    re.compile(r'(?<!\d)(?P<day>\d{1,2})(?:st|nd|rd|th)?[-_ ]'
+               r'(?P<month>' + '|'.join(_MONTHS) + r')[-_ ](?P<year>\d{4})(?!\d)',
+               re.IGNORECASE),
+]  # Dates as they may appear in issue urls
+
+
+def date_from_url(url):
+    """
+    :param url: str
+    :return: str, ISO date found in url, e.g. 2017-10-19 or
+    19th-october-2017, or None if there isn't one
+    """
+    for pattern in _URL_DATES:
+        for match in pattern.finditer(url):
+            month = match.group('month')
+            month = int(month) if month.isdigit() else _MONTHS.index(month.lower()) + 1
+            try:
+                return date(int(match.group('year')), month,
+                            int(match.group('day'))).isoformat()
+            except ValueError:
+                continue
+    return None
+
+
+class Database(Backend):
     """
     This class uses sqlite to create a database for usage with a rss
     feed search.  Methods written handle adding & removing users and their
-    associated search terms from the database.
+    associated search terms from the database.  Maintenance, history &
+    export queries are only offered by this backend.
     """
     def __init__(self, database):
         """
         :param database: str database file
         """
         self._database = database
-        self._connection = sqlite3.connect(self._database)
+        self._connection = sqlite3.connect(self._database,
+                                           timeout=Config.busy_timeout)
         self._connection.execute('PRAGMA foreign_keys=ON')
         self.cursor = self._connection.cursor()
 
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type is not None:
-            print(f'{exc_type} - {exc_val} {exc_tb}')
-
     def __repr__(self):
         return f"{self.__class__.__name__}({self._database})"
 
     def __str__(self):
         return f"<{self.__class__.__name__} using {self._database}>"
 
+    def close(self):
+        """
+        Closes the connection, uncommitted changes are lost
+        :return: None
+        """
+        self._connection.close()
+
     def create_tables(self):
         """
         Creates table users if not present.  Used to initialize the database.
+        Each distinct search term is stored once in terms, user_terms links
+        users to them.  search_terms is a view over the pair, kept for
+        compatibility with the original one-row-per-user-and-term table.
+        term_stats counts the issues each term was found in, from the day it
+        was added.  settings holds the database's id, the term set version,
+        see get_term_set_version, & issues_scanned, the number of issues ever
+        searched.  Each term's scanned_from is issues_scanned when it was
+        added, so the issues it was searched for in are the difference; the
+        scanned column holds that count for databases from before then.
+        Issues stored before they had a date are given one when the column is
+        added, see _backfill_issue_dates.
+        The database is kept in WAL mode, so readers don't block a writer, and
+        new databases are created with incremental vacuuming.
         :return: None
         """
+        self.cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.cursor.execute('PRAGMA journal_mode = WAL')
         self.cursor.execute('CREATE TABLE IF NOT EXISTS users '
                             '(id INTEGER PRIMARY KEY, '
                             'name TEXT, '
                             'email_address TEXT UNIQUE)')
-        self.cursor.execute('CREATE TABLE IF NOT EXISTS search_terms '
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS terms '
+                            '(id INTEGER PRIMARY KEY, '
+                            'term TEXT UNIQUE NOT NULL,'
+                            'max_distance INTEGER)')
+        self._add_column('terms', 'max_distance', 'INTEGER')
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS term_stats '
+                            '(term_id INTEGER PRIMARY KEY,'
+                            'since TEXT,'
+                            'scanned INTEGER NOT NULL DEFAULT 0,'
+                            'hits INTEGER NOT NULL DEFAULT 0,'
+                            'last_hit TEXT,'
+                            'scanned_from INTEGER,'
+                            'FOREIGN KEY(term_id) REFERENCES terms(id))')
+        self._add_column('term_stats', 'scanned_from', 'INTEGER')
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS user_terms '
                             '(id INTEGER PRIMARY KEY, '
-                            'term TEXT NOT NULL,'
                             'user_id INTEGER NOT NULL,'
-                            'FOREIGN KEY(user_id) REFERENCES users(id))')
+                            'term_id INTEGER NOT NULL,'
+                            'UNIQUE(user_id, term_id),'
+                            'FOREIGN KEY(user_id) REFERENCES users(id),'
+                            'FOREIGN KEY(term_id) REFERENCES terms(id))')
+        self._migrate_search_terms()
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS settings '
+                            '(name TEXT PRIMARY KEY,'
+                            'value)')
+        self.cursor.execute("INSERT OR IGNORE INTO settings VALUES ('database_id', ?)",
+                            (uuid.uuid4().hex,))
+        self.cursor.execute("INSERT OR IGNORE INTO settings VALUES ('term_set_version', 0)")
+        self.cursor.execute("INSERT OR IGNORE INTO settings SELECT 'issues_scanned', "
+                            "COALESCE(MAX(scanned), 0) FROM term_stats")
+        self.cursor.execute("UPDATE term_stats SET scanned_from = (SELECT value FROM settings "
+                            "WHERE name = 'issues_scanned') - scanned "
+                            "WHERE scanned_from IS NULL")
+        self.cursor.execute("INSERT OR IGNORE INTO term_stats(term_id, since, scanned_from) "
+                            "SELECT id, ?, (SELECT value FROM settings "
+                            "WHERE name = 'issues_scanned') FROM terms",
+                            (date.today().isoformat(),))
+        self.cursor.execute('CREATE VIEW IF NOT EXISTS search_terms AS '
+                            'SELECT ut.id AS id, t.term AS term, '
+                            'ut.user_id AS user_id FROM user_terms ut '
+                            'JOIN terms t ON ut.term_id = t.id')
         self.cursor.execute('CREATE TABLE IF NOT EXISTS issues '
                             '(id INTEGER PRIMARY KEY,'
                             'url TEXT UNIQUE NOT NULL,'
-                            'html TEXT)')
+                            'html TEXT,'
+                            'date TEXT,'
+                            'text BLOB,'
+                            "status TEXT NOT NULL DEFAULT 'done',"
+                            'claimed_by TEXT,'
+                            'lease_expires REAL)')
+        dated = self._add_column('issues', 'date', 'TEXT')
+        self._add_column('issues', 'text', 'BLOB')
+        self._add_column('issues', 'status', "TEXT NOT NULL DEFAULT 'done'")
+        self._add_column('issues', 'claimed_by', 'TEXT')
+        self._add_column('issues', 'lease_expires', 'REAL')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS issues_date '
+                            'ON issues(date)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS issues_status '
+                            'ON issues(status)')
         self.cursor.execute('CREATE TABLE IF NOT EXISTS user_issues '
                             '(id INTEGER PRIMARY KEY,'
                             'user_id INTEGER,'
                             'issue_id INTEGER,'
+                            'matched_at TEXT,'
+                            'terms TEXT,'
+                            'sent INTEGER NOT NULL DEFAULT 1,'  # 0 unsent, 2 reprocessed
                             'FOREIGN KEY(user_id) REFERENCES users(id),'
                             'FOREIGN KEY (issue_id) REFERENCES issues(id))')
+        self._add_column('user_issues', 'matched_at', 'TEXT')
+        self._add_column('user_issues', 'terms', 'TEXT')
+        self._add_column('user_issues', 'sent', 'INTEGER NOT NULL DEFAULT 1')
+        self._unique_user_issues()
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS user_issues_history '
+                            'ON user_issues(user_id, id)')
+        if dated:
+            self._backfill_issue_dates()
+        self._connection.commit()
+
+    def _add_column(self, table, column, definition):
+        """
+        Adds column to a table created by an older version, if it is missing
+        :param table: str
+        :param column: str
+        :param definition: str, column type & constraints
+        :return: bool, True if the column was added
+        """
+        self.cursor.execute(f'PRAGMA table_info({table})')
+        if column in [row[1] for row in self.cursor.fetchall()]:
+            return False
+        self.cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        return True
+
+    def _backfill_issue_dates(self):
+        """
+        Dates the issues stored before issues had a date column, by the day
+        they were first matched or, failing that, a date in their url.  Run
+        once, by create_tables, when it adds the column.  Issues left without
+        a date are only returned by iter_issues when no date range is given.
+        Does not commit.
+        :return: None
+        """
+        self.cursor.execute('UPDATE issues SET date = (SELECT MIN(substr(matched_at, 1, 10)) '
+                            'FROM user_issues WHERE issue_id = issues.id) '
+                            'WHERE date IS NULL')
+        self.cursor.execute('SELECT id, url FROM issues WHERE date IS NULL')
+        dates = [(date_from_url(url), issue_id) for issue_id, url in self.cursor.fetchall()]
+        self.cursor.executemany('UPDATE issues SET date = ? WHERE id = ?',
+                                [row for row in dates if row[0]])
+
+    def _unique_user_issues(self):
+        """
+        Older versions recorded an issue against a user once per matching
+        term.  Removes those duplicates, then adds the unique index which lets
+        user issues be written idempotently.
+        :return: None
+        """
+        self.cursor.execute("SELECT name FROM sqlite_master "
+                            "WHERE name = 'user_issues_unique'")
+        if self.cursor.fetchone():
+            return
+        self.cursor.execute('DELETE FROM user_issues WHERE id NOT IN '
+                            '(SELECT MIN(id) FROM user_issues '
+                            'GROUP BY user_id, issue_id)')
+        self.cursor.execute('CREATE UNIQUE INDEX user_issues_unique '
+                            'ON user_issues(user_id, issue_id)')
+        self._connection.commit()
+
+    def _migrate_search_terms(self):
+        """
+        Moves rows from the original search_terms table, if present, into
+        terms & user_terms, then drops it so that the view can replace it.
+        :return: None
+        """
+        self.cursor.execute("SELECT type FROM sqlite_master "
+                            "WHERE name = 'search_terms'")
+        if self.cursor.fetchone() != ('table',):
+            return
+        self.cursor.execute('INSERT OR IGNORE INTO terms(term) '
+                            'SELECT term FROM search_terms ORDER BY id')
+        self.cursor.execute('INSERT OR IGNORE INTO user_terms(user_id, term_id) '
+                            'SELECT s.user_id, t.id FROM search_terms s '
+                            'JOIN terms t ON s.term = t.term ORDER BY s.id')
+        self.cursor.execute('DROP TABLE search_terms')
+        self._connection.commit()
 
     def add_user(self, name, email_address):
         """
@@ -77,7 +276,7 @@ class Database:
         :param email_address: str
         :return: None
         """
-        self.cursor.execute('DELETE FROM search_terms WHERE user_id in '
+        self.cursor.execute('DELETE FROM user_terms WHERE user_id in '
                             '(SELECT id FROM users u WHERE u.email_address = ?)',
                             (email_address,))
         self.cursor.execute('DELETE FROM user_issues WHERE user_id IN '
@@ -85,6 +284,8 @@ class Database:
                             (email_address,))
         self.cursor.execute('DELETE FROM users WHERE email_address = ?',
                             (email_address,))
+        self._remove_orphan_terms()
+        self._bump_term_set_version()
         self._connection.commit()
 
     def get_users(self):
@@ -94,16 +295,48 @@ class Database:
         self.cursor.execute('SELECT name, email_address FROM users')
         return self.cursor.fetchall()
 
-    def add_search_term(self, email_address, search_term):
+    def get_subscriptions(self):
+        """
+        Fetches every user along with their search terms in a single query.
+        Users without search terms appear once, with a term of None.
+        :return: list of 3-tuples, name, email address & term, ordered by
+        user then by the order in which terms were added
+        """
+        self.cursor.execute('SELECT u.name, u.email_address, t.term FROM users u '
+                            'LEFT JOIN user_terms ut ON ut.user_id = u.id '
+                            'LEFT JOIN terms t ON ut.term_id = t.id '
+                            'ORDER BY u.id, ut.id')
+        return self.cursor.fetchall()
+
+    def add_search_term(self, email_address, search_term, max_distance=None):
         """
-        Adds terms to search_terms based on email_address
+        Adds terms to search_terms based on email_address.  Each distinct term
+        is only stored once, however many users it belongs to.  Terms
+        containing double quotes are parsed as expressions, see query.py;
+        raises ValueError if they can't be.
         :param email_address: str
         :param search_term: str
+        :param max_distance: int, number of typos tolerated when fuzzy
+        matching this term.  None leaves the term's current setting alone.
         :return: None
         """
-        self.cursor.execute('INSERT INTO search_terms(term, user_id) '
-                            'SELECT ?, id FROM users WHERE email_address = ?',
+        parse(search_term)
+        self.cursor.execute('INSERT OR IGNORE INTO terms(term) SELECT ? '
+                            'WHERE EXISTS (SELECT id FROM users '
+                            'WHERE email_address = ?)',
                             (search_term, email_address))
+        if max_distance is not None:
+            self.cursor.execute('UPDATE terms SET max_distance = ? WHERE term = ?',
+                                (max_distance, search_term))
+        self.cursor.execute("INSERT OR IGNORE INTO term_stats(term_id, since, scanned_from) "
+                            "SELECT id, ?, (SELECT value FROM settings "
+                            "WHERE name = 'issues_scanned') FROM terms WHERE term = ?",
+                            (date.today().isoformat(), search_term))
+        self.cursor.execute('INSERT OR IGNORE INTO user_terms(user_id, term_id) '
+                            'SELECT u.id, t.id FROM users u, terms t '
+                            'WHERE u.email_address = ? AND t.term = ?',
+                            (email_address, search_term))
+        self._bump_term_set_version()
         self._connection.commit()
 
     def remove_search_term(self, email_address, term):
@@ -113,36 +346,476 @@ class Database:
         :param term: str
         :return: None
         """
-        self.cursor.execute('DELETE FROM search_terms WHERE user_id IN '
+        self.cursor.execute('DELETE FROM user_terms WHERE user_id IN '
                             '(SELECT id FROM users u WHERE u.email_address = ?)'
-                            ' AND term = ?',
+                            ' AND term_id IN (SELECT id FROM terms WHERE term = ?)',
                             (email_address, term))
+        self._remove_orphan_terms()
+        self._bump_term_set_version()
         self._connection.commit()
 
+    def get_term_set_version(self):
+        """
+        The version goes up with every change to users' search terms, so that
+        anything built from them, e.g. a Matcher, can tell whether it's stale
+        :return: 2-tuple, str id of this database & int term set version
+        """
+        self.cursor.execute("SELECT name, value FROM settings "
+                            "WHERE name IN ('database_id', 'term_set_version')")
+        settings = dict(self.cursor.fetchall())
+        return settings['database_id'], settings['term_set_version']
+
+    def _bump_term_set_version(self):
+        """
+        Does not commit
+        :return: None
+        """
+        self.cursor.execute("UPDATE settings SET value = value + 1 "
+                            "WHERE name = 'term_set_version'")
+
+    def get_term_distances(self):
+        """
+        :return: dict of search term to the number of typos tolerated when
+        fuzzy matching it, for terms with their own setting
+        """
+        self.cursor.execute('SELECT term, max_distance FROM terms '
+                            'WHERE max_distance IS NOT NULL')
+        return dict(self.cursor.fetchall())
+
+    def _remove_orphan_terms(self):
+        """
+        Deletes terms which no longer belong to any user.  Does not commit.
+        :return: None
+        """
+        self.cursor.execute('DELETE FROM term_stats WHERE term_id NOT IN '
+                            '(SELECT term_id FROM user_terms)')
+        self.cursor.execute('DELETE FROM terms WHERE id NOT IN '
+                            '(SELECT term_id FROM user_terms)')
+
+    def record_term_hits(self, terms):
+        """
+        Counts an issue as searched for every current term, and as a hit for
+        each of terms, then commits.  Called once per new issue, so that
+        get_term_stats never has to look through user_issues.  Only the
+        issues_scanned setting & the rows of terms are written.
+        :param terms: iterable of str, the distinct terms found in the issue
+        :return: None
+        """
+        self._record_term_hits(terms)
+        self._connection.commit()
+
+    def _record_term_hits(self, terms):
+        """
+        record_term_hits, without committing
+        """
+        self.cursor.execute("UPDATE settings SET value = value + 1 "
+                            "WHERE name = 'issues_scanned'")
+        self.cursor.executemany('UPDATE term_stats SET hits = hits + 1, last_hit = ? '
+                                'WHERE term_id = (SELECT id FROM terms WHERE term = ?)',
+                                [(datetime.now().isoformat(' ', 'seconds'), term)
+                                 for term in terms])
+
+    def get_term_stats(self):
+        """
+        :return: list of 6-tuples, term, number of users with it, date
+        statistics began, issues searched since, issues it was found in &
+        when it was last found, or None.  Ordered from the fewest hits per
+        issue searched to the most.
+        """
+        self.cursor.execute("SELECT * FROM (SELECT t.term, COUNT(ut.id), s.since, "
+                            "(SELECT value FROM settings WHERE name = 'issues_scanned') "
+                            "- s.scanned_from AS scanned, s.hits, s.last_hit "
+                            "FROM term_stats s "
+                            "JOIN terms t ON s.term_id = t.id "
+                            "LEFT JOIN user_terms ut ON ut.term_id = t.id "
+                            "GROUP BY t.id) "
+                            "ORDER BY hits * 1.0 / MAX(scanned, 1), scanned DESC, term")
+        return self.cursor.fetchall()
+
     def get_search_terms(self, email_address):
         """
         If email address absent from database, raises ValueError.
         :param email_address: str
         :return: list of search terms associated with email_address
         """
-        self.cursor.execute('SELECT term FROM search_terms JOIN users u ON'
-                            ' search_terms.user_id = u.id '
-                            'AND u.email_address = ?', (email_address,))
+        self.cursor.execute('SELECT t.term FROM user_terms ut '
+                            'JOIN users u ON ut.user_id = u.id '
+                            'JOIN terms t ON ut.term_id = t.id '
+                            'WHERE u.email_address = ? ORDER BY ut.id',
+                            (email_address,))
         return [item[0] for item in self.cursor.fetchall()]
 
-    def add_url_html(self, url, html=None):
+    def add_url_html(self, url, html=None, issue_date=None, text=None):
         """
         adds url to issues table, re-raises if url already in table
         :param url: str
         :param html: str the html from each court roll issue
+        :param issue_date: str, ISO format date of the issue, defaults to today
+        :param text: str, the issue's search text, stored alongside the html so
+        that it never has to be parsed again
+        :return: None
+        """
+        issue_date = issue_date or date.today().isoformat()
+        self.cursor.execute('INSERT INTO issues(url, html, date, text) '
+                            'VALUES (?,?,?,?)',
+                            (url, html or None, issue_date, self._encode_text(text)))
+        self._connection.commit()
+
+    def queue_issues(self, issues):
+        """
+        Adds issues found in the feed, to be claimed & processed by
+        claim_issues.  Issues already in the database are left alone, so any
+        number of processes can queue the same feed.
+        :param issues: list of 2-tuples, url & ISO format date, or None for
+        today
         :return: None
         """
-        if html:
-            self.cursor.execute('INSERT INTO issues(url, html) VALUES (?,?)',
-                                (url, html))
-        else:
-            self.cursor.execute('INSERT INTO issues(url) VALUES (?)', (url,))
+        today = date.today().isoformat()
+        self.cursor.executemany("INSERT OR IGNORE INTO issues(url, date, status) "
+                                "VALUES (?,?,'new')",
+                                [(url, issue_date or today) for url, issue_date in issues])
+        self._connection.commit()
+
+    def claim_issues(self, worker, limit, lease):
+        """
+        Claims queued issues for worker, along with any whose previous claim
+        has expired before they were stored.  The write lock is taken before
+        looking for issues, so two workers can never claim the same one.
+        :param worker: str, unique to the claiming process
+        :param limit: int, most issues to claim
+        :param lease: float, seconds before the claims expire & the issues
+        can be claimed by another worker
+        :return: list of 2-tuples, url & date of each claimed issue, in the
+        order they were queued
+        """
+        rows = self._claim("status = 'new' OR (status = 'claimed' AND lease_expires < ?)",
+                           worker, limit, lease, 'claimed')
+        return [(url, issue_date) for url, issue_date, _, _ in rows]
+
+    def claim_unfinished(self, worker, limit, lease):
+        """
+        Claims issues which were stored, or matched, by a refresh which
+        stopped before finishing them, so that they can be carried on with
+        from that point
+        :param worker: str
+        :param limit: int
+        :param lease: float
+        :return: list of 4-tuples, url, date, status, stored or matched, &
+        search text
+        """
+        rows = self._claim("status IN ('stored', 'matched') AND "
+                           "(claimed_by IS NULL OR lease_expires < ?)",
+                           worker, limit, lease)
+        return [(url, issue_date, status, self._decode_text(text))
+                for url, issue_date, status, text in rows]
+
+    def _claim(self, condition, worker, limit, lease, status=None):
+        """
+        :param condition: str, SQL picking the issues to claim, with a
+        placeholder for the current time
+        :param worker: str
+        :param limit: int
+        :param lease: float
+        :param status: str, given to the claimed issues, None to leave it
+        :return: list of 4-tuples, url, date, previous status & text
+        """
+        now = time.time()
         self._connection.commit()
+        self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            self.cursor.execute(f'SELECT id, url, date, status, text FROM issues '
+                                f'WHERE {condition} ORDER BY id LIMIT ?', (now, limit))
+            rows = self.cursor.fetchall()
+            self.cursor.executemany('UPDATE issues SET status = COALESCE(?, status), '
+                                    'claimed_by = ?, lease_expires = ? WHERE id = ?',
+                                    [(status, worker, now + lease, row[0]) for row in rows])
+            self._connection.commit()
+        except BaseException:
+            self._connection.rollback()
+            raise
+        return [row[1:] for row in rows]
+
+    def renew_claim(self, url, worker, lease):
+        """
+        Extends worker's claim on url by lease seconds from now, as long as
+        it hasn't run out.  Called as an issue moves through refresh, so that
+        another worker only takes it over once this one has stopped.
+        :param url: str
+        :param worker: str
+        :param lease: float
+        :return: bool, False if the claim was lost or had run out
+        """
+        now = time.time()
+        self.cursor.execute('UPDATE issues SET lease_expires = ? '
+                            'WHERE url = ? AND claimed_by = ? AND lease_expires > ?',
+                            (now + lease, url, worker, now))
+        renewed = self.cursor.rowcount == 1
+        self._connection.commit()
+        return renewed
+
+    def complete_issue(self, url, worker, html, text):
+        """
+        Stores a claimed issue's html & search text, marking it stored, as
+        long as worker still holds the claim.  The claim is kept until the
+        issue is finished, see finish_issue.
+        :param url: str
+        :param worker: str
+        :param html: str
+        :param text: str, search text
+        :return: bool, False if the claim was lost, e.g. because the lease
+        expired and another worker claimed the issue, in which case nothing
+        is stored
+        """
+        self.cursor.execute("UPDATE issues SET html = ?, text = ?, status = 'stored' "
+                            "WHERE url = ? AND status = 'claimed' AND claimed_by = ?",
+                            (html or None, self._encode_text(text), url, worker))
+        completed = self.cursor.rowcount == 1
+        self._connection.commit()
+        return completed
+
+    def record_matches(self, url, worker, hits):
+        """
+        Records a stored issue's hits, as alerts yet to be sent, along with
+        its term statistics, and marks it matched, all in one transaction
+        :param url: str
+        :param worker: str, which must hold the issue's claim
+        :param hits: list of 2-tuples, email address & list of the search
+        terms found
+        :return: bool, False if the claim was lost, in which case nothing is
+        recorded
+        """
+        self.cursor.execute("UPDATE issues SET status = 'matched' "
+                            "WHERE url = ? AND status = 'stored' AND claimed_by = ?",
+                            (url, worker))
+        if self.cursor.rowcount != 1:
+            self._connection.rollback()
+            return False
+        today = date.today().isoformat()
+        self.cursor.executemany('INSERT OR IGNORE INTO user_issues'
+                                '(user_id, issue_id, matched_at, terms, sent) '
+                                'SELECT u.id, i.id, ?, ?, 0 FROM users u, issues i '
+                                'WHERE u.email_address = ? AND i.url = ?',
+                                [(today, self._encode_terms(terms), email_address, url)
+                                 for email_address, terms in hits])
+        self._record_term_hits({term for _, terms in hits for term in terms})
+        self._connection.commit()
+        return True
+
+    def get_unsent_alerts(self, url):
+        """
+        :param url: str
+        :return: list of 2-tuples, email address & list of search terms found,
+        for the issue's hits which haven't been mailed yet
+        """
+        self.cursor.execute('SELECT u.email_address, ui.terms FROM user_issues ui '
+                            'JOIN users u ON ui.user_id = u.id '
+                            'JOIN issues i ON ui.issue_id = i.id '
+                            'WHERE i.url = ? AND ui.sent = 0 ORDER BY ui.id', (url,))
+        return [(email_address, json.loads(terms) if terms else [])
+                for email_address, terms in self.cursor.fetchall()]
+
+    def mark_sent(self, email_address, url, worker=None):
+        """
+        Records that the alert about url has been mailed to email_address.
+        Given worker, only if it still holds the issue's claim: once another
+        worker has claimed the issue, the alerts are its to send & record.
+        An alert sent while the claim ran out, but before anyone else took
+        it, is still recorded, so that it is never sent again.
+        :param email_address: str
+        :param url: str
+        :param worker: str, or None to record the alert regardless
+        :return: bool, False if nothing was recorded
+        """
+        self.cursor.execute('UPDATE user_issues SET sent = 1 '
+                            'WHERE user_id = (SELECT id FROM users WHERE email_address = ?) '
+                            'AND issue_id = (SELECT id FROM issues WHERE url = ? '
+                            'AND (? IS NULL OR claimed_by = ?))',
+                            (email_address, url, worker, worker))
+        recorded = self.cursor.rowcount == 1
+        self._connection.commit()
+        return recorded
+
+    def finish_issue(self, url, worker):
+        """
+        Marks a matched issue whose alerts have all been sent done, giving up
+        worker's claim
+        :param url: str
+        :param worker: str
+        :return: bool, False if the claim was lost
+        """
+        self.cursor.execute("UPDATE issues SET status = 'done', claimed_by = NULL, "
+                            "lease_expires = NULL "
+                            "WHERE url = ? AND status = 'matched' AND claimed_by = ?",
+                            (url, worker))
+        finished = self.cursor.rowcount == 1
+        self._connection.commit()
+        return finished
+
+    def release_issues(self, worker):
+        """
+        Puts the issues worker claimed but didn't store back in the queue, &
+        gives up its claims on those it stored or matched but didn't finish,
+        for claim_unfinished to pick up
+        :param worker: str
+        :return: int, number of issues released
+        """
+        self.cursor.execute("UPDATE issues SET status = 'new', claimed_by = NULL, "
+                            "lease_expires = NULL "
+                            "WHERE status = 'claimed' AND claimed_by = ?", (worker,))
+        released = self.cursor.rowcount
+        self.cursor.execute("UPDATE issues SET claimed_by = NULL, lease_expires = NULL "
+                            "WHERE status IN ('stored', 'matched') AND claimed_by = ?",
+                            (worker,))
+        released += self.cursor.rowcount
+        self._connection.commit()
+        return released
+
+    @staticmethod
+    def _encode_text(text):
+        """
+        :param text: str or None
+        :return: text, zlib compressed if Config.compress_text is set
+        """
+        if text is None or not Config.compress_text:
+            return text
+        return zlib.compress(text.encode('utf-8'))
+
+    @staticmethod
+    def _decode_text(value):
+        """
+        Reads text written by _encode_text, whether compressed or not
+        :param value: str, bytes or None
+        :return: str or None
+        """
+        if isinstance(value, bytes):
+            return zlib.decompress(value).decode('utf-8')
+        return value
+
+    def iter_issues(self, since=None, until=None, url=None, batch_size=100):
+        """
+        Streams stored issues which have html, oldest first, without loading
+        them all into memory.  Uses its own cursor, so other queries can be
+        run while iterating.
+        :param since: str, ISO date, only issues dated on or after this
+        :param until: str, ISO date, only issues dated on or before this.
+        Issues whose date isn't known, see create_tables, are left out once
+        either is given.
+        :param url: str, only issues whose url contains this
+        :param batch_size: int, number of rows fetched from sqlite at a time
+        :yield: 3-tuple, url, html & search text, which is None for issues
+        stored before search text was
+        """
+        query = 'SELECT url, html, text FROM issues WHERE html IS NOT NULL'
+        params = []
+        if since:
+            query += ' AND date >= ?'
+            params.append(since)
+        if until:
+            query += ' AND date <= ?'
+            params.append(until)
+        if url:
+            query += " AND instr(url, ?) > 0"
+            params.append(url)
+        cursor = self._connection.cursor()
+        cursor.execute(query + ' ORDER BY id', params)
+        try:
+            rows = cursor.fetchmany(batch_size)
+            while rows:
+                for issue_url, html, text in rows:
+                    yield issue_url, html, self._decode_text(text)
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            cursor.close()
+
+    def get_issues_without_text(self, after_id=0, limit=100):
+        """
+        :param after_id: int, only issues with a greater id
+        :param limit: int
+        :return: list of 2-tuples, id & html of issues with html but no
+        search text, in id order
+        """
+        self.cursor.execute('SELECT id, html FROM issues WHERE id > ? '
+                            'AND html IS NOT NULL AND text IS NULL '
+                            'ORDER BY id LIMIT ?', (after_id, limit))
+        return self.cursor.fetchall()
+
+    def set_issue_texts(self, texts):
+        """
+        :param texts: list of 2-tuples, issue id & search text
+        :return: None
+        """
+        self.cursor.executemany('UPDATE issues SET text = ? WHERE id = ?',
+                                [(self._encode_text(text), issue_id)
+                                 for issue_id, text in texts])
+        self._connection.commit()
+
+    def get_issues_before(self, cutoff, after_id=0, limit=100):
+        """
+        :param cutoff: str, ISO date
+        :param after_id: int, only issues with a greater id
+        :param limit: int
+        :return: list of 5-tuples, id, url, date, html & search text of issues
+        dated before cutoff, or not dated at all, which still have html or
+        search text, in id order.  Issues are only undated if they were
+        stored before dates were & their date couldn't be worked out, see
+        create_tables, so they are among the oldest.
+        """
+        self.cursor.execute('SELECT id, url, date, html, text FROM issues '
+                            'WHERE id > ? AND (date < ? OR date IS NULL) '
+                            'AND (html IS NOT NULL OR text IS NOT NULL) '
+                            'ORDER BY id LIMIT ?', (after_id, cutoff, limit))
+        return [(issue_id, url, issue_date, html, self._decode_text(text))
+                for issue_id, url, issue_date, html, text in self.cursor.fetchall()]
+
+    def clear_issue_bodies(self, issue_ids):
+        """
+        Removes the html & search text of issues, keeping their urls so that
+        they aren't downloaded again, and their user issues
+        :param issue_ids: list of int
+        :return: None
+        """
+        self.cursor.executemany('UPDATE issues SET html = NULL, text = NULL '
+                                'WHERE id = ?', [(issue_id,) for issue_id in issue_ids])
+        self._connection.commit()
+
+    def compact(self, pages=256, full=False):
+        """
+        Returns free pages to the filesystem a few at a time, committing in
+        between so that other connections can write.  Databases created before
+        incremental vacuuming have to be converted first, by a one-off full
+        VACUUM, which locks the database until it is done.  That is only run
+        if full is set and no refresh holds a claim on an issue.
+        :param pages: int, pages freed per step
+        :param full: bool, allows the full VACUUM
+        :return: int, number of pages freed, or None if the database still
+        needs converting
+        """
+        self.cursor.execute('PRAGMA page_count')
+        before = self.cursor.fetchone()[0]
+        self.cursor.execute('PRAGMA auto_vacuum')
+        if self.cursor.fetchone()[0] != 2:
+            self.cursor.execute('SELECT COUNT(*) FROM issues WHERE claimed_by IS NOT NULL '
+                                'AND lease_expires > ?', (time.time(),))
+            if not full or self.cursor.fetchone()[0]:
+                return None
+            self._connection.commit()
+            self.cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.cursor.execute('VACUUM')
+        self.cursor.execute('PRAGMA freelist_count')
+        remaining = self.cursor.fetchone()[0]
+        while remaining:
+            self.cursor.execute(f'PRAGMA incremental_vacuum({int(pages)})')
+            self.cursor.fetchall()
+            self._connection.commit()
+            self.cursor.execute('PRAGMA freelist_count')
+            left = self.cursor.fetchone()[0]
+            if left >= remaining:
+                break
+            remaining = left
+        self.cursor.execute('PRAGMA page_count')
+        freed = before - self.cursor.fetchone()[0]
+        self.cursor.execute('PRAGMA optimize')
+        return freed
 
     def get_urls(self):
         """
@@ -151,11 +824,12 @@ class Database:
         self.cursor.execute('SELECT url FROM issues')
         return [item[0] for item in self.cursor.fetchall()]
 
-    def add_user_issue(self, email_address, url):
+    def add_user_issue(self, email_address, url, terms=None):
         """
         Handles associating which user is tied to which issue
         :param email_address: str
         :param url: str issue url
+        :param terms: list of str, the user's search terms found in the issue
         :return: None
         """
         self.cursor.execute('SELECT id FROM users WHERE email_address = ?',
@@ -169,18 +843,132 @@ class Database:
         if issue_id is None:
             raise ValueError('Invalid URL')
         issue_id, = issue_id
-        self.cursor.execute('INSERT INTO user_issues(user_id, issue_id)'
-                            ' VALUES (?,?)', (user_id, issue_id))
+        self.cursor.execute('INSERT OR IGNORE INTO user_issues'
+                            '(user_id, issue_id, matched_at, terms) VALUES (?,?,?,?)',
+                            (user_id, issue_id, date.today().isoformat(),
+                             self._encode_terms(terms)))
+        self._connection.commit()
+
+    @staticmethod
+    def _encode_terms(terms):
+        """
+        :param terms: list of str or None
+        :return: str, JSON list, or None
+        """
+        return None if terms is None else json.dumps(list(terms))
+
+    def new_user_issues(self, pairs):
+        """
+        :param pairs: list of 2-tuples, email address & issue url
+        :return: list of the pairs which aren't recorded in user_issues yet
+        """
+        new = []
+        for email_address, url in pairs:
+            self.cursor.execute('SELECT 1 FROM user_issues ui '
+                                'JOIN users u ON ui.user_id = u.id '
+                                'JOIN issues i ON ui.issue_id = i.id '
+                                'WHERE u.email_address = ? AND i.url = ?',
+                                (email_address, url))
+            if self.cursor.fetchone() is None:
+                new.append((email_address, url))
+        return new
+
+    def add_user_issues(self, rows):
+        """
+        Records many user issues at once, skipping those already recorded,
+        then commits once.  They are marked sent = 2, as found by reprocess
+        rather than mailed
+        :param rows: list of tuples, email address, issue url &, optionally,
+        the list of search terms found
+        :return: int, number of rows added
+        """
+        today = date.today().isoformat()
+        self.cursor.executemany('INSERT OR IGNORE INTO user_issues'
+                                '(user_id, issue_id, matched_at, terms, sent) '
+                                'SELECT u.id, i.id, ?, ?, 2 FROM users u, issues i '
+                                'WHERE u.email_address = ? AND i.url = ?',
+                                [(today, self._encode_terms(row[2] if len(row) > 2 else None),
+                                  row[0], row[1]) for row in rows])
+        added = self.cursor.rowcount
         self._connection.commit()
+        return added
 
     def get_user_issues(self, email_address):
         """
         :param email_address: str
-        :return: list of URLs connected to that email address
+        :return: list of URLs connected to that email address, in the order
+        they were recorded
         """
-        self.cursor.execute('SELECT url from issues WHERE id IN '
-                            '(SELECT issue_id FROM user_issues '
-                            'WHERE user_id is (SELECT id FROM users '
-                            'WHERE email_address is ? ))', (email_address,))
-
+        self.cursor.execute('SELECT i.url FROM user_issues ui '
+                            'JOIN users u ON ui.user_id = u.id '
+                            'JOIN issues i ON ui.issue_id = i.id '
+                            'WHERE u.email_address = ? ORDER BY ui.id',
+                            (email_address,))
         return [item[0] for item in self.cursor.fetchall()]
+
+    def get_hit_history(self, email_address, before_id=None, limit=20):
+        """
+        Pages through a user's hits, newest first.  Pages are found by
+        seeking the user_issues_history index to before_id, so each page
+        costs the same however many hits the user has.
+        :param email_address: str
+        :param before_id: int, id of the last hit on the previous page, or
+        None for the first page
+        :param limit: int, hits per page
+        :return: list of 5-tuples, hit id, issue url, issue date, date the hit
+        was recorded & list of the search terms found.  Hits recorded before
+        dates & terms were stored have None for those.
+        """
+        query = ('SELECT ui.id, i.url, i.date, ui.matched_at, ui.terms '
+                 'FROM user_issues ui JOIN issues i ON ui.issue_id = i.id '
+                 'WHERE ui.user_id = (SELECT id FROM users WHERE email_address = ?)')
+        params = [email_address]
+        if before_id is not None:
+            query += ' AND ui.id < ?'
+            params.append(before_id)
+        self.cursor.execute(query + ' ORDER BY ui.id DESC LIMIT ?', params + [limit])
+        return [(hit_id, url, issue_date, matched_at,
+                 None if terms is None else json.loads(terms))
+                for hit_id, url, issue_date, matched_at, terms in self.cursor.fetchall()]
+
+    def export_rows(self, dataset, after_id=0, since=None, batch_size=1000):
+        """
+        Streams every row of one of the EXPORTS datasets in id order.  Rows
+        are read a batch at a time, each with its own short query which seeks
+        past the last id read, so memory use stays flat and no read
+        transaction is held open while the rows are being written out.
+        Raises ValueError for unknown datasets, or if since is given for a
+        dataset without dates.
+        :param dataset: str, users, terms or hits
+        :param after_id: int, only rows with a greater id, to carry on from a
+        previous export
+        :param since: str, ISO date, only hits found on or after this; hits
+        recorded before that was stored use their issue's date
+        :param batch_size: int
+        :yield: dict of column name to value, terms being a list of str
+        """
+        if dataset not in EXPORTS:
+            raise ValueError(f'Unknown dataset {dataset!r}, expected one of '
+                             f'{", ".join(EXPORTS)}')
+        query, date_filter = EXPORTS[dataset]
+        if since and not date_filter:
+            raise ValueError(f'{dataset} can\'t be filtered by date')
+        if since:
+            query += f' AND {date_filter}'
+        query += ' ORDER BY 1 LIMIT ?'
+        cursor = self._connection.cursor()
+        try:
+            while True:
+                cursor.execute(query, [after_id] + ([since] if since else []) + [batch_size])
+                columns = [column[0] for column in cursor.description]
+                rows = cursor.fetchall()
+                for row in rows:
+                    record = dict(zip(columns, row))
+                    if 'terms' in record and record['terms'] is not None:
+                        record['terms'] = json.loads(record['terms'])
+                    yield record
+                if len(rows) < batch_size:
+                    break
+                after_id = rows[-1][0]
+        finally:
+            cursor.close()
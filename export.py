@@ -0,0 +1,37 @@
+"""
+This module contains write_export, which writes the rows streamed by
+Database.export_rows out as CSV or JSON Lines.
+"""
+import csv
+import json
+
+FORMATS = ['csv', 'jsonl']
+
+
+def write_export(rows, file, fmt='csv'):
+    """
+    Writes rows to file one at a time, so that any number of rows can be
+    exported in constant memory.  In CSV, lists are joined with '; '.
+    Raises ValueError for unknown formats.
+    :param rows: iterable of dicts, all with the same keys, which must
+    include id
+    :param file: text file obj
+    :param fmt: str, csv or jsonl
+    :return: 2-tuple, number of rows written & the last row's id, or None if
+    there were no rows
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format {fmt!r}, expected one of {", ".join(FORMATS)}')
+    count, last_id, writer = 0, None, None
+    for row in rows:
+        if fmt == 'jsonl':
+            file.write(json.dumps(row) + '\n')
+        else:
+            if writer is None:
+                writer = csv.DictWriter(file, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow({key: '; '.join(value) if isinstance(value, list) else value
+                             for key, value in row.items()})
+        count += 1
+        last_id = row['id']
+    return count, last_id
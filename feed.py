@@ -1,90 +1,863 @@
 """
 Contains Feed, which handles parsing the rss feed and User, which handles messaging
 """
+import asyncio
+from bisect import bisect_right
+from collections import deque
+from datetime import date
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+import html as markup
+from multiprocessing import Pool
+import os
 import smtplib
+import socket
+import threading
+import time
 
 from bs4 import BeautifulSoup
-import feedparser as fp
 from jinja2 import Environment, PackageLoader, select_autoescape
 from requests import get
+from requests.exceptions import RequestException
 
+from archive import append_issues
+from cache import ResponseCache
 from configuration import Config
 from database import Database
+from matcher import Matcher, load_matcher, save_matcher
+import metrics
+from rss import Entry, parse_feed
+from throttle import FetchController
 
+_DONE = object()  # Passed down the refresh pipeline once a stage has finished
+_worker_matcher = None  # Built once in each reprocessing worker process
+# (directory, max_bytes) to the ResponseCache _fetch uses, which keeps count
+# of the cache's size from one page to the next
+_response_caches = {}
+_TEMPLATES = {
+    'base.txt': Environment(loader=PackageLoader('message', 'templates'),
+                            autoescape=False),
+    'base.html': Environment(loader=PackageLoader('message', 'templates'),
+                             autoescape=select_autoescape(['html', 'xml'])),
+}  # Alert templates & the environment each is rendered in
 
-class Feed(Database):
+
+def render(template, name, search_term_hits, url, contexts=None):
+    """
+    :param template: str, base.txt or base.html
+    :param name: str, as it should appear in the greeting
+    :param search_term_hits: list of search_terms
+    :param url: str
+    :param contexts: dict of term to list of (heading, snippet) tuples
+    :return: str, the alert email's body
+    """
+    return _TEMPLATES[template].get_template(template).render(
+        name=name, search_terms=search_term_hits, contexts=contexts or {}, url=url)
+
+
+def normalize(text):
+    """
+    Collapses the runs of whitespace & line breaks left by html layout, so
+    phrases match across line breaks and the stored text stays small
+    :param text: str
+    :return: str
+    """
+    return ' '.join(text.split())
+
+
+def snippet(text, offset, width):
+    """
+    :param text: str
+    :param offset: int
+    :param width: int
+    :return: str, the text up to width characters either side of offset,
+    trimmed to whole words, with '...' where it was cut short
+    """
+    start, end = max(0, offset - width), offset + width
+    if start:
+        space = text.find(' ', start, offset)
+        start = start if space < 0 else space + 1
+    if end < len(text):
+        space = text.rfind(' ', offset, end)
+        end = end if space < 0 else space
+    return ('...' if start else '') + text[start:end] + ('...' if end < len(text) else '')
+
+
+def hit_contexts(text, term_offsets, headings=None):
+    """
+    Quotes the text around the first Config.snippet_count places each term
+    was found, along with the heading each one falls under.  Places within
+    Config.snippet_chars of the last one quoted are passed over, as they're
+    already in its snippet.
+    :param text: str, the search text term_offsets refer to
+    :param term_offsets: dict of term to sorted offsets, from Matcher.locate
+    :param headings: list of (offset, heading) tuples, sorted, as returned by
+    Feed._parse_sections, or None if they aren't known
+    :return: dict of term to list of (heading, snippet) tuples, heading being
+    None if there isn't one
+    """
+    headings = headings or []
+    starts = [offset for offset, _ in headings]
+    width = Config.snippet_chars
+    contexts = {}
+    for term, offsets in term_offsets.items():
+        quotes, last = contexts.setdefault(term, []), None
+        for offset in offsets:
+            if len(quotes) == Config.snippet_count:
+                break
+            if last is not None and offset - last < width:
+                continue
+            num = bisect_right(starts, offset) - 1
+            quotes.append((headings[num][1] if num >= 0 else None,
+                           snippet(text, offset, width)))
+            last = offset
+    return contexts
+
+
+def retention_cutoff(months, today=None):
+    """
+    :param months: int
+    :param today: date obj, defaults to today
+    :return: str, ISO date of the first day of the month which is months
+    before today's; issues dated earlier are outside the retention period
+    """
+    today = today or date.today()
+    month = today.year * 12 + today.month - 1 - months
+    return date(month // 12, month % 12 + 1, 1).isoformat()
+
+
+def _init_worker(matcher):
+    """
+    :param matcher: Matcher obj
+    :return: None
+    """
+    global _worker_matcher
+    _worker_matcher = matcher
+
+
+def _match_issue(issue):
+    """
+    Matches a stored issue, extracting text from its html if no search text
+    was stored with it
+    :param issue: 3-tuple, url, html & search text
+    :return: 2-tuple, url & list of (email address, search term hits) tuples
+    """
+    url, html, text = issue
+    if text is None:
+        _, text = Feed._parse(html)
+    return url, [(user.email_address, hits)
+                 for user, hits in _worker_matcher.match(text.upper())]
+
+
+def _delegated(name):
+    """
+    :param name: str, name of a Backend method
+    :return: function, a Feed method calling the method of that name on
+    Feed.storage
+    """
+    def method(self, *args, **kwargs):
+        return getattr(self.storage, name)(*args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = f'Calls {name} on the storage backend, see Database.{name}'
+    return method
+
+
+class Feed:
     """
-    Uses Database's methods in conjunction with its own to parse feed url,
-    fetching and parsing page to plain text, searching each text for specific
-    terms and email the correct users if the terms are found.
+    Uses a storage Backend's methods in conjunction with its own to parse feed
+    url, fetching and parsing page to plain text, searching each text for
+    specific terms and email the correct users if the terms are found.  The
+    backend's methods can be called on Feed itself, e.g. feed.get_users().
     """
     URL = 'feed://www.scotcourts.gov.uk/feeds/court-of-session-court-rolls'
 
+    # Backend methods
+    create_tables = _delegated('create_tables')
+    close = _delegated('close')
+    add_user = _delegated('add_user')
+    remove_user = _delegated('remove_user')
+    get_users = _delegated('get_users')
+    get_subscriptions = _delegated('get_subscriptions')
+    add_search_term = _delegated('add_search_term')
+    remove_search_term = _delegated('remove_search_term')
+    get_search_terms = _delegated('get_search_terms')
+    get_term_set_version = _delegated('get_term_set_version')
+    get_term_distances = _delegated('get_term_distances')
+    record_term_hits = _delegated('record_term_hits')
+    get_term_stats = _delegated('get_term_stats')
+    add_url_html = _delegated('add_url_html')
+    get_urls = _delegated('get_urls')
+    queue_issues = _delegated('queue_issues')
+    claim_issues = _delegated('claim_issues')
+    claim_unfinished = _delegated('claim_unfinished')
+    renew_claim = _delegated('renew_claim')
+    complete_issue = _delegated('complete_issue')
+    record_matches = _delegated('record_matches')
+    get_unsent_alerts = _delegated('get_unsent_alerts')
+    mark_sent = _delegated('mark_sent')
+    finish_issue = _delegated('finish_issue')
+    release_issues = _delegated('release_issues')
+    iter_issues = _delegated('iter_issues')
+    add_user_issue = _delegated('add_user_issue')
+    new_user_issues = _delegated('new_user_issues')
+    add_user_issues = _delegated('add_user_issues')
+    get_user_issues = _delegated('get_user_issues')
+    # Only provided by Database
+    get_hit_history = _delegated('get_hit_history')
+    export_rows = _delegated('export_rows')
+    get_issues_without_text = _delegated('get_issues_without_text')
+    set_issue_texts = _delegated('set_issue_texts')
+    get_issues_before = _delegated('get_issues_before')
+    clear_issue_bodies = _delegated('clear_issue_bodies')
+    compact = _delegated('compact')
+
+    def __init__(self, database):
+        """
+        :param database: str database file, or a Backend obj, e.g. a
+        MemoryBackend
+        """
+        self.storage = Database(database) if isinstance(database, str) else database
+        self._matcher = None  # (key, Matcher obj) last built or loaded
+        # Identifies this Feed's claims on issues, see refresh
+        self.worker = f'{socket.gethostname()}:{os.getpid()}:{id(self):x}'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self.storage.__exit__(exc_type, exc_val, exc_tb)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.storage!r})'
+
     def new_urls(self):
         """
-        Gets new URLs, adds to database then yields url
-        :yield: str, url
+        :return: list of str, urls of issues in the feed which aren't in the
+        database yet
+        """
+        return [entry.link for entry in self.new_entries()]
+
+    def new_entries(self):
+        """
+        :return: list of Entry, issues in the feed which aren't in the
+        database yet
+        """
+        known = set(self.get_urls())
+        return [entry for entry in self.entries() if entry.link not in known]
+
+    def entries(self):
+        """
+        Downloads & parses the feed.  If it can't be downloaded, or isn't
+        cached in replay mode, says so and returns no entries, so that a
+        refresh still carries on with issues queued earlier.
+        :return: list of Entry
         """
-        page = fp.parse(self.URL)['entries']
-        return [item['link'] for item in page if item['link'] not in
-                self.get_urls()]
+        try:
+            content = self._fetch(self.URL.replace('feed://', 'https://', 1))
+        except (ValueError, RequestException) as error:
+            print(f'Could not fetch the feed: {error}')
+            return []
+        return parse_feed(content)
 
-    def refresh(self):
+    def refresh(self, budget=None):
         """
-        Iterates through new_urls, downloading then searching through resulting text.
+        Queues new_entries, then claims queued issues a batch at a time and
+        runs them through the refresh pipeline, downloading each issue,
+        searching through the resulting text and sending alerts.  Several
+        processes can refresh at once, each only handling the issues it
+        claimed; claims still held at the end, e.g. for issues which couldn't
+        be downloaded, are released for the next run.
+        Each issue's progress is saved as it goes: once stored, once matched
+        and as each alert is sent.  Issues left unfinished, by a crash or by
+        running out of time, are claimed before new ones & carried on with
+        from where they stopped, so nothing is skipped or done twice.
         Note: text and search terms are upper case, to simplify things.
+        Run statistics are written to Config.metrics_file afterwards, whether
+        or not the refresh succeeded.
+        :param budget: float, seconds after which the refresh stops, defaults
+        to Config.refresh_budget, None meaning no limit
         """
-        new_urls = self.new_urls()
-        for url in new_urls:
-            print(f'Adding {url}')
-            html, text = self._downloader(url)
-            self.add_url_html(url, html)
-            for user in self.users():
-                hits = self._text_search(text.upper(), user, url)
-                if hits:
-                    print(f'Sending alert to {user.name}')
-                    user.send_email(hits, url)
+        budget = Config.refresh_budget if budget is None else budget
+        deadline = None if budget is None else time.monotonic() + budget
+        loop = asyncio.new_event_loop()
+        metrics.REFRESHES.inc()
+        try:
+            with metrics.REFRESH_SECONDS.time():
+                self.queue_issues([(entry.link, entry.published)
+                                   for entry in self.new_entries()])
+                while self._refresh_batch(loop, deadline):
+                    pass
+        except BaseException:
+            metrics.REFRESH_FAILURES.inc()
+            raise
+        finally:
+            loop.close()
+            self.release_issues(self.worker)
+            metrics.LAST_REFRESH.set(time.time())
+            if Config.metrics_file:
+                metrics.REGISTRY.write(Config.metrics_file)
+
+    def _refresh_batch(self, loop, deadline):
+        """
+        Claims unfinished issues, then queued ones, up to
+        Config.claim_batch_size, and runs them through the pipeline, which is
+        cancelled at deadline
+        :param loop: asyncio event loop
+        :param deadline: float, time.monotonic() at which to stop, or None
+        :return: bool, False once there is nothing left to claim, or no time
+        """
+        if deadline is not None and time.monotonic() >= deadline:
+            print('Out of time, the next run will carry on from here')
+            return False
+        resumed = self.claim_unfinished(self.worker, Config.claim_batch_size,
+                                        Config.claim_lease)
+        claimed = self.claim_issues(self.worker, Config.claim_batch_size - len(resumed),
+                                    Config.claim_lease)
+        if not resumed and not claimed:
+            return False
+        pipeline = loop.create_task(self._pipeline(
+            [Entry(url, url, issue_date) for url, issue_date in claimed],
+            [(Entry(url, url, issue_date), status, text)
+             for url, issue_date, status, text in resumed]))
+        timer = None
+        if deadline is not None:
+            timer = loop.call_later(deadline - time.monotonic(), pipeline.cancel)
+        try:
+            loop.run_until_complete(pipeline)
+        except asyncio.CancelledError:
+            print('Out of time, the next run will carry on from here')
+            return False
+        finally:
+            if timer:
+                timer.cancel()
+        return True
+
+    async def _pipeline(self, entries, resumed=()):
+        """
+        Fetch, parse, match & notify run as separate stages joined by bounded
+        queues, so that one issue can be parsed while the next is downloading
+        and the previous one is being mailed.  Each stage has a single worker,
+        so issues & alerts are handled in the same order as the feed; a full
+        queue blocks the stage feeding it, which keeps memory flat when a
+        later stage is slow.
+        :param entries: list of Entry, court roll issues
+        :param resumed: list of 3-tuples, Entry, status & search text of
+        issues which were stored or matched by an earlier run, which start at
+        the match stage
+        :return: None
+        """
+        size = Config.pipeline_queue_size
+        fetched = asyncio.Queue(maxsize=size)
+        parsed = asyncio.Queue(maxsize=size)
+        alerts = asyncio.Queue(maxsize=size)
+        stages = [asyncio.ensure_future(stage) for stage in
+                  (self._fetch_stage(entries, fetched),
+                   self._parse_stage(fetched, parsed),
+                   self._match_stage(resumed, parsed, alerts),
+                   self._notify_stage(alerts))]
+        try:
+            await asyncio.gather(*stages)
+        except BaseException:
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            raise
+
+    @staticmethod
+    async def _fetch_stage(entries, out_queue):
+        """
+        Downloads issues through a FetchController, which decides how many
+        may be in flight at once.  A window of up to
+        Config.fetch_max_concurrency downloads is kept going, and pages are
+        handed on in feed order as they complete.  Downloads taking longer
+        than Config.fetch_timeout seconds, once started, are skipped.
+        :param entries: list of Entry
+        :param out_queue: asyncio.Queue receiving (entry, content) tuples
+        :return: None
+        """
+        loop = asyncio.get_event_loop()
+        controller = FetchController()
+        pending = deque()
+
+        async def hand_on():
+            entry, download = pending.popleft()
+            try:
+                content = await download
+            except asyncio.TimeoutError:
+                print(f'Skipping {entry.link}: download took over '
+                      f'{Config.fetch_timeout} seconds')
+                metrics.SKIPPED.inc()
+                return
+            except (ValueError, RequestException) as error:
+                print(f'Skipping {entry.link}: {error}')
+                metrics.SKIPPED.inc()
+                return
+            await out_queue.put((entry, content))
+
+        try:
+            for entry in entries:
+                print(f'Adding {entry.link}')
+                if Config.cache_replay:
+                    download = asyncio.wait_for(
+                        loop.run_in_executor(None, Feed._fetch, entry.link),
+                        Config.fetch_timeout)
+                else:
+                    download = controller.fetch(Feed._fetch, entry.link,
+                                                timeout=Config.fetch_timeout)
+                pending.append((entry, asyncio.ensure_future(download)))
+                if len(pending) >= Config.fetch_max_concurrency:
+                    await hand_on()
+            while pending:
+                await hand_on()
+        finally:
+            for _, download in pending:
+                download.cancel()
+            await asyncio.gather(*[download for _, download in pending],
+                                 return_exceptions=True)
+        await out_queue.put(_DONE)
+
+    @staticmethod
+    async def _parse_stage(in_queue, out_queue):
+        """
+        Pages taking longer than Config.parse_timeout seconds to parse, or
+        without a .courtRollContent section, are skipped.  Their claims are
+        released at the end of the refresh, like those of failed downloads.
+        :param in_queue: asyncio.Queue of (entry, content) tuples
+        :param out_queue: asyncio.Queue receiving (entry, html, text, headings)
+        tuples
+        :return: None
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await in_queue.get()
+            if item is _DONE:
+                break
+            entry, content = item
+            try:
+                with metrics.PARSE_SECONDS.time():
+                    html, text, headings = await asyncio.wait_for(
+                        loop.run_in_executor(None, Feed._parse_sections, content),
+                        Config.parse_timeout)
+            except asyncio.TimeoutError:
+                print(f'Skipping {entry.link}: parsing took over '
+                      f'{Config.parse_timeout} seconds')
+                metrics.SKIPPED.inc()
+                continue
+            except IndexError:
+                print(f'Skipping {entry.link}: no court roll found')
+                metrics.SKIPPED.inc()
+                continue
+            await out_queue.put((entry, html, text, headings))
+        await out_queue.put(_DONE)
+
+    async def _match_stage(self, resumed, in_queue, out_queue):
+        """
+        Stores each issue, records which users it concerns and queues their
+        alerts, followed by a (None, None, url, None) marker once all of an
+        issue's alerts are queued.  Users with the same hits, in whatever
+        order they added the terms, are queued together, up to
+        Config.alert_batch_size at a time, with the hits sorted, so that their
+        alert is only rendered once.  Each batch carries the hit_contexts of
+        its terms.  Issues resumed from an earlier run go first: stored ones are
+        matched, though their headings aren't known, and matched ones only
+        have their unsent alerts queued, without contexts.  Issues whose claim
+        was lost to another worker are dropped, as that worker will handle
+        them.  Database calls run on the event loop's thread, as the sqlite
+        connection may not be shared.
+        :param resumed: list of (entry, status, text) tuples
+        :param in_queue: asyncio.Queue of (entry, html, text, headings) tuples
+        :param out_queue: asyncio.Queue receiving (users, hits, url, contexts)
+        tuples
+        :return: None
+        """
+        matcher = self.matcher()
+        users = {user.email_address: user for user in matcher.users}
+
+        async def queue_alerts(url, contexts):
+            groups = {}
+            for email_address, hits in self.get_unsent_alerts(url):
+                if email_address in users:
+                    groups.setdefault(tuple(sorted(hits)), []).append(users[email_address])
+            size = Config.alert_batch_size
+            for hits, recipients in groups.items():
+                quotes = {term: contexts[term] for term in hits if term in contexts}
+                for first in range(0, len(recipients), size):
+                    await out_queue.put((recipients[first:first + size], list(hits),
+                                         url, quotes))
+            await out_queue.put((None, None, url, None))
+
+        for entry, status, text in resumed:
+            print(f'Resuming {entry.link}')
+            if status == 'matched':
+                contexts = {}
+            else:
+                contexts = await self._record_matches(entry.link, text, matcher)
+            if contexts is not None:
+                await queue_alerts(entry.link, contexts)
+        while True:
+            item = await in_queue.get()
+            if item is _DONE:
+                break
+            entry, html, text, headings = item
+            completed = self.complete_issue(entry.link, self.worker, html, text) and \
+                self.renew_claim(entry.link, self.worker, Config.claim_lease)
+            if not completed:
+                print(f'Skipping {entry.link}: claimed by another worker')
+                continue
+            metrics.ISSUES.inc()
+            contexts = await self._record_matches(entry.link, text, matcher, headings)
+            if contexts is not None:
+                await queue_alerts(entry.link, contexts)
+        await out_queue.put(_DONE)
+
+    async def _record_matches(self, url, text, matcher, headings=None):
+        """
+        Searches a stored issue in the executor, giving up after
+        Config.match_timeout seconds, then records its hits
+        :param url: str
+        :param text: str, search text
+        :param matcher: Matcher obj
+        :param headings: list of (offset, heading) tuples, or None if unknown
+        :return: dict, hit_contexts of the terms found, or None if the issue
+        was left for another run or worker
+        """
+        loop = asyncio.get_event_loop()
+        upper = text.upper()
+        try:
+            user_hits, offsets = await asyncio.wait_for(
+                loop.run_in_executor(None, self._locate, upper, matcher),
+                Config.match_timeout)
+        except asyncio.TimeoutError:
+            print(f'Skipping {url}: searching took over {Config.match_timeout} seconds')
+            return None
+        if not self.record_matches(url, self.worker, [(user.email_address, hits)
+                                                      for user, hits in user_hits]):
+            print(f'Skipping {url}: claimed by another worker')
+            return None
+        # Quoted as published, unless upper-casing moved the offsets
+        return hit_contexts(text if len(text) == len(upper) else upper, offsets, headings)
+
+    async def _notify_stage(self, in_queue):
+        """
+        Sends each batch of alerts as an AlertBatch, recording each alert as
+        sent, and finishes each issue once its alerts are all sent.  The
+        issue's claim is renewed before each batch; if it has been lost, e.g.
+        because the lease ran out and another worker claimed the issue, the
+        batch is dropped, as are the issue's later batches, leaving its alerts
+        to whichever worker claims it next.  With Config.cache_replay, alerts
+        are recorded as sent without being mailed.  A batch taking longer than
+        Config.notify_timeout seconds per alert fails the refresh, like any
+        other error sending mail, leaving the alerts not yet sent to the next
+        run.  On a timeout, or running out of time, the
+        batch is told to stop after the email it is sending, which is waited
+        for, so that every alert sent is recorded and never sent again.
+        :param in_queue: asyncio.Queue of (users, hits, url, contexts) tuples
+        :return: None
+        """
+        loop = asyncio.get_event_loop()
+        lost = set()
+        while True:
+            item = await in_queue.get()
+            if item is _DONE:
+                break
+            users, hits, url, contexts = item
+            if users is None:
+                if url not in lost:
+                    self.finish_issue(url, self.worker)
+                continue
+            if url in lost or not self.renew_claim(url, self.worker, Config.claim_lease):
+                print(f'Skipping alerts about {url}: claimed by another worker')
+                lost.add(url)
+                continue
+            if Config.cache_replay:
+                for user in users:
+                    print(f'Replaying, not sending alert to {user.name}')
+                    self.mark_sent(user.email_address, url, self.worker)
+                continue
+            for user in users:
+                print(f'Sending alert to {user.name}')
+            sent, stop = [], threading.Event()
+            send = loop.run_in_executor(None, AlertBatch(users, hits, url, contexts).send,
+                                        sent, stop)
+            try:
+                with metrics.EMAIL_SECONDS.time():
+                    await asyncio.wait_for(asyncio.shield(send),
+                                           Config.notify_timeout * len(users))
+            except asyncio.CancelledError:
+                stop.set()
+                await asyncio.gather(send, return_exceptions=True)
+                raise
+            except asyncio.TimeoutError:
+                stop.set()
+                await asyncio.gather(send, return_exceptions=True)
+                metrics.EMAIL_FAILURES.inc(len(users) - len(sent))
+                raise
+            except Exception:
+                metrics.EMAIL_FAILURES.inc(len(users) - len(sent))
+                raise
+            finally:
+                sent = list(sent)
+                for user in sent:
+                    self.mark_sent(user.email_address, url, self.worker)
+                metrics.EMAILS.inc(len(sent))
+
+    def reprocess(self, since=None, until=None, url=None, dry_run=False,
+                  workers=None):
+        """
+        Matches issues already in the database against the current search
+        terms, recording any new user issues.  No emails are sent.  Issues are
+        streamed from the database and matched by a pool of worker processes,
+        with only a few issues in flight per worker; user issues already
+        recorded are left alone, so it is safe to run repeatedly.
+        :param since: str, ISO date, only issues dated on or after this
+        :param until: str, ISO date, only issues dated on or before this
+        :param url: str, only issues whose url contains this
+        :param dry_run: bool, if set, reports what would be recorded without
+        writing anything
+        :param workers: int, number of worker processes, defaults to
+        Config.reprocess_workers.  1 matches in this process.
+        :return: dict, with the number of issues scanned, the number of
+        user issues found & the new user issues, as (email, url) tuples
+        """
+        report = {'issues': 0, 'hits': 0, 'new': []}
+        issues = self.iter_issues(since=since, until=until, url=url)
+        for issue_url, user_hits in self._map_issues(issues, workers):
+            report['issues'] += 1
+            report['hits'] += len(user_hits)
+            hits = dict(user_hits)
+            pairs = self.new_user_issues([(email_address, issue_url)
+                                          for email_address in hits])
+            if pairs and not dry_run:
+                self.add_user_issues([(email_address, issue_url, hits[email_address])
+                                      for email_address, _ in pairs])
+            report['new'].extend(pairs)
+        return report
+
+    def backfill_text(self, batch_size=None):
+        """
+        Stores search text for issues saved with only their html, a batch at
+        a time, committing after each batch
+        :param batch_size: int, defaults to Config.backfill_batch_size
+        :return: int, number of issues backfilled
+        """
+        batch_size = batch_size or Config.backfill_batch_size
+        done, last_id = 0, 0
+        rows = self.get_issues_without_text(last_id, batch_size)
+        while rows:
+            texts = []
+            for issue_id, html in rows:
+                try:
+                    _, text = self._parse(html)
+                except IndexError:
+                    text = ''
+                texts.append((issue_id, text))
+            self.set_issue_texts(texts)
+            done += len(texts)
+            last_id = rows[-1][0]
+            rows = self.get_issues_without_text(last_id, batch_size)
+        return done
+
+    def maintain(self, months=None, directory=None, batch_size=100, full=False):
+        """
+        Applies the retention policy: moves the html & search text of issues
+        dated before retention_cutoff(months) into monthly archives, a batch
+        at a time, then compacts the database.  Undated issues go into an
+        'undated' archive.  Urls & user issues are kept.  Each batch is
+        committed separately, so a refresh running at the same time only ever
+        waits for one batch.
+        :param months: int, defaults to Config.retention_months.  If that is
+        None, nothing is archived but the database is still compacted
+        :param directory: str, defaults to Config.archive_dir
+        :param batch_size: int
+        :param full: bool, see Database.compact
+        :return: dict with cutoff, the ISO date before which issues were
+        archived, or None; archived, the number of issues archived; files,
+        the sorted archive paths written to & pages, the number freed, or
+        None if the database needs a full compaction first
+        """
+        months = Config.retention_months if months is None else months
+        directory = directory or Config.archive_dir
+        report = {'cutoff': None, 'archived': 0, 'files': set(), 'pages': 0}
+        if months is not None:
+            report['cutoff'] = retention_cutoff(months)
+            rows = self.get_issues_before(report['cutoff'], 0, batch_size)
+            while rows:
+                by_month = {}
+                for _, url, issue_date, html, text in rows:
+                    by_month.setdefault(issue_date[:7] if issue_date else 'undated', []).append(
+                        {'url': url, 'date': issue_date, 'html': html, 'text': text})
+                for month, issues in sorted(by_month.items()):
+                    report['files'].add(append_issues(directory, month, issues))
+                self.clear_issue_bodies([row[0] for row in rows])
+                report['archived'] += len(rows)
+                rows = self.get_issues_before(report['cutoff'], rows[-1][0], batch_size)
+        report['files'] = sorted(report['files'])
+        report['pages'] = self.compact(Config.vacuum_pages, full)
+        return report
+
+    def _map_issues(self, issues, workers=None):
+        """
+        :param issues: iterable of (url, html, text) tuples
+        :param workers: int, number of worker processes
+        :yield: results of _match_issue, in the same order as issues
+        """
+        matcher = self.matcher()
+        workers = workers or Config.reprocess_workers or os.cpu_count()
+        if workers <= 1:
+            _init_worker(matcher)
+            yield from map(_match_issue, issues)
+            return
+        with Pool(workers, initializer=_init_worker, initargs=(matcher,)) as pool:
+            pending = deque()
+            for issue in issues:
+                pending.append(pool.apply_async(_match_issue, (issue,)))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+    def matcher(self):
+        """
+        Building a Matcher for many terms is slow, so the last one is kept,
+        both here and, unless Config.matcher_cache is None, in that file, for
+        the next run.  Either is used for as long as the backend's term set
+        version & the fuzzy matching settings stay the same.
+        :return: Matcher obj, built from every user's search terms
+        """
+        key = (self.get_term_set_version(), Config.fuzzy_matching,
+               Config.fuzzy_max_distance)
+        if self._matcher is not None and self._matcher[0] == key:
+            return self._matcher[1]
+        matcher = None
+        if Config.matcher_cache:
+            matcher = load_matcher(Config.matcher_cache, key)
+        if matcher is None:
+            matcher = Matcher(self.users(), fuzzy=Config.fuzzy_matching,
+                              distances=self.get_term_distances(),
+                              default_distance=Config.fuzzy_max_distance)
+            if Config.matcher_cache:
+                save_matcher(Config.matcher_cache, key, matcher)
+        self._matcher = (key, matcher)
+        return matcher
 
     def users(self):
         """
         :yield: User obj containing name, email address and list of
         search_terms
         """
-        users = self.get_users()
-        for user in users:
-            name, email_address = user
-            search_terms = self.get_search_terms(email_address)
-            yield User(name, email_address, search_terms)
+        user = None
+        for name, email_address, term in self.get_subscriptions():
+            if user is None or user.email_address != email_address:
+                if user is not None:
+                    yield user
+                user = User(name, email_address, [])
+            if term is not None:
+                user.search_terms.append(term)
+        if user is not None:
+            yield user
 
-    def _text_search(self, text, user, url):
+    @staticmethod
+    def _locate(text, matcher):
         """
-        Searches through text for any of the user's search terms, if found,
-        sends email.
-        :param text: str, block of text from Court Roll Issue
-        :param user: User obj
-        :param url: str Court Roll Issue URL
-        :return: search term hits
+        :param text: str, upper-cased search text
+        :param matcher: Matcher obj
+        :return: 2-tuple, as returned by Matcher.locate
         """
-        search_term_hits = []
-        for term in user.search_terms:
-            if term in text:
-                search_term_hits.append(term)
-                self.add_user_issue(user.email_address, url)
-        return search_term_hits
+        with metrics.MATCH_SECONDS.time():
+            user_hits, offsets = matcher.locate(text)
+        metrics.HITS.inc(len(user_hits))
+        return user_hits, offsets
 
     @staticmethod
     def _downloader(url):
         """
-        Uses BeautifulSoup to extract a block of text through which to search
+        Uses BeautifulSoup to extract a block of text through which to search.
+        Raises ValueError if the page is larger than Config.max_page_bytes
         :param url: str
         :return: tuple, html and plain text of Court Roll issue downloaded
         """
-        soup = BeautifulSoup(get(url).content, 'html.parser')
+        return Feed._parse(Feed._fetch(url))
+
+    @staticmethod
+    def _fetch(url):
+        """
+        Streams the page at url in chunks, giving up once more than
+        Config.max_page_bytes have been received, so that an oversized page
+        is never held in memory in full.  If Config.cache_dir is set, pages
+        are kept in a ResponseCache and only downloaded again if the server
+        says they have changed; with Config.cache_replay, they are only ever
+        read from the cache, raising ValueError for pages which aren't in it.
+        :param url: str
+        :return: bytes, raw page content
+        """
+        cache = cached = None
+        headers = {}
+        if Config.cache_dir:
+            key = (Config.cache_dir, Config.cache_max_bytes)
+            cache = _response_caches.get(key)
+            if cache is None:
+                cache = _response_caches.setdefault(key, ResponseCache(*key))
+            cached = cache.get(url)
+            if Config.cache_replay:
+                if cached is None:
+                    raise ValueError(f'{url} is not cached')
+                return cached
+            if cached is not None:
+                headers = cache.validators(url)
+        limit = Config.max_page_bytes
+        timeout = (Config.connect_timeout, Config.read_timeout)
+        with get(url, stream=True, timeout=timeout, headers=headers) as response:
+            if response.status_code == 304 and cached is not None:
+                return cached
+            response.raise_for_status()
+            length = response.headers.get('Content-Length')
+            if length and int(length) > limit:
+                raise ValueError(f'Page is {length} bytes, limit is {limit}')
+            chunks, size = [], 0
+            for chunk in response.iter_content(chunk_size=Config.chunk_size):
+                size += len(chunk)
+                if size > limit:
+                    raise ValueError(f'Page exceeds {limit} bytes')
+                chunks.append(chunk)
+            content = b''.join(chunks)
+            del chunks
+            if cache:
+                cache.put(url, content, response.headers)
+        return content
+
+    @staticmethod
+    def _parse(content):
+        """
+        Extracts the court roll section from a downloaded page
+        :param content: bytes, raw page content, or a stored issue's html
+        :return: tuple, html and search text of Court Roll issue
+        """
+        return Feed._parse_sections(content)[:2]
+
+    @staticmethod
+    def _parse_sections(content):
+        """
+        _parse, also finding where each of the roll's headings, picked out by
+        Config.heading_selector, starts in the search text.  The soup tree is
+        torn down before returning, leaving only the strings alive.
+        :param content: bytes, raw page content, or a stored issue's html
+        :return: tuple, html, search text & list of (offset, heading) tuples,
+        in the order the headings appear
+        """
+        soup = BeautifulSoup(content, 'html.parser')
         selection = soup.select('.courtRollContent')[0]
-        html, text = selection.prettify(), selection.get_text()
-        return html, text
+        html = selection.prettify()
+        text = normalize(selection.get_text())
+        headings, position = [], 0
+        for element in selection.select(Config.heading_selector):
+            heading = normalize(element.get_text())
+            offset = text.find(heading, position) if heading else -1
+            if offset >= 0:
+                headings.append((offset, heading))
+                position = offset + len(heading)
+        soup.decompose()
+        return html, text, headings
 
 
 class User:
@@ -111,55 +884,97 @@ class User:
     def __str__(self):
         return f'<User: {self.name}>'
 
-    def send_email(self, search_term_hits, url):
+    def send_email(self, search_term_hits, url, contexts=None):
         """
         Sends email message to a user.email_address containing the url &
         search term hits
         :param search_term_hits: list of search terms that were present in
         the issue searched
         :param url: str, url to a court roll issue
+        :param contexts: dict of term to list of (heading, snippet) tuples,
+        quoting where each term was found, see hit_contexts
         :return: None
         """
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = 'Court Roll Notification'
-        msg['From'] = Config.sender
-        msg['To'] = self.email_address
-        msg.attach(MIMEText(self._render_text(search_term_hits, url), 'plain'))
-        msg.attach(MIMEText(self._render_html(search_term_hits, url), 'html'))
-        server = smtplib.SMTP(host=Config.host, port=Config.port)
-        server.starttls()
-        server.login(user=Config.sender, password=Config.pw)
-        server.sendmail(Config.sender, self.email_address, msg.as_string())
-        server.quit()
+        AlertBatch([self], search_term_hits, url, contexts).send([])
 
-    def _render_text(self, search_term_hits, url):
+    def _render_text(self, search_term_hits, url, contexts=None):
         """
         Renders Text message for email
         :param search_term_hits: list of search_terms
         :param url: str
+        :param contexts: dict of term to list of (heading, snippet) tuples
         :return: text-formatted email message
         """
-        env = Environment(
-            loader=PackageLoader('message', 'templates'),
-            autoescape=select_autoescape(['.txt'])
-        )
-        template = env.get_template('base.txt')
-        return template.render(name=self.name,
-                               search_terms=search_term_hits,
-                               url=url)
+        return render('base.txt', self.name.title(), search_term_hits, url, contexts)
 
-    def _render_html(self, search_term_hits, url):
+    def _render_html(self, search_term_hits, url, contexts=None):
         """
         Renders HTML message for email
         :param search_term_hits: list of search_terms
         :param url: str
+        :param contexts: dict of term to list of (heading, snippet) tuples
         :return: HTML-formatted email message
         """
-        env = Environment(
-            loader=PackageLoader('message', 'templates'),
-            autoescape=select_autoescape(['html', 'xml'])
-        )
-        template = env.get_template('base.html')
-        return template.render(name=self.name,
-                               search_terms=search_term_hits,
-                               url=url)
+        return render('base.html', self.name.title(), search_term_hits, url, contexts)
+
+
+class AlertBatch:
+    """
+    An issue's alert to users who all had the same search terms found in it.
+    Their emails only differ in the greeting, so each template is rendered
+    once, with a placeholder where the name goes, which is then swapped for
+    each user's name; the emails are all sent over one connection to the
+    mail server.
+    """
+    NAME = '\x00name\x00'  # Placeholder, which no template or name contains
+
+    def __init__(self, users, search_term_hits, url, contexts=None):
+        """
+        :param users: list of User obj
+        :param search_term_hits: list of search terms present in the issue
+        :param url: str, url to a court roll issue
+        :param contexts: dict of term to list of (heading, snippet) tuples
+        """
+        self.users = users
+        self.hits = search_term_hits
+        self.url = url
+        self.contexts = contexts or {}
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.users}, {self.hits}, {self.url!r})'
+
+    def messages(self):
+        """
+        :yield: 2-tuples, User obj & the email message to them
+        """
+        text = render('base.txt', self.NAME, self.hits, self.url, self.contexts)
+        html = render('base.html', self.NAME, self.hits, self.url, self.contexts)
+        for user in self.users:
+            name = user.name.title()
+            msg = MIMEMultipart('alternative')
+            msg['Subject'] = 'Court Roll Notification'
+            msg['From'] = Config.sender
+            msg['To'] = user.email_address
+            msg.attach(MIMEText(text.replace(self.NAME, name), 'plain'))
+            msg.attach(MIMEText(html.replace(self.NAME, markup.escape(name)), 'html'))
+            yield user, msg
+
+    def send(self, sent, stop=None):
+        """
+        Sends every user their email, each step on the connection giving up
+        after Config.notify_timeout seconds
+        :param sent: list, each User obj is appended to it as soon as their
+        email is sent, so that if sending fails part way, the caller can
+        tell who already has theirs
+        :param stop: threading.Event, once set, no more emails are started
+        :return: None
+        """
+        with smtplib.SMTP(host=Config.host, port=Config.port,
+                          timeout=Config.notify_timeout) as server:
+            server.starttls()
+            server.login(user=Config.sender, password=Config.pw)
+            for user, msg in self.messages():
+                if stop is not None and stop.is_set():
+                    break
+                server.sendmail(Config.sender, user.email_address, msg.as_string())
+                sent.append(user)
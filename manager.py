@@ -1,289 +1,408 @@
 """
 This module contains an interactive menu script, instead of the standard cli
 program that uses flags to do things, intended to be more user friendly.
+
+Each screen is a function taking the Session and returning the next screen to
+show, or None to exit, and run shows them one after the other in a loop, so
+that however long the program is used, moving between menus never builds up
+the stack.  The Session holds the only database connection.
 """
 
 import os
 import sqlite3
-import sys
 
 from configuration import Config
 from feed import Feed
 
 
-def top_menu():
+class Session:
     """
-    Creates top level menu
-    :return: None
+    Holds the database connection used by every screen, along with the users
+    & search terms already read from it.  Each write forgets the lists it
+    changes, so they are only read again once they're next shown.
     """
-    valid = draw_menu('Main Menu',
-                      'Run program',
-                      'User management',
-                      'Search phrase management',
-                      'Exit',
-                      num_option=True)
-    choice = input()
-    while choice not in valid:
-        draw_menu('Main Menu',
-                  'Run program',
-                  'User management',
-                  'Search phrase management',
-                  'Exit',
-                  num_option=True)
-        choice = input()
-    if choice == '1':
-        run_parser()
-    elif choice == '2':
-        user_management()
-    elif choice == '3':
-        search_phrase_management()
-    elif choice == '4':
-        exit_program()
 
-
-def user_management():
-    """
-    Creates the user management menu
-    :return: None
-    """
-    def list_users():
+    def __init__(self, database):
         """
-        Prints out list of current users
-        :return: None
+        :param database: str database file
         """
-        users = Feed(Config.database).get_users()
-        if users:
-            clear_screen()
-            for user in users:
-                name, email_address = user
-                print(f'{name} - {email_address}')
-            input('Press enter to continue')
-            user_management()
-        else:
-            input('No users found, press enter to continue')
-            top_menu()
+        self.feed = Feed(database)
+        self.email_address = None  # User picked in search phrase management
+        self._users = None
+        self._terms = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
-    def add_user():
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.feed.storage!r})'
+
+    @property
+    def users(self):
         """
-        Adds user to database
-        :return: None
+        :return: List of 2 tuples made up of each name & email address
         """
-        clear_screen()
-        name = input('Enter full name: ')
-        email_address = input('Enter email address: ').lower()
-        if name == '' or email_address == '':
-            input('Blank name or email addresses aren\'t allowed.  Press enter to continue')
-            user_management()
-        try:
-            Feed(Config.database).add_user(name.strip(), email_address.strip())
-        except sqlite3.IntegrityError:
-            print(f'{email_address} already in database!')
-            input('Press enter to continue')
-        user_management()
-
-    def add_users_from_file():
+        if self._users is None:
+            self._users = self.feed.get_users()
+        return self._users
+
+    def terms(self, email_address):
         """
-        Adds line-separated file of csv names and email addresses to database
-        :return: None
+        :param email_address: str
+        :return: list of search terms associated with email_address
         """
-        clear_screen()
-        print('Create a text file, where each line consists of a users\'s '
-              'full name and the user\'s email address, separated by a comma')
-        print('Save this file into the same directory as the program file')
-        filename = input('Type the full name of the file: ')
-        if filename in os.listdir(os.path.dirname(os.path.abspath(__file__))):
-            with open(filename) as file:
-                for line in file:
-                    if line.strip():
-                        name, email_address = line.split(',')
-                        name, email_address = name.strip(), email_address.strip()
-                        try:
-                            Feed(Config.database).add_user(name, email_address)
-                            print(f'Adding {name} - {email_address}')
-                        except sqlite3.IntegrityError:
-                            print(f'{email_address} already in database!')
-            input('Press enter to continue')
-            user_management()
-        else:
-            input('File not found!  Press enter to continue')
-            user_management()
+        if email_address not in self._terms:
+            self._terms[email_address] = self.feed.get_search_terms(email_address)
+        return self._terms[email_address]
 
-    def remove_user():
+    def add_user(self, name, email_address):
         """
-        Prints users from a dictionary, in order to prevent user error when
-        inputting email addresses
+        Re-raises if email_address already in database
+        :param name: str
+        :param email_address: str
         :return: None
         """
-        clear_screen()
-        users = Feed(Config.database).get_users()
-        if users:
-            clear_screen()
-            user_dict = {i[0] + 1: i[1] for i in enumerate(users)}
-            for num, user in user_dict.items():
-                print(f'{num}) {user[0]} - {user[1]}')
-            print('Press enter with blank input to cancel')
-            try:
-                choice_ = int(input('User number to delete: '))
-            except ValueError:
-                input('Canceled, press enter to continue')
-                user_management()
-            else:
-                Feed(Config.database).remove_user(user_dict[choice_][1])
-                user_management()
-        else:
-            input('No users found, press enter to continue')
-            user_management()
-
-    valid = draw_menu('User Management',
-                      'List users',
-                      'Add user',
-                      'Add users from file',
-                      'Remove user',
-                      'Return to main menu',
-                      num_option=True)
-    choice = input()
-    while choice not in valid:
-        draw_menu('User Management',
-                  'List users',
-                  'Add user',
-                  'Add users from file',
-                  'Remove user',
-                  'Return to main menu',
-                  num_option=True)
-        choice = input()
-    if choice == '1':
-        list_users()
-    elif choice == '2':
-        add_user()
-    elif choice == '3':
-        add_users_from_file()
-    elif choice == '4':
-        remove_user()
-    elif choice == '5':
-        top_menu()
-
-
-def search_phrase_management():
-    """
-    Creates search phrase management menu
-    :return: None
-    """
+        self.feed.add_user(name, email_address)
+        self._users = None
 
-    def add_phrase(email_address):
+    def remove_user(self, email_address):
         """
-        Adds a single phrase to user associated with email_address
         :param email_address: str
         :return: None
         """
-        clear_screen()
-        phrase = input(f'Type search phrase to add: ')
-        Feed(Config.database).add_search_term(email_address, phrase.upper())
-        search_phrase_management()
+        self.feed.remove_user(email_address)
+        self._users = None
+        self._terms.pop(email_address, None)
 
-    def add_phrases_from_file(email_address):
+    def add_search_term(self, email_address, term):
         """
-        Adds phrases from text file
+        Raises ValueError if term is an invalid expression
         :param email_address: str
+        :param term: str
         :return: None
         """
-        clear_screen()
-        print('Create a text file where each line is a separate search phrase')
-        print('Save this file into the same directory as the program file')
-        filename = input('Type the full name of the file: ').strip()
-        if filename in os.listdir(os.path.dirname(os.path.abspath(__file__))):
-            with open(filename) as file:
-                for line in file:
-                    Feed(Config.database).add_search_term(email_address, line.strip().upper())
-            print(filename)
-            input('pause')
-            search_phrase_management()
-        else:
-            input('File not found!  Press enter to continue')
-            search_phrase_management()
+        self.feed.add_search_term(email_address, term)
+        self._terms.pop(email_address, None)
 
-    def remove_phrase(email_address):
+    def remove_search_term(self, email_address, term):
         """
-        Removes phrase from user, constructs a dictionary and prints from that
-        to ensure that the phrase is exact (Eliminates user input error)
         :param email_address: str
+        :param term: str
         :return: None
         """
-        clear_screen()
-        terms = Feed(Config.database).get_search_terms(email_address)
-        if not terms:
-            input('No terms found!')
-            search_phrase_management()
-        else:
-            phrase_dict = {i[0] + 1: i[1] for i in enumerate(terms)}
-            for num, item in phrase_dict.items():
-                print(f'{num}) {item}')
-            print('Press enter with blank input to cancel')
-            choice_ = int(input('Phrase number to delete: '))
-            try:
-                ans = phrase_dict[choice_]
-                Feed(Config.database).remove_search_term(email_address, term=ans)
-                search_phrase_management()
-            except ValueError:
-                input('Canceling')
-                search_phrase_management()
-
-    def search_phrase_menu(users):
+        self.feed.remove_search_term(email_address, term=term)
+        self._terms.pop(email_address, None)
+
+    def close(self):
         """
-        :param users: list of 2-tuple, users names and email addresses.
-        Draws the search_phrase_management menu
         :return: None
         """
-        clear_screen()
-        user_dict = {i[0] + 1: i[1] for i in enumerate(users)}
-        print('User selection')
-        for num, user in user_dict.items():
-            print(f'{num}) {user[0]} - {user[1]}')
-        try:
-            print('Press enter with blank input to return to main menu')
-            email_address = user_dict[int(input('User to manage: '))][1]
-            terms = Feed(Config.database).get_search_terms(email_address)
-            valid_ = draw_menu('Search Phrase Management',
-                               'Print current search terms',
-                               'Add search term',
-                               'Add search terms from file',
-                               'Remove term',
-                               'Return to main menu',
-                               num_option=True)
-            choice_ = input()
-            while choice_ not in valid_:
-                valid_ = draw_menu('Search Phrase Management',
-                                   'Print current search terms',
-                                   'Add search term',
-                                   'Add search terms from file',
-                                   'Remove term',
-                                   'Return to main menu',
-                                   num_option=True)
-                choice_ = input()
-            if choice_ == '1':
-                if terms:
-                    draw_menu(f'Search phrases for {email_address}',
-                              *terms,
-                              continue_=True)
-                else:
-                    input('No search phrases found.  Press enter to continue')
-                search_phrase_management()
-            elif choice_ == '2':
-                add_phrase(email_address)
-            elif choice_ == '3':
-                add_phrases_from_file(email_address)
-            elif choice_ == '4':
-                remove_phrase(email_address)
-            elif choice_ == '5':
-                top_menu()
-        except ValueError:
-            top_menu()
-
-    users = Feed(Config.database).get_users()
-    if users:
-        search_phrase_menu(users)
+        self.feed.close()
+
+
+def run(session, screen=None):
+    """
+    Shows screens, starting with the main menu, until one returns None
+    :param session: Session obj
+    :param screen: function taking session & returning the next screen
+    :return: None
+    """
+    screen = screen or top_menu
+    while screen is not None:
+        screen = screen(session)
+
+
+def top_menu(session):
+    """
+    Creates top level menu
+    :param session: Session obj
+    :return: next screen
+    """
+    choice = choose_option('Main Menu',
+                           'Run program',
+                           'User management',
+                           'Search phrase management',
+                           'Exit')
+    return {'1': run_parser,
+            '2': user_management,
+            '3': search_phrase_management,
+            '4': exit_program}[choice]
+
+
+def user_management(session):
+    """
+    Creates the user management menu
+    :param session: Session obj
+    :return: next screen
+    """
+    choice = choose_option('User Management',
+                           'List users',
+                           'Add user',
+                           'Add users from file',
+                           'Remove user',
+                           'Return to main menu')
+    if choice == '1':
+        list_users(session)
+    elif choice == '2':
+        add_user(session)
+    elif choice == '3':
+        add_users_from_file(session)
+    elif choice == '4':
+        remove_user(session)
+    elif choice == '5':
+        return top_menu
+    return user_management
+
+
+def list_users(session):
+    """
+    Prints out list of current users, a page at a time
+    :param session: Session obj
+    :return: None
+    """
+    if session.users:
+        draw_pages('Users', [f'{name} - {email_address}'
+                             for name, email_address in session.users])
     else:
         input('No users found, press enter to continue')
-        top_menu()
+
+
+def add_user(session):
+    """
+    Adds user to database
+    :param session: Session obj
+    :return: None
+    """
+    clear_screen()
+    name = input('Enter full name: ').strip()
+    email_address = input('Enter email address: ').strip().lower()
+    if name == '' or email_address == '':
+        input('Blank name or email addresses aren\'t allowed.  Press enter to continue')
+        return
+    try:
+        session.add_user(name, email_address)
+    except sqlite3.IntegrityError:
+        print(f'{email_address} already in database!')
+        input('Press enter to continue')
+
+
+def add_users_from_file(session):
+    """
+    Adds line-separated file of csv names and email addresses to database
+    :param session: Session obj
+    :return: None
+    """
+    clear_screen()
+    print('Create a text file, where each line consists of a users\'s '
+          'full name and the user\'s email address, separated by a comma')
+    lines = read_file()
+    if lines is None:
+        return
+    for line in lines:
+        if line.strip():
+            name, email_address = line.split(',')
+            name, email_address = name.strip(), email_address.strip()
+            try:
+                session.add_user(name, email_address)
+                print(f'Adding {name} - {email_address}')
+            except sqlite3.IntegrityError:
+                print(f'{email_address} already in database!')
+    input('Press enter to continue')
+
+
+def remove_user(session):
+    """
+    Lists numbered users to choose from, in order to prevent user error when
+    inputting email addresses
+    :param session: Session obj
+    :return: None
+    """
+    users = session.users
+    if not users:
+        input('No users found, press enter to continue')
+        return
+    num = draw_pages('Users', [f'{name} - {email_address}' for name, email_address in users],
+                     prompt='User number to delete: ')
+    if num is not None:
+        session.remove_user(users[num][1])
+
+
+def search_phrase_management(session):
+    """
+    Picks the user whose search phrases are to be managed
+    :param session: Session obj
+    :return: next screen
+    """
+    users = session.users
+    if not users:
+        input('No users found, press enter to continue')
+        return top_menu
+    num = draw_pages('User selection',
+                     [f'{name} - {email_address}' for name, email_address in users],
+                     prompt='User to manage: ')
+    if num is None:
+        return top_menu
+    session.email_address = users[num][1]
+    return search_phrase_menu
+
+
+def search_phrase_menu(session):
+    """
+    Draws the search phrase menu for the user picked by
+    search_phrase_management
+    :param session: Session obj
+    :return: next screen
+    """
+    email_address = session.email_address
+    choice = choose_option(f'Search Phrase Management - {email_address}',
+                           'Print current search terms',
+                           'Add search term',
+                           'Add search terms from file',
+                           'Remove term',
+                           'Choose another user',
+                           'Return to main menu')
+    if choice == '1':
+        terms = session.terms(email_address)
+        if terms:
+            draw_pages(f'Search phrases for {email_address}', terms)
+        else:
+            input('No search phrases found.  Press enter to continue')
+    elif choice == '2':
+        add_phrase(session, email_address)
+    elif choice == '3':
+        add_phrases_from_file(session, email_address)
+    elif choice == '4':
+        remove_phrase(session, email_address)
+    elif choice == '5':
+        return search_phrase_management
+    elif choice == '6':
+        return top_menu
+    return search_phrase_menu
+
+
+def add_phrase(session, email_address):
+    """
+    Adds a single phrase to user associated with email_address
+    :param session: Session obj
+    :param email_address: str
+    :return: None
+    """
+    clear_screen()
+    phrase = input('Type search phrase to add: ')
+    try:
+        session.add_search_term(email_address, phrase.upper())
+    except ValueError as error:
+        input(f'Invalid search phrase: {error}.  Press enter to continue')
+
+
+def add_phrases_from_file(session, email_address):
+    """
+    Adds phrases from text file
+    :param session: Session obj
+    :param email_address: str
+    :return: None
+    """
+    clear_screen()
+    print('Create a text file where each line is a separate search phrase')
+    lines = read_file()
+    if lines is None:
+        return
+    for line in lines:
+        if line.strip():
+            try:
+                session.add_search_term(email_address, line.strip().upper())
+            except ValueError as error:
+                print(f'Invalid search phrase: {error}')
+    input('Press enter to continue')
+
+
+def remove_phrase(session, email_address):
+    """
+    Removes phrase from user, listing numbered phrases to choose from to
+    ensure that the phrase is exact (Eliminates user input error)
+    :param session: Session obj
+    :param email_address: str
+    :return: None
+    """
+    terms = session.terms(email_address)
+    if not terms:
+        input('No terms found!  Press enter to continue')
+        return
+    num = draw_pages(f'Search phrases for {email_address}', terms,
+                     prompt='Phrase number to delete: ')
+    if num is not None:
+        session.remove_search_term(email_address, terms[num])
+
+
+def read_file():
+    """
+    Asks for the name of a file saved in the program directory
+    :return: list of str, the file's lines, or None if it wasn't found
+    """
+    print('Save this file into the same directory as the program file')
+    filename = input('Type the full name of the file: ').strip()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    if filename not in os.listdir(directory):
+        input('File not found!  Press enter to continue')
+        return None
+    with open(os.path.join(directory, filename)) as file:
+        return file.readlines()
+
+
+def choose_option(menu_name, *args):
+    """
+    Draws a menu until one of its options is chosen
+    :param menu_name: str
+    :param args: strings, the options
+    :return: str, number of the option chosen
+    """
+    valid = draw_menu(menu_name, *args, num_option=True)
+    choice = input()
+    while choice not in valid:
+        draw_menu(menu_name, *args, num_option=True)
+        choice = input()
+    return choice
+
+
+def draw_pages(title, items, prompt=None):
+    """
+    Prints numbered items Config.menu_page_size at a time, typing n or p
+    moving to the next or previous page.  Items are numbered across pages, so
+    any of them can be chosen from any page.
+    :param title: str
+    :param items: list of str
+    :param prompt: str, if given, asks for the number of an item
+    :return: int, index of the item chosen, or None if none was, or if there
+    was no prompt
+    """
+    size = Config.menu_page_size
+    pages = max(1, -(-len(items) // size))
+    page = 0
+    while True:
+        clear_screen()
+        print(f'{title} (page {page + 1} of {pages})')
+        first = page * size
+        for num, item in enumerate(items[first:first + size], first + 1):
+            print(f'{num}) {item}')
+        options = []
+        if page + 1 < pages:
+            options.append('n for the next page')
+        if page > 0:
+            options.append('p for the previous page')
+        options.append('blank input to ' + ('cancel' if prompt else 'return'))
+        print(f'Type {", ".join(options)}')
+        answer = input(prompt or '').strip().lower()
+        if not answer:
+            return None
+        if answer == 'n' and page + 1 < pages:
+            page += 1
+        elif answer == 'p' and page > 0:
+            page -= 1
+        elif prompt and answer.isdigit() and 0 < int(answer) <= len(items):
+            return int(answer) - 1
 
 
 def draw_menu(menu_name, *args, num_option=None, continue_=None, clear=True):
@@ -310,15 +429,16 @@ def draw_menu(menu_name, *args, num_option=None, continue_=None, clear=True):
     return nums
 
 
-def run_parser():
+def run_parser(session):
     """
     Calls Feed.refresh then returns to main menu
-    :return: None
+    :param session: Session obj
+    :return: next screen
     """
     clear_screen()
     print('Running...')
-    Feed(Config.database).refresh()
-    top_menu()
+    session.feed.refresh()
+    return top_menu
 
 
 def clear_screen():
@@ -329,16 +449,17 @@ def clear_screen():
     os.system('cls' if os.name == 'nt' else 'clear')
 
 
-def exit_program():
+def exit_program(session):
     """
-    Exits program
+    Ends the menu loop
+    :param session: Session obj
     :return: None
     """
     clear_screen()
     print('Exiting...')
-    sys.exit(0)
 
 
 if __name__ == '__main__':
-    Feed(Config.database).create_tables()
-    top_menu()
+    with Session(Config.database) as main_session:
+        main_session.feed.create_tables()
+        run(main_session)
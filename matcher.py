@@ -0,0 +1,456 @@
+"""
+This module contains Matcher, which searches court roll text for every user's
+search terms at once, along with Scanner & PartitionIndex, which Matcher uses
+to find phrases exactly & approximately
+"""
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import compress
+import pickle
+import re
+
+from atomic import replacing
+from query import parse_stored
+
+_PUNCTUATION = re.compile(r'[\W_]+')
+_LETTERS = re.compile(r'[^\W_]+')
+_WORDS = re.compile(r'\S+')
+# One of the pieces PartitionIndex picked from a term, see PartitionIndex
+Piece = namedtuple('Piece', ['term', 'offset', 'distance', 'head', 'tail', 'before', 'after',
+                             'segments'])
+# Saved with each Matcher, so that files written by a version which laid
+# Matcher out differently are rebuilt rather than loaded
+_FORMAT = 3
+
+
+def compact(text):
+    """
+    Strips spacing & punctuation, so that 'MAC-DONALD & CO.' and
+    'MACDONALD & CO' compare equal
+    :param text: str
+    :return: str, upper-cased letters & digits of text
+    """
+    return _PUNCTUATION.sub('', text).upper()
+
+
+def load_matcher(path, key):
+    """
+    :param path: str, file written by save_matcher
+    :param key: anything picklable identifying the terms & settings the
+    Matcher is wanted for
+    :return: Matcher obj saved with the same key, or None if there is no
+    such file, it was saved with another key or it can't be read
+    """
+    try:
+        with open(path, 'rb') as file:
+            saved_key, matcher = pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    return matcher if saved_key == (_FORMAT, key) else None
+
+
+def save_matcher(path, key, matcher):
+    """
+    Pickles matcher along with key, replacing path in one step so that
+    another process never reads half a file
+    :param path: str
+    :param key: anything picklable, see load_matcher
+    :param matcher: Matcher obj
+    :return: None
+    """
+    with replacing(path) as file:
+        pickle.dump(((_FORMAT, key), matcher), file, pickle.HIGHEST_PROTOCOL)
+
+
+def prefix_distance(pattern, text, limit):
+    """
+    The fewest insertions, deletions or substitutions needed to turn pattern
+    into some prefix of text.  Matching characters are consumed greedily,
+    which never costs an edit, so each edit only branches three ways at the
+    first mismatch; with the small limits used this beats filling in a table.
+    :param pattern: str
+    :param text: str
+    :param limit: int
+    :return: int, the distance, or limit + 1 if it is greater than limit
+    """
+    if text.startswith(pattern):
+        return 0
+    if limit == 0:
+        return 1
+    same = 0
+    while same < len(text) and pattern[same] == text[same]:
+        same += 1
+    if same == len(text):
+        return min(len(pattern) - same, limit + 1)
+    if limit == 1:
+        # The last edit has to be at the mismatch, so the rest must match
+        rest = pattern[same + 1:]
+        if text.startswith(rest, same + 1) or text.startswith(rest, same) or \
+                text.startswith(pattern[same:], same + 1):
+            return 1
+        return 2
+    return 1 + min(prefix_distance(pattern[same + 1:], text[same + 1:], limit - 1),
+                   prefix_distance(pattern[same + 1:], text[same:], limit - 1),
+                   prefix_distance(pattern[same:], text[same + 1:], limit - 1))
+
+
+class Matcher:
+    """
+    Compiles every user's search terms into a single scanning plan.  Each
+    term is parsed into a query, the phrases of all queries are pooled and
+    deduplicated, and one Scanner finds all of them in a single pass over the
+    text.  Each unique term's query is then evaluated against what was found,
+    and hits are fanned out to the term's subscribers through an inverted
+    index, however many users share that term.
+    """
+    def __init__(self, users, fuzzy=False, distances=None, default_distance=1):
+        """
+        :param users: iterable of User obj
+        :param fuzzy: bool, if set, phrases missing from the text are looked
+        for again, ignoring spacing & punctuation and tolerating typos
+        :param distances: dict of term to the number of typos tolerated,
+        for terms which don't use default_distance
+        :param default_distance: int
+        """
+        self.users = list(users)
+        self.subscribers = {}
+        for user in self.users:
+            for term in user.search_terms:
+                self.subscribers.setdefault(term, []).append(user)
+        self.queries = {term: parse_stored(term) for term in self.subscribers}
+        self.scanner = Scanner(set().union(*(query.phrases()
+                                             for query in self.queries.values())))
+        self.fuzzy_index = None
+        if fuzzy:
+            distances = distances or {}
+            phrase_distances = {}
+            for term, query in self.queries.items():
+                distance = distances.get(term, default_distance)
+                for phrase in query.phrases():
+                    phrase_distances[phrase] = min(
+                        distance, phrase_distances.get(phrase, distance))
+            self.fuzzy_index = PartitionIndex(phrase_distances)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.users})'
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def match(self, text):
+        """
+        :param text: str, upper-cased block of text from a Court Roll Issue
+        :return: list of 2-tuples, User obj & list of that user's search terms
+        found in text.  Users & terms keep the order they were added in.
+        """
+        return self.locate(text)[0]
+
+    def locate(self, text):
+        """
+        match, also returning where each term was found, from the same scan
+        :param text: str, upper-cased block of text from a Court Roll Issue
+        :return: 2-tuple, match's list of (User obj, terms) tuples & dict of
+        each term found to the sorted offsets in text of the phrases it
+        matched on
+        """
+        found = self.scanner.scan(text)
+        if self.fuzzy_index is not None and len(found) < len(self.scanner):
+            found.update(self._fuzzy_search(CompactText(text), exclude=found))
+        words = WordPositions(text)
+        hits, offsets = {}, {}
+        for term, query in self.queries.items():
+            if query.evaluate(found, words):
+                offsets[term] = sorted(set(query.offsets(found, words)))
+                for user in self.subscribers[term]:
+                    hits.setdefault(user, set()).add(term)
+        return [(user, [term for term in user.search_terms if term in hits[user]])
+                for user in self.users if user in hits], offsets
+
+    def _fuzzy_search(self, text, exclude):
+        """
+        :param text: CompactText obj, of the upper-cased text
+        :param exclude: container of phrases already found, which aren't
+        looked for again
+        :return: dict of phrase to offsets in text where it was approximately
+        found
+        """
+        found = self.fuzzy_index.search(text.compacted, exclude=exclude)
+        for phrase, offsets in found.items():
+            offsets[:] = [text.original_offset(offset) for offset in offsets]
+        return found
+
+
+class Scanner:
+    """
+    Aho-Corasick automaton over a set of phrases: a trie of the phrases, with
+    each node linked to the longest proper suffix of its path that is also in
+    the trie.  One pass over a text finds every occurrence of every phrase,
+    overlapping or not, whatever the number of phrases.
+    """
+    def __init__(self, phrases):
+        """
+        :param phrases: iterable of str
+        """
+        self.phrases = set(phrases)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for phrase in self.phrases:
+            state = 0
+            for char in phrase:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state] = (phrase,)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] += self.output[self.fail[child]]
+                queue.append(child)
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def scan(self, text):
+        """
+        :param text: str
+        :return: dict of phrase to list of offsets where it starts in text,
+        for phrases found at least once
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        found = {}
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for phrase in output[state]:
+                    found.setdefault(phrase, []).append(end - len(phrase))
+        return found
+
+
+class CompactText:
+    """
+    A text along with its letters & digits run together, as PartitionIndex
+    expects, compacted once per text.  Where each run of letters started in
+    the original is only worked out the first time an offset is converted.
+    """
+    def __init__(self, text):
+        """
+        :param text: str, upper-cased
+        """
+        self.text = text
+        self.compacted = _PUNCTUATION.sub('', text)
+        self.runs = None
+
+    def original_offset(self, offset):
+        """
+        :param offset: int, in compacted
+        :return: int, the same character's offset in text
+        """
+        if self.runs is None:
+            self.runs = ([], [])
+            total = 0
+            for match in _LETTERS.finditer(self.text):
+                self.runs[0].append(total)
+                self.runs[1].append(match.start())
+                total += match.end() - match.start()
+        run = bisect_right(self.runs[0], offset) - 1
+        return self.runs[1][run] + offset - self.runs[0][run]
+
+
+class WordPositions:
+    """
+    Converts offsets in a text into word numbers, splitting the text into
+    words the first time it is needed
+    """
+    def __init__(self, text):
+        """
+        :param text: str
+        """
+        self.text = text
+        self.starts = None
+
+    def index(self, offset):
+        """
+        :param offset: int
+        :return: int, number of the word containing offset
+        """
+        if self.starts is None:
+            self.starts = [match.start() for match in _WORDS.finditer(self.text)]
+        return max(0, bisect_right(self.starts, offset) - 1)
+
+
+class PartitionIndex:
+    """
+    Finds terms within a per-term edit distance of some part of a text.  Each
+    term allowed d typos has d + 1 non-overlapping pieces, PIECE characters
+    long, picked out up front; since d edits can spoil at most d of them, any
+    approximate occurrence of the term must contain one piece exactly.  A
+    single pass over the text looks every PIECE-long stretch up in the piece
+    index, and the comparatively slow edit distance is only worked out around
+    the few places where a piece turns up.
+    Pieces of common words like BANK turn up all over a roll, in many terms.
+    A term can only be within d edits where one of the d + 1 characters
+    before the piece is among the d + 1 the term has there, & likewise after
+    it, which is checked before the edit distance is worked out.  So is the
+    pieces' argument over again, on each side of the piece: split into d + 1
+    segments, one must turn up exactly, within d characters of its place.
+    Both terms & text are expected to be compacted first.
+    """
+    PIECE = 4
+
+    def __init__(self, distances):
+        """
+        Distances are capped so that every piece fits in the term.  Short terms
+        therefore tolerate fewer typos, and terms under PIECE characters aren't
+        indexed at all.
+        :param distances: dict of term to the number of typos tolerated
+        """
+        self.patterns = {}
+        for term, distance in distances.items():
+            pattern = compact(term)
+            distance = min(distance, len(pattern) // self.PIECE - 1)
+            if distance >= 0:
+                self.patterns[term] = (pattern, distance)
+        frequencies = {}
+        for pattern, _ in self.patterns.values():
+            for piece in self._pieces(pattern):
+                frequencies[piece] = frequencies.get(piece, 0) + 1
+        # Piece to a Piece for each term it was picked from.  head is the
+        # term before the piece, reversed, & tail the term after it, so that
+        # nothing is sliced from terms while searching.  before & after are
+        # the distance + 1 characters nearest the piece, or None if there
+        # are too few to tell anything from, & segments each side's segments.
+        self.pieces = {}
+        for term, (pattern, distance) in self.patterns.items():
+            for offset in self._choose_pieces(pattern, distance + 1, frequencies):
+                head, tail = pattern[:offset][::-1], pattern[offset + self.PIECE:]
+                before, after = (frozenset(side[:distance + 1]) if len(side) > distance
+                                 else None for side in (head, tail))
+                self.pieces.setdefault(pattern[offset:offset + self.PIECE], []).append(
+                    Piece(term, offset, distance, head, tail, before, after,
+                          self._segments(pattern, offset, distance)))
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _pieces(self, pattern):
+        """
+        :param pattern: str
+        :return: set of every PIECE-long substring of pattern
+        """
+        return {pattern[start:start + self.PIECE]
+                for start in range(len(pattern) - self.PIECE + 1)}
+
+    def _choose_pieces(self, pattern, count, frequencies):
+        """
+        Picks count non-overlapping pieces, preferring those shared by
+        the fewest other terms.  Words common to many party names, like BANK
+        or LIMITED, are just as common in the rolls, and would otherwise have
+        to be verified at every occurrence.
+        :param pattern: str
+        :param count: int
+        :param frequencies: dict of piece to how many patterns contain it
+        :return: list of int, offsets of the chosen pieces in pattern
+        """
+        starts = sorted(range(len(pattern) - self.PIECE + 1),
+                        key=lambda start: frequencies[pattern[start:start + self.PIECE]])
+        chosen = []
+        for start in starts:
+            if all(abs(start - other) >= self.PIECE for other in chosen):
+                chosen.append(start)
+                if len(chosen) == count:
+                    return chosen
+        return [part * self.PIECE for part in range(count)]
+
+    def _segments(self, pattern, offset, distance):
+        """
+        Splits the term either side of the piece at offset into distance + 1
+        segments.  A side shorter than that could be spoilt entirely, so has
+        none.
+        :param pattern: str
+        :param offset: int, where the piece starts in pattern
+        :param distance: int
+        :return: tuple with a tuple for each side which has segments, of
+        (int, str, int) tuples: where in text, relative to the piece, to start
+        looking for the segment, the segment & how far to look
+        """
+        sides = []
+        for first, last in ((0, offset), (offset + self.PIECE, len(pattern))):
+            if last - first > distance:
+                bounds = [first + (last - first) * part // (distance + 1)
+                          for part in range(distance + 2)]
+                sides.append(tuple((start - offset - distance, pattern[start:stop],
+                                    stop - start + 2 * distance)
+                                   for start, stop in zip(bounds, bounds[1:])))
+        return tuple(sides)
+
+    def search(self, text, exclude=()):
+        """
+        :param text: str, compacted text
+        :param exclude: container of terms already known to be present
+        :return: dict of term to list of offsets in text where it starts,
+        for terms found at least once
+        """
+        found = {}
+        pieces, size = self.pieces, self.PIECE
+        # Every stretch is looked up without leaving C, & only the places
+        # where a piece turns up come back out to Python
+        stretches = map(''.join, zip(*(text[skip:] for skip in range(size))))
+        owners_at = list(map(pieces.get, stretches))
+        for start in compress(range(len(owners_at)), owners_at):
+            end = start + size
+            for term, offset, distance, head, tail, before, after, segments \
+                    in owners_at[start]:
+                if term in exclude:
+                    continue
+                if before is not None and \
+                        before.isdisjoint(text[max(0, start - distance - 1):start]):
+                    continue
+                if after is not None and after.isdisjoint(text[end:end + distance + 1]):
+                    continue
+                for side in segments:
+                    for relative, segment, width in side:
+                        first = max(0, start + relative)
+                        if text.find(segment, first, start + relative + width) != -1:
+                            break
+                    else:
+                        break
+                else:
+                    if self._verify(distance, offset, head, tail, text, start):
+                        begin = max(0, start - offset)
+                        offsets = found.setdefault(term, [])
+                        if not offsets or offsets[-1] != begin:
+                            offsets.append(begin)
+        return found
+
+    def _verify(self, distance, offset, head, tail, text, start):
+        """
+        Given one of a term's pieces found at start, works outwards from it,
+        checking that the rest of the term can be matched within distance.
+        :param distance: int
+        :param offset: int, where the piece starts in the term's pattern
+        :param head: str, the pattern before the piece, reversed
+        :param tail: str, the pattern after the piece
+        :param text: str, compacted text
+        :param start: int, where the piece starts in text
+        :return: bool
+        """
+        used = 0
+        if head:
+            before = text[max(0, start - offset - distance):start][::-1]
+            used = prefix_distance(head, before, distance)
+            if used > distance:
+                return False
+        end = start + self.PIECE
+        after = text[end:end + len(tail) + distance - used]
+        return prefix_distance(tail, after, distance - used) <= distance - used
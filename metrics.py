@@ -0,0 +1,310 @@
+"""
+This module contains a small metrics registry, written out in the Prometheus
+text format, either to a file for node_exporter's textfile collector or over
+HTTP, along with the metrics recorded by Feed.refresh.
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import threading
+import time
+
+from atomic import replacing
+
+
+class Counter:
+    """
+    A count which only goes up
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, lock):
+        """
+        :param name: str
+        :param documentation: str
+        :param lock: threading.Lock, shared by the registry's metrics
+        """
+        self.name = name
+        self.documentation = documentation
+        self._lock = lock
+        self.value = 0
+
+    def inc(self, amount=1):
+        """
+        :param amount: int or float
+        :return: None
+        """
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        """
+        :return: list of 2-tuples, sample name, including any labels, & value
+        """
+        return [(self.name, self.value)]
+
+    def merge(self, values):
+        """
+        Adds the totals written by a previous run, so that counts carry on
+        from where it left off
+        :param values: dict of sample name to value
+        :return: None
+        """
+        self.value += values.get(self.name, 0)
+
+
+class Gauge(Counter):
+    """
+    A value which can go up or down, e.g. a timestamp
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, lock):
+        super().__init__(name, documentation, lock)
+        self.value = None
+
+    def set(self, value):
+        """
+        :param value: int or float
+        :return: None
+        """
+        with self._lock:
+            self.value = value
+
+    def samples(self):
+        return [] if self.value is None else [(self.name, self.value)]
+
+    def merge(self, values):
+        """
+        Keeps the previous run's value until a new one is set
+        """
+        if self.value is None:
+            self.value = values.get(self.name)
+
+
+class Histogram(Counter):
+    """
+    Counts observations, e.g. durations, into cumulative buckets
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, lock, buckets):
+        """
+        :param buckets: list of float, upper bounds of the buckets
+        """
+        super().__init__(name, documentation, lock)
+        self.buckets = sorted(buckets) + [float('inf')]
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0
+
+    def observe(self, value):
+        """
+        :param value: int or float
+        :return: None
+        """
+        with self._lock:
+            for num, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[num] += 1
+                    break
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """
+        Observes the number of seconds the with block took
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    @property
+    def count(self):
+        """
+        :return: int, number of observations
+        """
+        return sum(self.counts)
+
+    def _bucket_name(self, bound):
+        """
+        :param bound: float, a bucket's upper bound
+        :return: str, the bucket's sample name
+        """
+        label = '+Inf' if bound == float('inf') else repr(float(bound))
+        return f'{self.name}_bucket{{le="{label}"}}'
+
+    def samples(self):
+        """
+        :return: list of 2-tuples, sample name & value: the cumulative count
+        of each bucket, then the sum & count of the observations
+        """
+        samples, total = [], 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            samples.append((self._bucket_name(bound), total))
+        return samples + [(f'{self.name}_sum', self.sum),
+                          (f'{self.name}_count', total)]
+
+    def merge(self, values):
+        """
+        Adds the bucket counts & sum written by a previous run, undoing the
+        buckets' running totals
+        :param values: dict of sample name to value
+        :return: None
+        """
+        previous = 0
+        for num, bound in enumerate(self.buckets):
+            total = values.get(self._bucket_name(bound), previous)
+            self.counts[num] += total - previous
+            previous = total
+        self.sum += values.get(f'{self.name}_sum', 0)
+
+
+class Registry:
+    """
+    Holds a set of metrics and writes them out in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+        self._merged = False
+
+    def counter(self, name, documentation):
+        """
+        :param name: str, should end in _total
+        :param documentation: str
+        :return: Counter obj
+        """
+        return self._register(Counter(name, documentation, self._lock))
+
+    def gauge(self, name, documentation):
+        """
+        :param name: str
+        :param documentation: str
+        :return: Gauge obj
+        """
+        return self._register(Gauge(name, documentation, self._lock))
+
+    def histogram(self, name, documentation, buckets):
+        """
+        :param name: str
+        :param documentation: str
+        :param buckets: list of float, upper bounds of the buckets
+        :return: Histogram obj
+        """
+        return self._register(Histogram(name, documentation, self._lock, buckets))
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        :return: str, every metric in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            for metric in self.metrics:
+                lines.append(f'# HELP {metric.name} {metric.documentation}')
+                lines.append(f'# TYPE {metric.name} {metric.kind}')
+                lines.extend(f'{name} {value!r}' for name, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Writes every metric to path, replacing it in one step so that a
+        collector never reads half a file.  The first time, the totals
+        already in the file are added to this process' own, so that counts
+        keep growing across runs of the program.
+        :param path: str
+        :return: None
+        """
+        if not self._merged:
+            self._merged = True
+            values = read_samples(path)
+            with self._lock:
+                for metric in self.metrics:
+                    metric.merge(values)
+        with replacing(path, 'w') as file:
+            file.write(self.render())
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serves the metrics at http://host:port/metrics from a background thread
+        :param port: int, 0 picks a free port
+        :param host: str
+        :return: HTTPServer obj, call shutdown() on it to stop serving
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def read_samples(path):
+    """
+    :param path: str, file written by Registry.write
+    :return: dict of sample name to value, empty if there is no such file
+    """
+    values = {}
+    if not os.path.exists(path):
+        return values
+    with open(path) as file:
+        for line in file:
+            if line.startswith('#') or not line.strip():
+                continue
+            name, _, value = line.rstrip('\n').rpartition(' ')
+            values[name] = float(value)
+    return values
+
+
+SECONDS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+REGISTRY = Registry()
+REFRESHES = REGISTRY.counter('court_roll_refreshes_total', 'Refreshes run')
+REFRESH_FAILURES = REGISTRY.counter('court_roll_refresh_failures_total',
+                                    'Refreshes which stopped with an error')
+LAST_REFRESH = REGISTRY.gauge('court_roll_last_refresh_timestamp_seconds',
+                              'Unix time at which the last refresh finished')
+ISSUES = REGISTRY.counter('court_roll_issues_total', 'Issues downloaded & stored')
+FETCH_THROTTLED = REGISTRY.counter('court_roll_fetch_throttled_total',
+                                  'Times downloads were slowed down because '
+                                  'the court server throttled or struggled')
+SKIPPED = REGISTRY.counter('court_roll_issues_skipped_total',
+                           'Issues which could not be downloaded')
+HITS = REGISTRY.counter('court_roll_hits_total',
+                        'Issues found to concern a user, summed over users')
+EMAILS = REGISTRY.counter('court_roll_emails_total', 'Alert emails sent')
+EMAIL_FAILURES = REGISTRY.counter('court_roll_email_failures_total',
+                                  'Alert emails which could not be sent')
+REFRESH_SECONDS = REGISTRY.histogram('court_roll_refresh_seconds',
+                                     'Time taken by each refresh',
+                                     [1, 5, 10, 30, 60, 120, 300, 600, 1800])
+FETCH_SECONDS = REGISTRY.histogram('court_roll_fetch_seconds',
+                                   'Time taken to download each issue', SECONDS)
+PARSE_SECONDS = REGISTRY.histogram('court_roll_parse_seconds',
+                                   'Time taken to parse each issue', SECONDS)
+MATCH_SECONDS = REGISTRY.histogram('court_roll_match_seconds',
+                                   'Time taken to search each issue', SECONDS)
+EMAIL_SECONDS = REGISTRY.histogram('court_roll_email_seconds',
+                                   'Time taken to send each batch of alert emails',
+                                   SECONDS)
@@ -0,0 +1,333 @@
+"""
+This module parses search terms into queries.  A term containing a double
+quote is an expression of quoted phrases combined with AND, OR, NOT,
+parentheses and W/n, meaning within n words of each other, e.g.
+    "ROYAL BANK" AND NOT ("HALIFAX" OR "BANK OF SCOTLAND")
+    "SMITH" W/5 "JONES"
+Any other term is a single phrase, matched as before.
+"""
+import re
+
+_TOKENS = re.compile(r'\s*(?:"(?P<phrase>[^"]*)"|(?P<paren>[()])|'
+                     r'(?P<within>W/(?P<distance>\d+))|'
+                     r'(?P<operator>AND|OR|NOT)\b|(?P<other>\S+))',
+                     re.IGNORECASE)
+
+
+class Phrase:
+    """
+    A run of text which has to appear in the issue
+    """
+    __slots__ = ['text', 'length']
+
+    def __init__(self, text):
+        """
+        :param text: str
+        """
+        self.text = text
+        self.length = len(text.split())
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.text!r})'
+
+    def phrases(self):
+        """
+        :return: set of str, the phrases which have to be scanned for
+        """
+        return {self.text}
+
+    def evaluate(self, found, words):
+        """
+        :param found: dict of phrase to list of offsets where it was found
+        :param words: WordPositions obj, used by W/n
+        :return: bool
+        """
+        return self.text in found
+
+    def offsets(self, found, words):
+        """
+        :param found: dict of phrase to list of offsets where it was found
+        :param words: WordPositions obj
+        :return: list of int, where the phrases which make the query match
+        were found, for a query which matches
+        """
+        return found[self.text]
+
+
+class And:
+    """
+    Every part has to match
+    """
+    __slots__ = ['parts']
+
+    def __init__(self, parts):
+        """
+        :param parts: list of queries
+        """
+        self.parts = parts
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.parts})'
+
+    def phrases(self):
+        """
+        :return: set of str, every part's phrases
+        """
+        return set().union(*(part.phrases() for part in self.parts))
+
+    def evaluate(self, found, words):
+        """
+        :param found: dict of phrase to list of offsets where it was found
+        :param words: WordPositions obj, used by W/n
+        :return: bool, True if every part matches
+        """
+        return all(part.evaluate(found, words) for part in self.parts)
+
+    def offsets(self, found, words):
+        """
+        :param found: dict of phrase to list of offsets where it was found
+        :param words: WordPositions obj
+        :return: list of int, the offsets of the parts which match
+        """
+        return [offset for part in self.parts if part.evaluate(found, words)
+                for offset in part.offsets(found, words)]
+
+
+class Or(And):
+    """
+    At least one part has to match
+    """
+    __slots__ = []
+
+    def evaluate(self, found, words):
+        """
+        :param found: dict of phrase to list of offsets where it was found
+        :param words: WordPositions obj, used by W/n
+        :return: bool, True if any part matches
+        """
+        return any(part.evaluate(found, words) for part in self.parts)
+
+
+class Not:
+    """
+    Matches when the inner query does not
+    """
+    __slots__ = ['part']
+
+    def __init__(self, part):
+        """
+        :param part: query
+        """
+        self.part = part
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.part})'
+
+    def phrases(self):
+        """
+        :return: set of str, the inner query's phrases, which have to be
+        scanned for to tell that they're absent
+        """
+        return self.part.phrases()
+
+    def evaluate(self, found, words):
+        """
+        :param found: dict of phrase to list of offsets where it was found
+        :param words: WordPositions obj, used by W/n
+        :return: bool, True if the inner query doesn't match
+        """
+        return not self.part.evaluate(found, words)
+
+    def offsets(self, found, words):
+        """
+        :param found: dict of phrase to list of offsets where it was found
+        :param words: WordPositions obj
+        :return: list, empty, as nothing found is what made it match
+        """
+        return []
+
+
+class Within:
+    """
+    Both phrases have to appear, in either order, with fewer than distance
+    words between the end of one and the start of the other, so W/1 means
+    the phrases are next to each other
+    """
+    __slots__ = ['left', 'right', 'distance']
+
+    def __init__(self, left, right, distance):
+        """
+        :param left: Phrase obj
+        :param right: Phrase obj
+        :param distance: int
+        """
+        self.left = left
+        self.right = right
+        self.distance = distance
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.left}, {self.right}, {self.distance})'
+
+    def phrases(self):
+        """
+        :return: set of str, both phrases
+        """
+        return {self.left.text, self.right.text}
+
+    def evaluate(self, found, words):
+        """
+        :param found: dict of phrase to list of offsets where it was found
+        :param words: WordPositions obj, used by W/n
+        :return: bool, True if some pair of places the phrases were found
+        is close enough
+        """
+        if self.left.text not in found or self.right.text not in found:
+            return False
+        lefts = [words.index(offset) for offset in found[self.left.text]]
+        rights = [words.index(offset) for offset in found[self.right.text]]
+        return any(right - (left + self.left.length) < self.distance and
+                   left - (right + self.right.length) < self.distance
+                   for left in lefts for right in rights)
+
+    def offsets(self, found, words):
+        """
+        :param found: dict of phrase to list of offsets where it was found
+        :param words: WordPositions obj
+        :return: list of int, everywhere either phrase was found
+        """
+        return found[self.left.text] + found[self.right.text]
+
+
+def parse(term):
+    """
+    Raises ValueError if term is an expression which can't be parsed, or
+    which would match an issue without any of its phrases appearing.
+    :param term: str, search term
+    :return: query obj, with phrases(), listing the phrases to scan for,
+    evaluate(found, words), which decides whether an issue matches, &
+    offsets(found, words), where the phrases it matched on were found
+    """
+    if '"' not in term:
+        return Phrase(term)
+    tokens = _tokenize(term)
+    query = _parse_or(tokens)
+    if tokens:
+        raise ValueError(f'Unexpected {tokens[-1][1]!r} in {term!r}')
+    if query.evaluate({}, None):
+        raise ValueError(f'{term!r} would match every issue')
+    return query
+
+
+def parse_stored(term):
+    """
+    parse, for terms already in the database.  Terms saved before
+    expressions were supported may contain double quotes without being valid
+    expressions; rather than stopping every refresh, those are matched as a
+    single phrase, as they were then.
+    :param term: str, search term
+    :return: query obj
+    """
+    try:
+        return parse(term)
+    except ValueError:
+        return Phrase(term)
+
+
+def _tokenize(term):
+    """
+    :param term: str
+    :return: list of 2-tuples, token kind & value, in reverse order so that
+    the parser can pop them off the end
+    """
+    tokens = []
+    for match in _TOKENS.finditer(term):
+        if match.group('phrase') is not None:
+            phrase = ' '.join(match.group('phrase').split())
+            if not phrase:
+                raise ValueError(f'Empty phrase in {term!r}')
+            tokens.append(('phrase', phrase))
+        elif match.group('paren'):
+            tokens.append((match.group('paren'), match.group('paren')))
+        elif match.group('within'):
+            tokens.append(('within', int(match.group('distance'))))
+        elif match.group('operator'):
+            tokens.append((match.group('operator').upper(), match.group('operator')))
+        elif match.group('other'):
+            raise ValueError(f'Unexpected {match.group("other")!r} in {term!r}, '
+                             f'phrases must be quoted')
+    return tokens[::-1]
+
+
+def _parse_or(tokens):
+    """
+    :param tokens: list of tokens from _tokenize, consumed from the end
+    :return: query obj, an Or of the AND expressions separated by OR, or
+    the only one
+    """
+    parts = [_parse_and(tokens)]
+    while tokens and tokens[-1][0] == 'OR':
+        tokens.pop()
+        parts.append(_parse_and(tokens))
+    return parts[0] if len(parts) == 1 else Or(parts)
+
+
+def _parse_and(tokens):
+    """
+    :param tokens: list of tokens from _tokenize, consumed from the end
+    :return: query obj, an And of the NOT expressions separated by AND, or
+    the only one
+    """
+    parts = [_parse_not(tokens)]
+    while tokens and tokens[-1][0] == 'AND':
+        tokens.pop()
+        parts.append(_parse_not(tokens))
+    return parts[0] if len(parts) == 1 else And(parts)
+
+
+def _parse_not(tokens):
+    """
+    :param tokens: list of tokens from _tokenize, consumed from the end
+    :return: query obj, wrapped in a Not for each leading NOT
+    """
+    if tokens and tokens[-1][0] == 'NOT':
+        tokens.pop()
+        return Not(_parse_not(tokens))
+    return _parse_within(tokens)
+
+
+def _parse_within(tokens):
+    """
+    Raises ValueError if W/n joins anything but two phrases, or n is 0
+    :param tokens: list of tokens from _tokenize, consumed from the end
+    :return: query obj, a Within if the next operator is W/n
+    """
+    query = _parse_primary(tokens)
+    if tokens and tokens[-1][0] == 'within':
+        distance = tokens.pop()[1]
+        if distance < 1:
+            raise ValueError(f'W/{distance} can never match, use W/1 or more')
+        right = _parse_primary(tokens)
+        if not isinstance(query, Phrase) or not isinstance(right, Phrase):
+            raise ValueError('W/n can only join two quoted phrases')
+        query = Within(query, right, distance)
+    return query
+
+
+def _parse_primary(tokens):
+    """
+    Raises ValueError if tokens run out, or don't start with a phrase or
+    an opening parenthesis, or the parenthesis isn't closed
+    :param tokens: list of tokens from _tokenize, consumed from the end
+    :return: query obj, a Phrase or a parenthesised expression
+    """
+    if not tokens:
+        raise ValueError('Expression ends unexpectedly')
+    kind, value = tokens.pop()
+    if kind == 'phrase':
+        return Phrase(value)
+    if kind == '(':
+        query = _parse_or(tokens)
+        if not tokens or tokens.pop()[0] != ')':
+            raise ValueError('Missing closing parenthesis')
+        return query
+    raise ValueError(f'Unexpected {value!r}')
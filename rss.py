@@ -0,0 +1,99 @@
+"""
+This module contains parse_feed, which pulls the entries out of an RSS or Atom
+feed.  Only each entry's link, guid & publish date are needed, so the document
+is streamed through a plain XML parser; feedparser, which sanitizes and
+normalizes everything, is only used for documents which aren't well formed.
+"""
+from collections import namedtuple
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from io import BytesIO
+import time
+from xml.etree.ElementTree import ParseError, iterparse
+
+import feedparser as fp
+
+Entry = namedtuple('Entry', ['link', 'guid', 'published'])
+Entry.__doc__ = """
+A feed entry.  published is an ISO format date, or None if the feed has none
+"""
+
+_ENTRIES = {'item', 'entry'}
+_DATES = {'pubDate', 'date', 'published', 'updated'}
+
+
+def parse_feed(content):
+    """
+    :param content: bytes, the feed document
+    :return: list of Entry, in feed order
+    """
+    try:
+        entries = _parse_fast(content)
+    except ParseError:
+        entries = []
+    return entries or _parse_slow(content)
+
+
+def _parse_fast(content):
+    """
+    Raises ParseError if the document isn't well formed XML
+    :param content: bytes
+    :return: list of Entry
+    """
+    entries = []
+    fields = {}
+    for event, element in iterparse(BytesIO(content), events=('start', 'end')):
+        tag = element.tag.rpartition('}')[2]
+        if event == 'start':
+            if tag in _ENTRIES:
+                fields = {}
+            continue
+        if tag in _ENTRIES:
+            if fields.get('link'):
+                entries.append(Entry(fields['link'], fields.get('guid', fields['link']),
+                                     _parse_date(fields.get('date'))))
+            element.clear()
+        elif tag == 'link':
+            href = element.get('href')
+            if href is None:
+                fields.setdefault('link', (element.text or '').strip())
+            elif element.get('rel', 'alternate') == 'alternate':
+                fields.setdefault('link', href.strip())
+        elif tag in ('guid', 'id'):
+            fields.setdefault('guid', (element.text or '').strip())
+        elif tag in _DATES:
+            fields.setdefault('date', (element.text or '').strip())
+    return entries
+
+
+def _parse_slow(content):
+    """
+    :param content: bytes
+    :return: list of Entry
+    """
+    entries = []
+    for item in fp.parse(content)['entries']:
+        if 'link' not in item:
+            continue
+        parsed = item.get('published_parsed') or item.get('updated_parsed')
+        published = time.strftime('%Y-%m-%d', parsed) if parsed else None
+        entries.append(Entry(item['link'], item.get('id', item['link']), published))
+    return entries
+
+
+def _parse_date(value):
+    """
+    :param value: str, RFC 822 date as used by RSS, or ISO 8601 date as used
+    by Atom
+    :return: str, ISO format date, or None if value can't be parsed
+    """
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value[:10], '%Y-%m-%d').date().isoformat()
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value).date().isoformat()
+    except (TypeError, ValueError):
+        return None
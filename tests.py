@@ -2,18 +2,125 @@
 This module contains unittests.
 """
 
+import asyncio
+from datetime import date
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
 import os
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from io import BytesIO, StringIO
+from socketserver import ThreadingMixIn
+from unittest import mock
+from urllib.request import urlopen
+from xml.etree.ElementTree import ParseError, iterparse
 
-from database import Database
-from feed import Feed
+import requests
+
+from archive import archive_path, read_issues
+from backend import MemoryBackend
+from cache import ResponseCache
+from configuration import Config
+from database import Database, date_from_url
+from export import write_export
+import manager
+from manager import Session
+from feed import AlertBatch, Feed, User, hit_contexts, render, retention_cutoff
+from matcher import Matcher, Scanner, prefix_distance
+import metrics
+from metrics import Registry, read_samples
+from query import parse
+from rss import Entry, parse_feed
+from throttle import FetchController, HostLimiter, TokenBucket
 
 DB = 'test.db'
 EMAIL = 'god_of_wine@iron_throne.com'
 URL = 'www.bobby-b.com/god_of_wine.html'
 
 
+MATCHER_CACHE = mock.patch.object(Config, 'matcher_cache', None)
+
+
+def setUpModule():
+    """
+    Keeps tests from leaving a matcher cache in the program directory
+    :return: None
+    """
+    MATCHER_CACHE.start()
+
+
+def tearDownModule():
+    MATCHER_CACHE.stop()
+
+
+def remove_db():
+    """
+    Deletes the test database along with its WAL files
+    :return: None
+    """
+    for path in (DB, DB + '-wal', DB + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def roll_page(entries=1000):
+    """
+    Builds a court roll page resembling the ones published on the court website
+    :param entries: int, number of case lines in the roll
+    :return: bytes
+    """
+    lines = ''.join(f'<p>{num}. BOBBY B v THE IRON BANK OF BRAAVOS (A{num}/17)</p>'
+                    for num in range(entries))
+    return (f'<html><body><div class="header">Court of Session</div>'
+            f'<div class="courtRollContent"><h3>Outer House</h3>{lines}</div>'
+            f'</body></html>').encode()
+
+
+def per_recipient(send_email):
+    """
+    :param send_email: function taking a User obj, hits, url & contexts,
+    standing in for sending one user their alert
+    :return: replacement for AlertBatch.send, calling send_email for each of
+    the batch's users in turn, until told to stop
+    """
+    def send(batch, sent, stop=None):
+        for user in batch.users:
+            if stop is not None and stop.is_set():
+                break
+            send_email(user, batch.hits, batch.url, batch.contexts)
+            sent.append(user)
+    return send
+
+
+class FakeResponse:
+    """
+    Stands in for a streamed requests.Response
+    """
+    def __init__(self, content, headers=None, status_code=200):
+        self.content = content
+        self.headers = headers or {}
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} Error')
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
 class TestDatabase(unittest.TestCase):
     """
     Tests for Database class
@@ -33,7 +140,7 @@ class TestDatabase(unittest.TestCase):
         Deletes database file
         :return: None
         """
-        os.remove(DB)
+        remove_db()
 
     def test_table_creation(self):
         """
@@ -139,6 +246,28 @@ class TestDatabase(unittest.TestCase):
             searches = data.cursor.fetchall()
             self.assertEqual(len(searches), 0)
 
+    def test_term_set_version(self):
+        """
+        Confirms that the term set version goes up with every change to
+        search terms, in both backends, and that databases have their own ids
+        :return: None
+        """
+        ids = set()
+        for backend in (Database(DB), MemoryBackend()):
+            with backend:
+                backend.add_user('bobby b', EMAIL)
+                database_id, version = backend.get_term_set_version()
+                backend.add_search_term(EMAIL, 'WINE')
+                backend.add_search_term(EMAIL, 'WARHAMMERS')
+                self.assertEqual((database_id, version + 2), backend.get_term_set_version())
+                backend.remove_search_term(EMAIL, 'WINE')
+                backend.remove_user(EMAIL)
+                self.assertEqual((database_id, version + 4), backend.get_term_set_version())
+                ids.add(database_id)
+        with Database(DB) as data:
+            ids.add(data.get_term_set_version()[0])
+        self.assertEqual(2, len(ids))
+
     def test_get_search_terms(self):
         """
         Adds user & pair of search terms, confirms that searching for terms
@@ -156,6 +285,100 @@ class TestDatabase(unittest.TestCase):
             self.assertEqual(['gods I was strong', 'breastplate stretcher'],
                              terms)
 
+    def test_shared_search_terms(self):
+        """
+        Adds the same term for two users, confirms it is only stored once and
+        that removing it from one user leaves it with the other
+        :return: None
+        """
+        with Database(DB) as data:
+            data.add_user('bobby b', EMAIL)
+            data.add_user('jon', 'jon@secret_targ.edu')
+            data.add_search_term(EMAIL, 'IRON BANK')
+            data.add_search_term('jon@secret_targ.edu', 'IRON BANK')
+            data.add_search_term('nobody@nowhere.com', 'ORPHAN')
+            data.cursor.execute('SELECT term FROM terms')
+            self.assertEqual([('IRON BANK',)], data.cursor.fetchall())
+            data.remove_search_term(EMAIL, 'IRON BANK')
+            self.assertEqual(['IRON BANK'],
+                             data.get_search_terms('jon@secret_targ.edu'))
+            data.remove_user('jon@secret_targ.edu')
+            data.cursor.execute('SELECT term FROM terms')
+            self.assertEqual([], data.cursor.fetchall())
+
+    def test_term_distances(self):
+        """
+        Confirms that a term's own fuzzy matching distance is stored, and is
+        left alone when the term is added again without one
+        :return: None
+        """
+        with Database(DB) as data:
+            data.add_user('bobby b', EMAIL)
+            data.add_user('jon', 'jon@secret_targ.edu')
+            data.add_search_term(EMAIL, 'WINE')
+            data.add_search_term(EMAIL, 'IRON BANK', max_distance=2)
+            data.add_search_term('jon@secret_targ.edu', 'IRON BANK')
+            self.assertEqual({'IRON BANK': 2}, data.get_term_distances())
+            with self.assertRaises(ValueError):
+                data.add_search_term(EMAIL, '"IRON BANK" AND')
+            self.assertEqual(['WINE', 'IRON BANK'], data.get_search_terms(EMAIL))
+
+    def test_migrate_search_terms(self):
+        """
+        Builds the original one-row-per-user-and-term search_terms table,
+        confirms create_tables moves its rows into terms & user_terms
+        :return: None
+        """
+        remove_db()
+        with Database(DB) as data:
+            data.cursor.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, '
+                                'name TEXT, email_address TEXT UNIQUE)')
+            data.cursor.execute('CREATE TABLE search_terms (id INTEGER PRIMARY KEY, '
+                                'term TEXT NOT NULL, user_id INTEGER NOT NULL)')
+            data.cursor.executemany('INSERT INTO users VALUES (?,?,?)',
+                                    [(1, 'bobby b', EMAIL),
+                                     (2, 'jon', 'jon@secret_targ.edu')])
+            data.cursor.executemany('INSERT INTO search_terms(term, user_id) '
+                                    'VALUES (?,?)',
+                                    [('WINE', 1), ('IRON BANK', 1),
+                                     ('IRON BANK', 2), ('WINE', 1)])
+            data._connection.commit()
+            data.create_tables()
+            data.create_tables()
+            self.assertEqual(['WINE', 'IRON BANK'], data.get_search_terms(EMAIL))
+            self.assertEqual(['IRON BANK'],
+                             data.get_search_terms('jon@secret_targ.edu'))
+            data.cursor.execute('SELECT term FROM terms ORDER BY id')
+            self.assertEqual([('WINE',), ('IRON BANK',)], data.cursor.fetchall())
+
+    def test_backfill_issue_dates(self):
+        """
+        Confirms that issues stored without a date are dated by their first
+        match, or else by a date in their url, & that the rest are left out
+        of date ranges; create_tables only dates them when it adds the column
+        :return: None
+        """
+        with Database(DB) as data:
+            data.add_user('bobby b', EMAIL)
+            data.cursor.executemany('INSERT INTO issues(id, url, html) VALUES (?,?,?)',
+                                    [(1, 'roll?id=1', 'a'), (2, 'roll/2017-10-19', 'b'),
+                                     (3, 'monday-16th-october-2017', 'c'), (4, 'roll', 'd')])
+            data.cursor.execute("INSERT INTO user_issues(user_id, issue_id, matched_at) "
+                                "VALUES (1, 1, '2017-09-01 10:00:00')")
+            data._connection.commit()
+            data.create_tables()
+            data.cursor.execute('SELECT COUNT(*) FROM issues WHERE date IS NULL')
+            self.assertEqual((4,), data.cursor.fetchone())
+            data._backfill_issue_dates()
+            data._connection.commit()
+            data.cursor.execute('SELECT date FROM issues ORDER BY id')
+            self.assertEqual([('2017-09-01',), ('2017-10-19',), ('2017-10-16',), (None,)],
+                             data.cursor.fetchall())
+            self.assertEqual(['roll?id=1', 'roll/2017-10-19', 'monday-16th-october-2017'],
+                             [url for url, _, _ in data.iter_issues(since='2017-01-01')])
+            self.assertEqual(4, len(list(data.iter_issues())))
+        self.assertIsNone(date_from_url('roll/2017-13-40'))
+
     def test_get_users(self):
         """
         Adds a pair of users, confirms via get_users
@@ -215,10 +438,28 @@ class TestDatabase(unittest.TestCase):
                 data.add_user_issue(email_address=EMAIL, url='')
                 data.add_user_issue(email_address='', url=URL)
             data.add_user_issue(EMAIL, URL)
-            data.cursor.execute('SELECT * from user_issues')
+            data.cursor.execute('SELECT id, user_id, issue_id from user_issues')
             user_issues = data.cursor.fetchone()
             self.assertEqual((1, 1, 1), user_issues)
 
+    def test_unique_user_issues(self):
+        """
+        Confirms that duplicate user issues left by older versions are removed,
+        and that recording the same user issue twice only stores it once
+        :return: None
+        """
+        with Database(DB) as data:
+            data.add_user('bobby b', EMAIL)
+            data.add_url_html(URL)
+            data.cursor.execute('DROP INDEX user_issues_unique')
+            data.cursor.executemany('INSERT INTO user_issues(user_id, issue_id) '
+                                    'VALUES (?,?)', [(1, 1), (1, 1)])
+            data.create_tables()
+            data.add_user_issue(EMAIL, URL)
+            self.assertEqual(0, data.add_user_issues([(EMAIL, URL)]))
+            data.cursor.execute('SELECT id, user_id, issue_id FROM user_issues')
+            self.assertEqual([(1, 1, 1)], data.cursor.fetchall())
+
     def test_get_user_issues(self):
         """
         adds three users, adds searches & user_issues for two, confirms urls
@@ -242,6 +483,246 @@ class TestDatabase(unittest.TestCase):
             urls = data.get_user_issues('nutty_queen@astapor.net')
             self.assertEqual(urls, [])
 
+    def test_claim_issues(self):
+        """
+        Confirms that queued issues are only claimed by one worker at a time,
+        that expired claims can be taken over, and that a worker which lost
+        its claim can't complete the issue
+        :return: None
+        """
+        with Database(DB) as data:
+            data.add_url_html(URL)
+            data.queue_issues([('issue/1', '2017-01-01'), ('issue/2', None),
+                               ('issue/3', None), (URL, None)])
+            data.queue_issues([('issue/1', '2017-01-01')])
+            self.assertEqual([('issue/1', '2017-01-01'),
+                              ('issue/2', date.today().isoformat())],
+                             data.claim_issues('a', 2, lease=-1))
+            self.assertEqual(['issue/1', 'issue/2', 'issue/3'],
+                             [url for url, _ in data.claim_issues('b', 5, lease=60)])
+            self.assertEqual([], data.claim_issues('a', 5, lease=60))
+            self.assertFalse(data.complete_issue('issue/1', 'a', '<p>1</p>', 'ONE'))
+            self.assertTrue(data.complete_issue('issue/1', 'b', '<p>1</p>', 'ONE'))
+            self.assertFalse(data.complete_issue('issue/1', 'b', '<p>1</p>', 'ONE'))
+            self.assertEqual(0, data.release_issues('a'))
+            self.assertEqual(3, data.release_issues('b'))
+            self.assertEqual(['issue/2', 'issue/3'],
+                             [url for url, _ in data.claim_issues('a', 5, lease=60)])
+            self.assertEqual([('issue/1', '<p>1</p>', 'ONE')], list(data.iter_issues()))
+
+    def test_checkpoints(self):
+        """
+        Takes an issue through each checkpoint, confirming that an unfinished
+        issue is only picked up once it has been released, and that only
+        the claim holder can move it on
+        :return: None
+        """
+        with Database(DB) as data:
+            data.add_user('bobby b', EMAIL)
+            data.add_user('jon', 'jon@secret_targ.edu')
+            data.add_search_term(EMAIL, 'WINE')
+            data.add_search_term('jon@secret_targ.edu', 'LANNISTER')
+            data.queue_issues([('issue/1', '2017-01-01')])
+            data.claim_issues('a', 1, lease=60)
+            self.assertTrue(data.complete_issue('issue/1', 'a', '<p>1</p>', 'ONE'))
+            self.assertEqual([], data.claim_unfinished('b', 5, lease=60))
+            self.assertEqual(1, data.release_issues('a'))
+            self.assertEqual([('issue/1', '2017-01-01', 'stored', 'ONE')],
+                             data.claim_unfinished('b', 5, lease=60))
+            hits = [(EMAIL, ['WINE']), ('jon@secret_targ.edu', ['LANNISTER'])]
+            self.assertFalse(data.record_matches('issue/1', 'a', hits))
+            self.assertEqual([], data.get_unsent_alerts('issue/1'))
+            self.assertTrue(data.record_matches('issue/1', 'b', hits))
+            self.assertFalse(data.record_matches('issue/1', 'b', hits))
+            self.assertEqual(hits, data.get_unsent_alerts('issue/1'))
+            data.mark_sent(EMAIL, 'issue/1')
+            self.assertEqual(hits[1:], data.get_unsent_alerts('issue/1'))
+            data.release_issues('b')
+            self.assertEqual([('issue/1', '2017-01-01', 'matched', 'ONE')],
+                             data.claim_unfinished('a', 5, lease=60))
+            self.assertFalse(data.finish_issue('issue/1', 'b'))
+            self.assertTrue(data.finish_issue('issue/1', 'a'))
+            self.assertEqual([], data.claim_unfinished('b', 5, lease=-1))
+            self.assertEqual(0, data.release_issues('a'))
+            self.assertEqual([(1, 1)] * 2, [(scanned, hits) for _, _, _, scanned, hits, _
+                                            in data.get_term_stats()])
+
+    def test_term_stats(self):
+        """
+        Confirms that each issue counts once for every term from when it was
+        added, that hits are counted per term, that removed terms lose their
+        statistics & that counts from before scanned_from are kept
+        :return: None
+        """
+        today = date.today().isoformat()
+        with Database(DB) as data:
+            data.add_user('bobby b', EMAIL)
+            data.add_user('jon', 'jon@secret_targ.edu')
+            for email_address, term in [(EMAIL, 'WINE'), (EMAIL, 'WARHAMMERS'),
+                                        ('jon@secret_targ.edu', 'WINE')]:
+                data.add_search_term(email_address, term)
+            data.record_term_hits({'WINE'})
+            data.record_term_hits({'WINE'})
+            data.record_term_hits(set())
+            stats = data.get_term_stats()
+            self.assertEqual([('WARHAMMERS', 1, today, 3, 0), ('WINE', 2, today, 3, 2)],
+                             [row[:5] for row in stats])
+            self.assertIsNone(stats[0][5])
+            self.assertTrue(stats[1][5].startswith(today))
+            data.add_search_term(EMAIL, 'BEER')
+            data.record_term_hits({'BEER'})
+            self.assertEqual([('WARHAMMERS', 4, 0), ('WINE', 4, 2), ('BEER', 1, 1)],
+                             [(term, scanned, hits) for term, _, _, scanned, hits, _
+                              in data.get_term_stats()])
+            data.remove_search_term(EMAIL, 'BEER')
+            data.cursor.execute("DELETE FROM settings WHERE name = 'issues_scanned'")
+            data.cursor.execute('UPDATE term_stats SET scanned = 6, scanned_from = NULL')
+            data.create_tables()
+            self.assertEqual([6, 6], [row[3] for row in data.get_term_stats()])
+            data.remove_search_term(EMAIL, 'WARHAMMERS')
+            data.cursor.execute('SELECT COUNT(*) FROM term_stats')
+            self.assertEqual((1,), data.cursor.fetchone())
+            data.cursor.execute('DELETE FROM term_stats')
+            data.create_tables()
+            self.assertEqual([('WINE', 2, today, 0, 0, None)], data.get_term_stats())
+
+    def test_hit_history(self):
+        """
+        Records hits for two users, pages through one user's history & checks
+        that the pages are found through the history index
+        :return: None
+        """
+        today = date.today().isoformat()
+        with Database(DB) as data:
+            data.add_user('bobby b', EMAIL)
+            data.add_user('jon', 'jon@secret_targ.edu')
+            for num in range(5):
+                data.add_url_html(f'issue/{num}', issue_date=f'2017-01-0{num + 1}')
+                data.add_user_issue(EMAIL, f'issue/{num}', ['WINE', f'TERM {num}'])
+                data.add_user_issue('jon@secret_targ.edu', f'issue/{num}')
+            data.add_url_html('issue/5', issue_date='2017-01-06')
+            data.cursor.execute('INSERT INTO user_issues(user_id, issue_id) '
+                                'VALUES (1, 6)')
+            first = data.get_hit_history(EMAIL, limit=2)
+            self.assertEqual([(11, 'issue/5', '2017-01-06', None, None),
+                              (9, 'issue/4', '2017-01-05', today, ['WINE', 'TERM 4'])],
+                             first)
+            second = data.get_hit_history(EMAIL, before_id=first[-1][0], limit=2)
+            self.assertEqual(['issue/3', 'issue/2'], [hit[1] for hit in second])
+            last = data.get_hit_history(EMAIL, before_id=second[-1][0], limit=2)
+            self.assertEqual(['issue/1', 'issue/0'], [hit[1] for hit in last])
+            self.assertEqual([], data.get_hit_history(EMAIL, before_id=last[-1][0]))
+            self.assertEqual([], data.get_hit_history('nutty_queen@astapor.net'))
+            data.cursor.execute('EXPLAIN QUERY PLAN SELECT ui.id FROM user_issues ui '
+                                'WHERE ui.user_id = 1 AND ui.id < 9 '
+                                'ORDER BY ui.id DESC LIMIT 2')
+            plan = ' '.join(row[-1] for row in data.cursor.fetchall())
+            self.assertIn('user_issues_history', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+class TestExport(unittest.TestCase):
+    """
+    Tests for Database.export_rows & write_export
+    """
+
+    def setUp(self):
+        """
+        Creates database with a pair of users, their search terms & hits
+        :return: None
+        """
+        with Database(DB) as data:
+            data.create_tables()
+            data.add_user('bobby b', EMAIL)
+            data.add_search_term(EMAIL, 'WINE')
+            data.add_user('jon', 'jon@secret_targ.edu')
+            data.add_search_term('jon@secret_targ.edu', 'WINE')
+            data.add_search_term('jon@secret_targ.edu', 'LANNISTER', max_distance=2)
+            for num in range(1, 4):
+                data.add_url_html(f'issue/{num}', issue_date=f'2017-01-0{num}')
+            data.add_user_issue(EMAIL, 'issue/1', ['WINE'])
+            data.add_user_issue('jon@secret_targ.edu', 'issue/2',
+                                ['WINE', 'LANNISTER'])
+            data.cursor.execute('INSERT INTO user_issues(user_id, issue_id) '
+                                'VALUES (1, 3)')
+            data._connection.commit()
+
+    def tearDown(self):
+        """
+        Deletes database file
+        :return: None
+        """
+        remove_db()
+
+    def test_export_rows(self):
+        """
+        Confirms that each dataset is streamed in id order across batches, and
+        that the id & date watermarks pick up where a previous export ended
+        :return: None
+        """
+        today = date.today().isoformat()
+        with Database(DB) as data:
+            self.assertEqual([{'id': 1, 'name': 'bobby b', 'email_address': EMAIL},
+                              {'id': 2, 'name': 'jon',
+                               'email_address': 'jon@secret_targ.edu'}],
+                             list(data.export_rows('users', batch_size=1)))
+            self.assertEqual([('WINE', None), ('WINE', None), ('LANNISTER', 2)],
+                             [(row['term'], row['max_distance'])
+                              for row in data.export_rows('terms', batch_size=2)])
+            hits = list(data.export_rows('hits', batch_size=2))
+            self.assertEqual({'id': 2, 'name': 'jon',
+                              'email_address': 'jon@secret_targ.edu',
+                              'url': 'issue/2', 'issue_date': '2017-01-02',
+                              'matched_at': today, 'terms': ['WINE', 'LANNISTER'],
+                              'sent': 1},
+                             hits[1])
+            self.assertEqual(['issue/1', 'issue/2', 'issue/3'],
+                             [row['url'] for row in hits])
+            self.assertEqual(['issue/3'], [row['url'] for row in
+                                           data.export_rows('hits', after_id=2)])
+            self.assertEqual(['issue/1', 'issue/2'], [row['url'] for row in
+                                                      data.export_rows('hits', since=today)])
+            with self.assertRaises(ValueError):
+                list(data.export_rows('issues'))
+            with self.assertRaises(ValueError):
+                list(data.export_rows('users', since=today))
+
+    def test_export_unsent(self):
+        """
+        Confirms that hits stop short of the first alert still to be sent,
+        which is exported once sent, & that reprocessed hits are marked so
+        :return: None
+        """
+        with Database(DB) as data:
+            data.cursor.execute('UPDATE user_issues SET sent = 0 WHERE id = 2')
+            data._connection.commit()
+            self.assertEqual([1], [row['id'] for row in data.export_rows('hits')])
+            data.mark_sent('jon@secret_targ.edu', 'issue/2')
+            self.assertEqual([2, 3], [row['id'] for row in
+                                      data.export_rows('hits', after_id=1)])
+            data.add_user_issues([('jon@secret_targ.edu', 'issue/1')])
+            self.assertEqual([(4, 2)], [(row['id'], row['sent']) for row in
+                                        data.export_rows('hits', after_id=3)])
+
+    def test_write_export(self):
+        """
+        Confirms the CSV & JSON Lines output, and that the last id is returned
+        :return: None
+        """
+        rows = [{'id': 1, 'url': 'issue/1', 'terms': ['WINE', 'LANNISTER']},
+                {'id': 4, 'url': 'issue/2', 'terms': None}]
+        output = StringIO()
+        self.assertEqual((2, 4), write_export(iter(rows), output, 'csv'))
+        self.assertEqual('id,url,terms\r\n1,issue/1,WINE; LANNISTER\r\n4,issue/2,\r\n',
+                         output.getvalue())
+        output = StringIO()
+        self.assertEqual((2, 4), write_export(iter(rows), output, 'jsonl'))
+        self.assertEqual(rows, [json.loads(line) for line in
+                                output.getvalue().splitlines()])
+        self.assertEqual((0, None), write_export(iter([]), StringIO(), 'csv'))
+        with self.assertRaises(ValueError):
+            write_export(iter(rows), StringIO(), 'xml')
+
 
 class TestFeed(unittest.TestCase):
     """
@@ -262,7 +743,7 @@ class TestFeed(unittest.TestCase):
         Deletes database file
         :return: None
         """
-        os.remove(DB)
+        remove_db()
 
     def test_users(self):
         """
@@ -281,19 +762,1459 @@ class TestFeed(unittest.TestCase):
 
     def test_text_search(self):
         """
-        Add
+        Confirms that matching a claimed issue records its hits as alerts
+        to send, as refresh does
         :return: None
         """
         with Feed(DB) as feed:
             feed.add_user('bobby b', EMAIL)
             feed.add_search_term(EMAIL, 'WINE')
             feed.add_search_term(EMAIL, 'WARHAMMERS')
-            feed.add_url_html('google.com')
-            for user in feed.users():
-                hits = feed._text_search('WINE and WARHAMMERS', user, 'google.com')
-                self.assertEqual(['WINE', 'WARHAMMERS'], hits)
-            issues = feed.get_user_issues(EMAIL)
-            self.assertEqual(issues, ['google.com'])
+            feed.queue_issues([('google.com', None)])
+            feed.claim_issues(feed.worker, 1, 60)
+            feed.complete_issue('google.com', feed.worker, '', 'WINE and WARHAMMERS')
+            loop = asyncio.new_event_loop()
+            self.addCleanup(loop.close)
+            contexts = loop.run_until_complete(feed._record_matches(
+                'google.com', 'WINE and WARHAMMERS', Matcher(feed.users())))
+            self.assertEqual(['WINE', 'WARHAMMERS'], list(contexts))
+            self.assertEqual([(EMAIL, ['WINE', 'WARHAMMERS'])],
+                             feed.get_unsent_alerts('google.com'))
+            self.assertEqual(['google.com'], feed.get_user_issues(EMAIL))
+
+    def test_matcher_cache(self):
+        """
+        Confirms that the matcher is built once, loaded from the cache file
+        by the next Feed, and built again once the terms or settings change
+        :return: None
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with mock.patch.object(Config, 'matcher_cache', os.path.join(directory, 'matcher')):
+            with Feed(DB) as feed:
+                feed.add_user('bobby b', EMAIL)
+                feed.add_search_term(EMAIL, 'WINE')
+                matcher = feed.matcher()
+                self.assertIs(matcher, feed.matcher())
+            with Feed(DB) as feed, mock.patch('feed.Matcher', side_effect=AssertionError):
+                self.assertEqual(['WINE'], list(feed.matcher().subscribers))
+            with Feed(DB) as feed:
+                feed.add_search_term(EMAIL, 'WARHAMMERS')
+                self.assertEqual(['WINE', 'WARHAMMERS'], list(feed.matcher().subscribers))
+                with mock.patch.object(Config, 'fuzzy_matching', True):
+                    self.assertIsNotNone(feed.matcher().fuzzy_index)
+            with open(Config.matcher_cache, 'wb') as file:
+                file.write(b'garbage')
+            with Feed(DB) as feed:
+                self.assertIsNone(feed.matcher().fuzzy_index)
+
+    def test_alert_batch(self):
+        """
+        Confirms that a batch renders its templates once, greets each user by
+        name & sends every email over a single connection
+        :return: None
+        """
+        users = [User('bobby b', EMAIL, ['WINE']),
+                 User('tyrion <imp>', 'tyrion@casterly_rock.com', ['WINE'])]
+        batch = AlertBatch(users, ['WINE'], URL, {'WINE': [(None, 'WINE v STARK')]})
+        sent = []
+        with mock.patch('feed.render', wraps=render) as rendered, \
+                mock.patch('feed.smtplib.SMTP') as smtp:
+            batch.send(sent)
+        self.assertEqual(2, rendered.call_count)
+        self.assertEqual(1, smtp.call_count)
+        server = smtp.return_value.__enter__.return_value
+        server.login.assert_called_once_with(user=Config.sender, password=Config.pw)
+        self.assertEqual(users, sent)
+        self.assertEqual([EMAIL, 'tyrion@casterly_rock.com'],
+                         [args[1] for args, _ in server.sendmail.call_args_list])
+        messages = [msg for _, msg in batch.messages()]
+        self.assertEqual(users[0]._render_text(['WINE'], URL, batch.contexts),
+                         messages[0].get_payload(0).get_payload())
+        self.assertEqual(users[1]._render_html(['WINE'], URL, batch.contexts),
+                         messages[1].get_payload(1).get_payload())
+        self.assertIn('Dear Tyrion &lt;Imp&gt;,', messages[1].get_payload(1).get_payload())
+        stop, sent = threading.Event(), []
+        with mock.patch('feed.smtplib.SMTP') as smtp:
+            server = smtp.return_value.__enter__.return_value
+            server.sendmail.side_effect = lambda *_: stop.set()
+            batch.send(sent, stop)
+        self.assertEqual(users[:1], sent)
+        self.assertEqual(1, server.sendmail.call_count)
+
+    def test_hit_contexts(self):
+        """
+        Confirms that each hit is quoted under the heading it falls beneath,
+        from the offsets found by the single scan, and that the quotes make
+        it into both parts of the email
+        :return: None
+        """
+        page = (b'<div class="courtRollContent">\n<h3>Outer House</h3>\n'
+                b'<p>1. WINE v STARK</p>\n<h4>Before Lord Tyrion</h4>\n'
+                + b''.join(b'<p>%d. WINE &amp; CO v LANNISTER</p>\n' % num
+                           for num in range(2, 12)) + b'</div>')
+        _, text, headings = Feed._parse_sections(page)
+        self.assertEqual([(0, 'Outer House'), (28, 'Before Lord Tyrion')], headings)
+        bobby = User('bobby b', EMAIL, ['WINE', '"STARK" OR "LANNISTER"'])
+        user_hits, offsets = Matcher([bobby]).locate(text.upper())
+        self.assertEqual([(bobby, ['WINE', '"STARK" OR "LANNISTER"'])], user_hits)
+        self.assertEqual([15, 50, 75], offsets['WINE'][:3])
+        with mock.patch.multiple(Config, snippet_chars=20, snippet_count=2):
+            contexts = hit_contexts(text, offsets, headings)
+        self.assertEqual([('Outer House', 'Outer House 1. WINE v STARK Before...'),
+                          ('Before Lord Tyrion', '...Lord Tyrion 2. WINE & CO v...')],
+                         contexts['WINE'])
+        self.assertEqual(('Outer House', '...House 1. WINE v STARK Before Lord...'),
+                         contexts['"STARK" OR "LANNISTER"'][0])
+        plain = bobby._render_text(['WINE'], URL, contexts)
+        self.assertIn('Before Lord Tyrion: ...Lord Tyrion 2. WINE & CO v...', plain)
+        html = bobby._render_html(['WINE'], URL, contexts)
+        self.assertIn('<b>Before Lord Tyrion</b>: ...Lord Tyrion 2. WINE &amp; CO v...',
+                      html)
+        self.assertNotIn('STARK v', bobby._render_text(['WINE'], URL))
+
+
+class TestMatcher(unittest.TestCase):
+    """
+    Tests for Matcher
+    """
+
+    def test_match(self):
+        """
+        Confirms that shared terms are indexed once and that hits are fanned
+        out to every subscriber, keeping user & term order
+        :return: None
+        """
+        bobby = User('bobby b', EMAIL, ['WINE', 'IRON BANK', 'WARHAMMERS'])
+        jon = User('jon', 'jon@secret_targ.edu', ['IRON BANK', 'GHOST'])
+        dany = User('dany', 'nutty_queen@astapor.net', ['DRAGONS'])
+        matcher = Matcher([bobby, jon, dany])
+        self.assertEqual(5, len(matcher))
+        self.assertEqual([bobby, jon], matcher.subscribers['IRON BANK'])
+        self.assertEqual([(bobby, ['IRON BANK', 'WARHAMMERS']), (jon, ['IRON BANK'])],
+                         matcher.match('WARHAMMERS v THE IRON BANK OF BRAAVOS'))
+        self.assertEqual([], matcher.match('STARK v LANNISTER'))
+
+    def test_fuzzy_match(self):
+        """
+        Confirms that fuzzy matching tolerates spacing, punctuation & typos up
+        to each term's distance, and that exact matching does not
+        :return: None
+        """
+        bobby = User('bobby b', EMAIL, ['MACDONALD & CO', 'IRON BANK OF BRAAVOS',
+                                        'WARHAMMERS', 'WINE'])
+        text = 'MAC-DONALD &CO. v THE IRON BNK OF BRAAVOS, WAR HAMERS & WNE'
+        self.assertEqual([], Matcher([bobby]).match(text))
+        matcher = Matcher([bobby], fuzzy=True, distances={'WARHAMMERS': 0})
+        self.assertEqual([(bobby, ['MACDONALD & CO', 'IRON BANK OF BRAAVOS'])],
+                         matcher.match(text))
+        matcher = Matcher([bobby], fuzzy=True, default_distance=2)
+        self.assertEqual([(bobby, ['MACDONALD & CO', 'IRON BANK OF BRAAVOS',
+                                   'WARHAMMERS'])],
+                         matcher.match(text))
+        self.assertEqual([], matcher.match('IRON BANK OF PENTOS'))
+        self.assertEqual({'IRON BANK OF BRAAVOS': [20, 22], 'WARHAMMERS': [43]},
+                         {term: offsets for term, offsets in matcher.locate(text)[1].items()
+                          if term in ('IRON BANK OF BRAAVOS', 'WARHAMMERS')})
+
+    def test_expressions(self):
+        """
+        Confirms that boolean & proximity expressions are evaluated from a
+        single scan, alongside plain terms sharing their phrases
+        :return: None
+        """
+        bobby = User('bobby b', EMAIL, ['"WINE" AND NOT "WATER"',
+                                        '"IRON BANK" W/3 "BRAAVOS"'])
+        jon = User('jon', 'jon@secret_targ.edu',
+                   ['("GHOST" OR "WINE") AND "WALL"', 'IRON BANK'])
+        matcher = Matcher([bobby, jon])
+        self.assertEqual(6, len(matcher.scanner))
+        self.assertEqual([(bobby, ['"WINE" AND NOT "WATER"',
+                                   '"IRON BANK" W/3 "BRAAVOS"']),
+                          (jon, ['("GHOST" OR "WINE") AND "WALL"', 'IRON BANK'])],
+                         matcher.match('WINE ON THE WALL v IRON BANK OF BRAAVOS'))
+        self.assertEqual([(jon, ['IRON BANK'])],
+                         matcher.match('WINE & WATER v IRON BANK OF THE OLD BRAAVOS'))
+        self.assertEqual([(bobby, ['"IRON BANK" W/3 "BRAAVOS"']), (jon, ['IRON BANK'])],
+                         matcher.match('BRAAVOS v IRONBANK, IRON BANK'))
+
+    def test_locate(self):
+        """
+        Confirms that each term's offsets are those of the phrases it matched
+        on, leaving out negated phrases & alternatives which didn't match
+        :return: None
+        """
+        bobby = User('bobby b', EMAIL, ['"WINE" AND NOT "WATER"', 'IRON BANK',
+                                        '("GHOST" W/1 "WALL") OR "BRAAVOS"'])
+        _, offsets = Matcher([bobby]).locate('WINE, GHOST OF THE WALL v IRON BANK OF BRAAVOS')
+        self.assertEqual({'"WINE" AND NOT "WATER"': [0], 'IRON BANK': [26],
+                          '("GHOST" W/1 "WALL") OR "BRAAVOS"': [39]}, offsets)
+
+    def test_parse(self):
+        """
+        Confirms that plain terms are left as phrases and that invalid
+        expressions raise ValueError
+        :return: None
+        """
+        self.assertEqual({'SMITH AND JONES'}, parse('SMITH AND JONES').phrases())
+        self.assertEqual({'SMITH', 'JONES'},
+                         parse('"SMITH"  and ( "JONES" or NOT "SMITH")').phrases())
+        for term in ['"SMITH" AND', '"SMITH" JONES', '("SMITH"', 'NOT "SMITH"',
+                     '"SMITH" OR NOT "JONES"', '""', '("A" OR "B") W/2 "C"',
+                     '"SMITH" W/0 "JONES"']:
+            with self.assertRaises(ValueError, msg=term):
+                parse(term)
+
+    def test_legacy_terms(self):
+        """
+        Confirms that a stored term which isn't a valid expression is matched
+        as a phrase instead of stopping the matcher being built
+        :return: None
+        """
+        bobby = User('bobby b', EMAIL, ['THE "BIG" BANK', 'WINE'])
+        self.assertEqual([(bobby, ['THE "BIG" BANK', 'WINE'])],
+                         Matcher([bobby]).match('WINE v THE "BIG" BANK'))
+
+    def test_scanner(self):
+        """
+        Confirms that overlapping phrases & phrases inside other phrases are
+        all found, with every offset
+        :return: None
+        """
+        scanner = Scanner(['HE', 'SHE', 'HERS', 'HIS', 'SHEEP'])
+        self.assertEqual({'HE': [1, 8], 'SHE': [0], 'HERS': [8], 'HIS': [4]},
+                         scanner.scan('SHE HIS HERS'))
+
+    def test_prefix_distance(self):
+        """
+        Confirms prefix_distance against a few worked examples
+        :return: None
+        """
+        self.assertEqual(0, prefix_distance('WINE', 'WINERY', 1))
+        self.assertEqual(1, prefix_distance('WINE', 'WNERY', 1))
+        self.assertEqual(1, prefix_distance('WINE', 'WIINE', 1))
+        self.assertEqual(1, prefix_distance('WINE', 'WIME', 2))
+        self.assertEqual(2, prefix_distance('WINE', 'WMNR', 2))
+        self.assertEqual(2, prefix_distance('WINE', 'ALE', 1))
+        self.assertEqual(1, prefix_distance('WINE', 'WIN', 1))
+
+
+class TestRefresh(unittest.TestCase):
+    """
+    Tests for Feed.refresh, with the network and mail server stubbed out
+    """
+    PAGES = {
+        'issue/1': b'<div class="courtRollContent">WINE v WARHAMMERS</div>',
+        'issue/2': b'<div class="courtRollContent">STARK v LANNISTER</div>',
+        'issue/3': b'<div class="courtRollContent">WARHAMMERS v LANNISTER</div>',
+    }
+
+    def setUp(self):
+        """
+        Creates database with a pair of users and their search terms
+        :return: None
+        """
+        with Database(DB) as data:
+            data.create_tables()
+            data.add_user('bobby b', EMAIL)
+            data.add_search_term(EMAIL, 'WINE')
+            data.add_search_term(EMAIL, 'WARHAMMERS')
+            data.add_user('jon', 'jon@secret_targ.edu')
+            data.add_search_term('jon@secret_targ.edu', 'LANNISTER')
+        self.directory = tempfile.mkdtemp()
+        self.metrics_file = os.path.join(self.directory, 'metrics.prom')
+        patch = mock.patch.multiple(Config, metrics_file=self.metrics_file,
+                                    fetch_rate=1000)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        """
+        Deletes database file & metrics
+        :return: None
+        """
+        remove_db()
+        shutil.rmtree(self.directory)
+
+    def run_refresh(self, urls, send_email):
+        """
+        :param urls: list of issue urls present in the feed
+        :param send_email: stands in for sending one alert, see per_recipient
+        :return: None
+        """
+        entries = [Entry(url, url, '2017-10-19') for url in urls]
+        with mock.patch.object(Feed, 'new_entries', return_value=entries), \
+                mock.patch('feed.get', lambda url, **_: FakeResponse(self.PAGES[url])), \
+                mock.patch('feed.AlertBatch.send', per_recipient(send_email)):
+            with Feed(DB) as feed:
+                feed.refresh()
+
+    def test_refresh(self):
+        """
+        Confirms that issues are stored, and alerts recorded & sent, in feed order
+        :return: None
+        """
+        sent, quoted = [], []
+
+        def send(user, hits, url, contexts):
+            sent.append((user.email_address, hits, url))
+            quoted.append(contexts)
+
+        self.run_refresh(sorted(self.PAGES), send)
+        self.assertEqual({'WINE': [(None, 'WINE v WARHAMMERS')],
+                          'WARHAMMERS': [(None, 'WINE v WARHAMMERS')]}, quoted[0])
+        self.assertEqual([(EMAIL, ['WARHAMMERS', 'WINE'], 'issue/1'),
+                          ('jon@secret_targ.edu', ['LANNISTER'], 'issue/2'),
+                          (EMAIL, ['WARHAMMERS'], 'issue/3'),
+                          ('jon@secret_targ.edu', ['LANNISTER'], 'issue/3')], sent)
+        with Database(DB) as data:
+            self.assertEqual(sorted(self.PAGES), data.get_urls())
+            self.assertEqual(['issue/1', 'issue/3'], data.get_user_issues(EMAIL))
+            self.assertEqual(['WINE v WARHAMMERS', 'STARK v LANNISTER',
+                              'WARHAMMERS v LANNISTER'],
+                             [text for _, _, text in data.iter_issues()])
+            self.assertEqual([('WINE', 3, 1), ('LANNISTER', 3, 2), ('WARHAMMERS', 3, 2)],
+                             [(term, scanned, hits) for term, _, _, scanned, hits, _
+                              in data.get_term_stats()])
+
+    def test_feed_unavailable(self):
+        """
+        Confirms that a refresh carries on with queued issues when the feed
+        can't be downloaded, or isn't cached in replay mode
+        :return: None
+        """
+        def get(url, **_):
+            if url not in self.PAGES:
+                raise requests.ConnectionError('Connection refused')
+            return FakeResponse(self.PAGES[url])
+
+        with Database(DB) as data:
+            data.queue_issues([('issue/1', '2017-10-19')])
+        with mock.patch('feed.get', get), \
+                mock.patch('feed.AlertBatch.send', per_recipient(lambda *_: None)), \
+                mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            with Feed(DB) as feed:
+                feed.refresh()
+                self.assertIn('Could not fetch the feed: Connection refused', stdout.getvalue())
+                self.assertEqual(['issue/1'], feed.get_user_issues(EMAIL))
+                with mock.patch.multiple(Config, cache_dir=self.directory, cache_replay=True):
+                    self.assertEqual([], feed.entries())
+
+    def test_replay_alerts(self):
+        """
+        Confirms that a refresh in replay mode records its alerts as sent
+        without mailing them
+        :return: None
+        """
+        def send(user, hits, url, contexts):
+            raise AssertionError('mailed in replay mode')
+
+        with mock.patch.object(Config, 'cache_dir', self.directory):
+            with mock.patch('feed.get', lambda url, **_: FakeResponse(self.PAGES[url])):
+                Feed._fetch('issue/3')
+            with mock.patch.object(Config, 'cache_replay', True), \
+                    mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+                self.run_refresh(['issue/3'], send)
+        self.assertIn('Replaying, not sending alert to jon', stdout.getvalue())
+        with Database(DB) as data:
+            self.assertEqual([], data.get_unsent_alerts('issue/3'))
+            data.cursor.execute("SELECT status FROM issues WHERE url = 'issue/3'")
+            self.assertEqual(('done',), data.cursor.fetchone())
+
+    def test_shared_alerts(self):
+        """
+        Confirms that users with the same hits in an issue are sent their
+        alerts as one batch, split at Config.alert_batch_size
+        :return: None
+        """
+        with Database(DB) as data:
+            for name in ('cersei', 'jaime', 'tyrion'):
+                data.add_user(name, f'{name}@casterly_rock.com')
+                data.add_search_term(f'{name}@casterly_rock.com', 'LANNISTER')
+        batches = []
+
+        def send(batch, sent, stop):
+            batches.append((batch.url, [user.name for user in batch.users]))
+            sent.extend(batch.users)
+
+        entries = [Entry(url, url, '2017-10-19') for url in sorted(self.PAGES)]
+        with mock.patch.object(Feed, 'new_entries', return_value=entries), \
+                mock.patch.object(Config, 'alert_batch_size', 3), \
+                mock.patch('feed.get', lambda url, **_: FakeResponse(self.PAGES[url])), \
+                mock.patch('feed.AlertBatch.send', send):
+            with Feed(DB) as feed:
+                feed.refresh()
+        self.assertEqual([('issue/1', ['bobby b']),
+                          ('issue/2', ['jon', 'cersei', 'jaime']), ('issue/2', ['tyrion']),
+                          ('issue/3', ['bobby b']),
+                          ('issue/3', ['jon', 'cersei', 'jaime']), ('issue/3', ['tyrion'])],
+                         batches)
+        with Database(DB) as data:
+            self.assertEqual([], data.get_unsent_alerts('issue/2'))
+
+    def test_shared_alerts_order(self):
+        """
+        Confirms that users who added the same terms in a different order
+        share a batch, its hits sorted
+        :return: None
+        """
+        with Database(DB) as data:
+            data.add_user('cersei', 'cersei@casterly_rock.com')
+            for term in ('WARHAMMERS', 'WINE'):
+                data.add_search_term('cersei@casterly_rock.com', term)
+        batches = []
+
+        def send(batch, sent, stop):
+            batches.append((batch.hits, [user.name for user in batch.users]))
+            sent.extend(batch.users)
+
+        with mock.patch.object(Feed, 'new_entries',
+                               return_value=[Entry('issue/1', 'issue/1', '2017-10-19')]), \
+                mock.patch('feed.get', lambda url, **_: FakeResponse(self.PAGES[url])), \
+                mock.patch('feed.AlertBatch.send', send):
+            with Feed(DB) as feed:
+                feed.refresh()
+        self.assertEqual([(['WARHAMMERS', 'WINE'], ['bobby b', 'cersei'])], batches)
+
+    def test_batch_timeout(self):
+        """
+        Confirms that a batch which times out stops after the email it is
+        sending, that one being recorded, & the next refresh sends the rest
+        :return: None
+        """
+        with Database(DB) as data:
+            for name in ('cersei', 'jaime'):
+                data.add_user(name, f'{name}@casterly_rock.com')
+                data.add_search_term(f'{name}@casterly_rock.com', 'LANNISTER')
+        sent = []
+
+        def slow_send(user, hits, url, contexts):
+            time.sleep(0.3 if user.name == 'jon' else 0)
+            sent.append((user.name, url))
+
+        with mock.patch.object(Config, 'notify_timeout', 0.05), \
+                self.assertRaises(asyncio.TimeoutError):
+            self.run_refresh(['issue/2'], slow_send)
+        self.assertEqual([('jon', 'issue/2')], sent)
+        self.run_refresh([], slow_send)
+        self.assertEqual([('jon', 'issue/2'), ('cersei', 'issue/2'), ('jaime', 'issue/2')],
+                         sent)
+
+    def test_lease_expires_during_notify(self):
+        """
+        Lets an issue's lease run out while its first alert is sent, then
+        confirms that its other alerts are dropped, & sent once the issue is
+        claimed again, & that a lost claim can't be renewed or record alerts
+        """
+        sent = []
+
+        def send(user, hits, url, contexts):
+            sent.append((user.email_address, url))
+            if len(sent) == 1:
+                with Database(DB) as data:
+                    data.cursor.execute('UPDATE issues SET lease_expires = 0 WHERE url = ?',
+                                        (url,))
+                    data._connection.commit()
+
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            self.run_refresh(['issue/3'], send)
+        self.assertIn('Skipping alerts about issue/3', stdout.getvalue())
+        self.assertEqual([(EMAIL, 'issue/3'), ('jon@secret_targ.edu', 'issue/3')], sent)
+        with Database(DB) as data:
+            data.cursor.execute("SELECT status FROM issues WHERE url = 'issue/3'")
+            self.assertEqual(('done',), data.cursor.fetchone())
+            data.cursor.execute("UPDATE issues SET status = 'matched' WHERE url = 'issue/3'")
+            data.cursor.execute('UPDATE user_issues SET sent = 0')
+            data._connection.commit()
+            self.assertEqual(1, len(data.claim_unfinished('other', 10, 60)))
+            self.assertFalse(data.renew_claim('issue/3', 'mine', 60))
+            self.assertFalse(data.mark_sent(EMAIL, 'issue/3', 'mine'))
+            self.assertTrue(data.renew_claim('issue/3', 'other', 60))
+            self.assertTrue(data.mark_sent(EMAIL, 'issue/3', 'other'))
+
+    def test_metrics(self):
+        """
+        Confirms that a refresh's statistics are written to the metrics file,
+        including those of a refresh which fails while sending mail
+        :return: None
+        """
+        before = {metric.name: metric.value for metric in
+                  (metrics.ISSUES, metrics.HITS, metrics.EMAILS,
+                   metrics.EMAIL_FAILURES, metrics.REFRESH_FAILURES)}
+        self.run_refresh(sorted(self.PAGES), lambda user, hits, url, _: None)
+        samples = read_samples(self.metrics_file)
+        for name, added in [('court_roll_issues_total', 3),
+                            ('court_roll_hits_total', 4),
+                            ('court_roll_emails_total', 4)]:
+            self.assertEqual(before[name] + added, samples[name])
+        self.assertEqual(samples['court_roll_match_seconds_count'],
+                         samples['court_roll_match_seconds_bucket{le="+Inf"}'])
+        self.assertGreaterEqual(samples['court_roll_email_seconds_count'], 4)
+
+        def failing_send(user, hits, url, contexts):
+            raise OSError('mail server down')
+
+        self.PAGES = dict(self.PAGES, **{'issue/4': self.PAGES['issue/1']})
+        with self.assertRaises(OSError):
+            self.run_refresh(['issue/4'], failing_send)
+        samples = read_samples(self.metrics_file)
+        self.assertEqual(before['court_roll_email_failures_total'] + 1,
+                         samples['court_roll_email_failures_total'])
+        self.assertEqual(before['court_roll_refresh_failures_total'] + 1,
+                         samples['court_roll_refresh_failures_total'])
+
+    def test_concurrent_refresh(self):
+        """
+        Runs two overlapping refreshes of the same feed, as two cron runs
+        would, & confirms that each issue is stored & alerted on exactly once
+        :return: None
+        """
+        urls = [f'issue/{num % 3 + 1}?{num}' for num in range(30)]
+        self.PAGES = {url: self.PAGES[url.split('?')[0]] for url in urls}
+        entries = [Entry(url, url, '2017-10-19') for url in urls]
+        sent, errors = [], []
+
+        def slow_send(user, hits, url, contexts):
+            time.sleep(0.001)
+            sent.append((user.email_address, url))
+
+        def refresh():
+            try:
+                with Feed(DB) as feed:
+                    feed.refresh()
+            except Exception as error:
+                errors.append(error)
+
+        with mock.patch.object(Feed, 'new_entries', return_value=entries), \
+                mock.patch.object(Config, 'claim_batch_size', 3), \
+                mock.patch('feed.get', lambda url, **_: FakeResponse(self.PAGES[url])), \
+                mock.patch('feed.AlertBatch.send', per_recipient(slow_send)):
+            threads = [threading.Thread(target=refresh) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(40, len(sent))
+        self.assertEqual(len(sent), len(set(sent)))
+        with Database(DB) as data:
+            self.assertEqual(30, len(list(data.iter_issues())))
+            data.cursor.execute("SELECT COUNT(*) FROM issues WHERE status != 'done'")
+            self.assertEqual((0,), data.cursor.fetchone())
+            self.assertEqual([('WINE', 30, 10), ('LANNISTER', 30, 20),
+                              ('WARHAMMERS', 30, 20)],
+                             [(term, scanned, hits) for term, _, _, scanned, hits, _
+                              in data.get_term_stats()])
+
+    def test_resume(self):
+        """
+        Stops a refresh by failing to send an alert, then confirms that the
+        next refresh sends the remaining alerts, & only those
+        """
+        sent, failures = [], ['mail server down']
+
+        def send(user, hits, url, contexts):
+            if url == 'issue/2' and failures:
+                raise OSError(failures.pop())
+            sent.append((user.email_address, url))
+
+        with self.assertRaises(OSError):
+            self.run_refresh(sorted(self.PAGES), send)
+        self.assertEqual([(EMAIL, 'issue/1')], sent)
+        self.run_refresh([], send)
+        self.assertEqual([(EMAIL, 'issue/1'), ('jon@secret_targ.edu', 'issue/2'),
+                          (EMAIL, 'issue/3'), ('jon@secret_targ.edu', 'issue/3')], sent)
+        with Database(DB) as data:
+            data.cursor.execute("SELECT COUNT(*) FROM issues WHERE status != 'done'")
+            self.assertEqual((0,), data.cursor.fetchone())
+            self.assertEqual([], data.get_unsent_alerts('issue/3'))
+
+    def test_notify_timeout(self):
+        """
+        Confirms that an alert which is sent after Config.notify_timeout has
+        passed is still recorded, so the next refresh doesn't send it again
+        """
+        sent, delays = [], [0.3]
+
+        def slow_send(user, hits, url, contexts):
+            if url == 'issue/2' and delays:
+                time.sleep(delays.pop())
+            sent.append((user.email_address, url))
+
+        with mock.patch.object(Config, 'notify_timeout', 0.1), \
+                self.assertRaises(asyncio.TimeoutError):
+            self.run_refresh(sorted(self.PAGES), slow_send)
+        self.assertEqual([(EMAIL, 'issue/1'), ('jon@secret_targ.edu', 'issue/2')], sent)
+        self.run_refresh([], slow_send)
+        self.assertEqual([(EMAIL, 'issue/1'), ('jon@secret_targ.edu', 'issue/2'),
+                          (EMAIL, 'issue/3'), ('jon@secret_targ.edu', 'issue/3')], sent)
+
+    def test_missing_court_roll(self):
+        """
+        Confirms that a page without a court roll is skipped & left unclaimed,
+        while the rest of the refresh carries on
+        :return: None
+        """
+        self.PAGES = dict(self.PAGES, **{'issue/2': b'<div>Page not found</div>'})
+        sent = []
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            self.run_refresh(sorted(self.PAGES), lambda user, hits, url, _: sent.append(url))
+        self.assertIn('Skipping issue/2: no court roll found', stdout.getvalue())
+        self.assertEqual(['issue/1', 'issue/3', 'issue/3'], sent)
+        with Database(DB) as data:
+            data.cursor.execute("SELECT url, claimed_by FROM issues WHERE status != 'done'")
+            self.assertEqual([('issue/2', None)], data.cursor.fetchall())
+
+    def test_budget(self):
+        """
+        Confirms that a refresh stops once its time budget is spent, that a
+        download taking longer than Config.fetch_timeout is left for later,
+        and that the next refresh finishes the job without repeating any
+        """
+        urls = [f'issue/{num % 3 + 1}?{num}' for num in range(12)]
+        self.PAGES = {url: self.PAGES[url.split('?')[0]] for url in urls}
+        sent = []
+
+        def slow_get(url, **_):
+            time.sleep(0.5 if url == 'issue/1?0' else 0.05)
+            return FakeResponse(self.PAGES[url])
+
+        with mock.patch.multiple(Config, claim_batch_size=3, fetch_timeout=0.25), \
+                mock.patch('feed.get', slow_get), \
+                mock.patch('feed.AlertBatch.send', per_recipient(
+                    lambda user, hits, url, _: sent.append((user.email_address, url)))), \
+                mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            with Feed(DB) as feed, \
+                    mock.patch.object(Feed, 'new_entries', return_value=[
+                        Entry(url, url, '2017-10-19') for url in urls]):
+                feed.refresh(budget=0.5)
+            self.assertIn('Skipping issue/1?0: download took over 0.25 seconds',
+                          stdout.getvalue())
+            self.assertIn('Out of time', stdout.getvalue())
+            with Database(DB) as data:
+                data.cursor.execute("SELECT COUNT(*) FROM issues WHERE status = 'done'")
+                done, = data.cursor.fetchone()
+            self.assertLess(done, 11)
+            with Feed(DB) as feed, mock.patch.object(Feed, 'new_entries', return_value=[]):
+                feed.refresh()
+        self.assertEqual(15, len(sent))
+        self.assertEqual(len(sent), len(set(sent)))
+        with Database(DB) as data:
+            data.cursor.execute("SELECT url FROM issues WHERE status != 'done'")
+            self.assertEqual([('issue/1?0',)], data.cursor.fetchall())
+
+    def test_backpressure(self):
+        """
+        With a slow mail stage, confirms that downloads never run further
+        ahead than the queues between stages & the download window allow
+        :return: None
+        """
+        urls = [f'issue/{num % 3 + 1}?{num}' for num in range(30)]
+        self.PAGES = {url: self.PAGES[url.split('?')[0]] for url in urls}
+        fetched, sent, ahead = [], [], []
+        fetch = Feed._fetch
+
+        def counting_fetch(url):
+            fetched.append(url)
+            ahead.append(len(fetched) - len({url for _, url in sent}))
+            return fetch(url)
+
+        def slow_send(user, hits, url, contexts):
+            time.sleep(0.002)
+            sent.append((user.email_address, url))
+
+        with mock.patch.object(Feed, '_fetch', staticmethod(counting_fetch)):
+            self.run_refresh(urls, slow_send)
+        self.assertEqual(len(urls), len(fetched))
+        self.assertLessEqual(max(ahead), 3 * Config.pipeline_queue_size +
+                             Config.fetch_max_concurrency + 4)
+
+
+class TestReprocess(unittest.TestCase):
+    """
+    Tests for Feed.reprocess
+    """
+
+    def setUp(self):
+        """
+        Creates database with a pair of users and a few stored issues
+        :return: None
+        """
+        with Database(DB) as data:
+            data.create_tables()
+            data.add_user('bobby b', EMAIL)
+            data.add_search_term(EMAIL, 'WINE')
+            data.add_user('jon', 'jon@secret_targ.edu')
+            data.add_search_term('jon@secret_targ.edu', 'LANNISTER')
+            for num, (text, issue_date) in enumerate(
+                    [('WINE v WARHAMMERS', '2017-01-10'),
+                     ('STARK v LANNISTER', '2017-02-10'),
+                     ('WINE v LANNISTER', '2017-03-10')], 1):
+                html = f'<div class="courtRollContent">{text}</div>'
+                data.add_url_html(f'issue/{num}', html, issue_date)
+            data.add_url_html('issue/4')
+
+    def tearDown(self):
+        """
+        Deletes database file
+        :return: None
+        """
+        remove_db()
+
+    def test_reprocess(self):
+        """
+        Confirms that a dry run writes nothing, that a real run records every
+        hit, and that running again records nothing new
+        :return: None
+        """
+        with Feed(DB) as feed:
+            feed.add_user_issue(EMAIL, 'issue/1')
+            report = feed.reprocess(dry_run=True, workers=1)
+            self.assertEqual(3, report['issues'])
+            self.assertEqual(4, report['hits'])
+            self.assertEqual([('jon@secret_targ.edu', 'issue/2'),
+                              (EMAIL, 'issue/3'),
+                              ('jon@secret_targ.edu', 'issue/3')], report['new'])
+            self.assertEqual(['issue/1'], feed.get_user_issues(EMAIL))
+            self.assertEqual(3, len(feed.reprocess(workers=2)['new']))
+            self.assertEqual(['issue/1', 'issue/3'], feed.get_user_issues(EMAIL))
+            self.assertEqual([], feed.reprocess(workers=1)['new'])
+
+    def test_backfill_text(self):
+        """
+        Confirms that search text is backfilled for stored issues, compressed
+        or not, and is then used instead of the html
+        :return: None
+        """
+        with Feed(DB) as feed:
+            with mock.patch.object(Config, 'compress_text', False):
+                feed.set_issue_texts([(1, 'WINE v WARHAMMERS')])
+            self.assertEqual(2, feed.backfill_text(batch_size=1))
+            self.assertEqual(0, feed.backfill_text())
+            feed.storage.cursor.execute('SELECT text FROM issues ORDER BY id')
+            stored = [row[0] for row in feed.storage.cursor.fetchall()]
+            self.assertEqual('WINE v WARHAMMERS', stored[0])
+            self.assertIsInstance(stored[1], bytes)
+            self.assertIsNone(stored[3])
+            self.assertEqual([('issue/1', 'WINE v WARHAMMERS'),
+                              ('issue/2', 'STARK v LANNISTER'),
+                              ('issue/3', 'WINE v LANNISTER')],
+                             [(url, text) for url, _, text in feed.iter_issues()])
+            with mock.patch.object(Feed, '_parse', side_effect=AssertionError):
+                self.assertEqual(4, len(feed.reprocess(workers=1)['new']))
+
+    def test_filters(self):
+        """
+        Confirms that issues can be narrowed down by date & url
+        :return: None
+        """
+        with Feed(DB) as feed:
+            report = feed.reprocess(since='2017-02-01', until='2017-02-28',
+                                    dry_run=True, workers=1)
+            self.assertEqual([('jon@secret_targ.edu', 'issue/2')], report['new'])
+            report = feed.reprocess(url='issue/3', dry_run=True, workers=1)
+            self.assertEqual(1, report['issues'])
+
+
+class TestDownloader(unittest.TestCase):
+    """
+    Tests for Feed's page download & parsing
+    """
+
+    def test_downloader(self):
+        """
+        Confirms that the court roll section is extracted and that the request
+        is streamed with both timeouts set
+        :return: None
+        """
+        with mock.patch('feed.get', return_value=FakeResponse(roll_page(3))) as get:
+            html, text = Feed._downloader(URL)
+        get.assert_called_once_with(URL, stream=True,
+                                    timeout=(Config.connect_timeout,
+                                             Config.read_timeout),
+                                    headers={})
+        self.assertIn('courtRollContent', html)
+        self.assertIn('THE IRON BANK OF BRAAVOS (A2/17)', text)
+        self.assertNotIn('Court of Session', text)
+
+    def test_size_cap(self):
+        """
+        Confirms that pages over the byte cap raise ValueError, whether or not
+        the server sends a Content-Length header
+        :return: None
+        """
+        page = roll_page(100)
+        with mock.patch.object(Config, 'max_page_bytes', len(page) - 1):
+            with mock.patch('feed.get', return_value=FakeResponse(page)):
+                with self.assertRaises(ValueError):
+                    Feed._downloader(URL)
+            headers = {'Content-Length': str(len(page))}
+            with mock.patch('feed.get', return_value=FakeResponse(page, headers)):
+                with self.assertRaises(ValueError):
+                    Feed._downloader(URL)
+
+    def test_peak_memory(self):
+        """
+        Reports the peak memory used to download & parse a single issue, and
+        confirms that it stays within a fixed multiple of the page size
+        :return: None
+        """
+        page = roll_page(5000)
+        with mock.patch('feed.get', return_value=FakeResponse(page)):
+            tracemalloc.start()
+            try:
+                Feed._downloader(URL)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        print(f'\nPeak memory per issue: {peak / 1024:.0f} KiB '
+              f'for a {len(page) / 1024:.0f} KiB page')
+        self.assertLess(peak, len(page) * 40)
+
+
+class TestMaintenance(unittest.TestCase):
+    """
+    Tests for the retention policy & compaction
+    """
+
+    def setUp(self):
+        """
+        Creates database with a user, a hit & a mix of old and new issues
+        :return: None
+        """
+        self.directory = tempfile.mkdtemp()
+        with Database(DB) as data:
+            data.create_tables()
+            data.add_user('bobby b', EMAIL)
+            for num, issue_date in enumerate(['2017-01-10', '2017-01-20',
+                                              '2017-02-10'], 1):
+                data.add_url_html(f'issue/{num}', 'x' * 100000, issue_date,
+                                  f'WINE v {num}')
+            data.add_url_html('issue/4', '<p>new</p>', text='WINE v 4')
+            data.add_user_issue(EMAIL, 'issue/1')
+
+    def tearDown(self):
+        """
+        Deletes database file & archives
+        :return: None
+        """
+        remove_db()
+        shutil.rmtree(self.directory)
+
+    def test_retention_cutoff(self):
+        self.assertEqual('2025-12-01', retention_cutoff(3, date(2026, 3, 19)))
+        self.assertEqual('2026-03-01', retention_cutoff(0, date(2026, 3, 19)))
+
+    def test_maintain(self):
+        """
+        Confirms that old issues are archived by month & their bodies removed,
+        that urls & hits are kept, and that the freed space is given back
+        :return: None
+        """
+        with Feed(DB) as feed:
+            feed.storage.cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            size = os.path.getsize(DB)
+            report = feed.maintain(months=1, directory=self.directory, batch_size=2)
+            self.assertEqual(3, report['archived'])
+            self.assertEqual([archive_path(self.directory, '2017-01'),
+                              archive_path(self.directory, '2017-02')], report['files'])
+            self.assertEqual([{'url': 'issue/1', 'date': '2017-01-10',
+                               'html': 'x' * 100000, 'text': 'WINE v 1'},
+                              {'url': 'issue/2', 'date': '2017-01-20',
+                               'html': 'x' * 100000, 'text': 'WINE v 2'}],
+                             list(read_issues(report['files'][0])))
+            self.assertEqual(['issue/1', 'issue/2', 'issue/3', 'issue/4'],
+                             feed.get_urls())
+            self.assertEqual(['issue/1'], feed.get_user_issues(EMAIL))
+            self.assertEqual(['issue/4'], [url for url, _, _ in feed.iter_issues()])
+            self.assertGreater(report['pages'], 0)
+            feed.storage.cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.assertLess(os.path.getsize(DB), size / 2)
+            report = feed.maintain(months=1, directory=self.directory)
+            self.assertEqual(0, report['archived'])
+            feed.storage.cursor.execute('PRAGMA auto_vacuum')
+            self.assertEqual(2, feed.storage.cursor.fetchone()[0])
+
+    def test_legacy_database(self):
+        """
+        Confirms that undated issues are archived, and that a database
+        created before incremental vacuuming is only rebuilt when asked to &
+        no refresh holds a claim
+        :return: None
+        """
+        with Database(DB) as data:
+            data.cursor.execute("INSERT INTO issues(url, date, html, text, status, "
+                                "claimed_by, lease_expires) VALUES ('issue/5', ?, 'y', "
+                                "'WINE v 5', 'stored', 'worker', ?)",
+                                (date.today().isoformat(), time.time() + 60))
+            data.cursor.execute('UPDATE issues SET date = NULL WHERE url = ?', ('issue/1',))
+            data._connection.commit()
+            data.cursor.execute('PRAGMA auto_vacuum = NONE')
+            data.cursor.execute('VACUUM')
+        with Feed(DB) as feed:
+            report = feed.maintain(months=1, directory=self.directory)
+            self.assertEqual(3, report['archived'])
+            self.assertIn(archive_path(self.directory, 'undated'), report['files'])
+            self.assertIsNone(report['pages'])
+            self.assertIsNone(feed.compact(full=True))
+            feed.release_issues('worker')
+            self.assertIsNotNone(feed.compact(full=True))
+            feed.storage.cursor.execute('PRAGMA auto_vacuum')
+            self.assertEqual(2, feed.storage.cursor.fetchone()[0])
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Tests for the metrics registry
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'metrics.prom')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def registry():
+        """
+        :return: 3-tuple, Registry obj with a counter & a histogram
+        """
+        registry = Registry()
+        return (registry, registry.counter('runs_total', 'Runs'),
+                registry.histogram('run_seconds', 'Run time', [0.1, 1]))
+
+    def test_render(self):
+        registry, runs, seconds = self.registry()
+        runs.inc()
+        for value in (0.05, 0.5, 0.7, 3):
+            seconds.observe(value)
+        self.assertEqual('# HELP runs_total Runs\n'
+                         '# TYPE runs_total counter\n'
+                         'runs_total 1\n'
+                         '# HELP run_seconds Run time\n'
+                         '# TYPE run_seconds histogram\n'
+                         'run_seconds_bucket{le="0.1"} 1\n'
+                         'run_seconds_bucket{le="1.0"} 3\n'
+                         'run_seconds_bucket{le="+Inf"} 4\n'
+                         'run_seconds_sum 4.25\n'
+                         'run_seconds_count 4\n', registry.render())
+
+    def test_write(self):
+        """
+        Confirms that a new process carries on counting from the totals in the
+        file left by the previous one
+        :return: None
+        """
+        for _ in range(2):
+            registry, runs, seconds = self.registry()
+            runs.inc()
+            seconds.observe(0.5)
+            registry.write(self.path)
+            runs.inc()
+            registry.write(self.path)
+        samples = read_samples(self.path)
+        self.assertEqual(4, samples['runs_total'])
+        self.assertEqual(2, samples['run_seconds_count'])
+        self.assertEqual(0, samples['run_seconds_bucket{le="0.1"}'])
+        self.assertEqual(2, samples['run_seconds_bucket{le="1.0"}'])
+        self.assertEqual(['metrics.prom'], os.listdir(self.directory))
+
+    def test_write_fails(self):
+        """
+        Confirms that a write which fails part way leaves the previous file
+        as it was, & no temporary file behind
+        :return: None
+        """
+        registry, runs, _ = self.registry()
+        runs.inc()
+        registry.write(self.path)
+        with open(self.path) as file:
+            before = file.read()
+        runs.inc()
+        with mock.patch.object(registry, 'render', side_effect=OSError('disk full')), \
+                self.assertRaises(OSError):
+            registry.write(self.path)
+        with open(self.path) as file:
+            self.assertEqual(before, file.read())
+        self.assertEqual(['metrics.prom'], os.listdir(self.directory))
+
+    def test_serve(self):
+        registry, runs, _ = self.registry()
+        runs.inc(5)
+        server = registry.serve(0)
+        try:
+            url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+            with urlopen(url) as response:
+                self.assertIn('runs_total 5\n', response.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestCache(unittest.TestCase):
+    """
+    Tests for ResponseCache & its use by Feed._fetch
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        patch = mock.patch.multiple(Config, cache_dir=self.directory,
+                                    cache_max_bytes=1024 * 1024, cache_replay=False)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_revalidate(self):
+        """
+        Confirms that a cached page is revalidated with its ETag, and served
+        from the cache when the server says it hasn't changed
+        :return: None
+        """
+        page = roll_page(3)
+        response = FakeResponse(page, {'ETag': '"v1"'})
+        with mock.patch('feed.get', return_value=response):
+            self.assertEqual(page, Feed._fetch(URL))
+        with mock.patch('feed.get', return_value=FakeResponse(b'', status_code=304)) as get:
+            self.assertEqual(page, Feed._fetch(URL))
+        self.assertEqual({'If-None-Match': '"v1"'}, get.call_args[1]['headers'])
+        with mock.patch('feed.get', return_value=FakeResponse(b'changed')):
+            self.assertEqual(b'changed', Feed._fetch(URL))
+        self.assertEqual(b'changed', ResponseCache(self.directory, 1024).get(URL))
+
+    def test_replay(self):
+        """
+        Confirms that replay mode never touches the network, and skips pages
+        which aren't cached
+        :return: None
+        """
+        with mock.patch('feed.get', return_value=FakeResponse(roll_page(3))):
+            Feed._fetch(URL)
+        with mock.patch.object(Config, 'cache_replay', True), \
+                mock.patch('feed.get', side_effect=AssertionError) as get:
+            html, text = Feed._downloader(URL)
+            self.assertIn('THE IRON BANK OF BRAAVOS (A2/17)', text)
+            with self.assertRaises(ValueError):
+                Feed._fetch('www.bobby-b.com/not_cached.html')
+        get.assert_not_called()
+
+    def test_evict(self):
+        """
+        Fills the cache past its limit & confirms the least recently used
+        page is the one evicted
+        :return: None
+        """
+        cache = ResponseCache(self.directory, 250)
+        for num, url in enumerate(['a', 'b', 'c']):
+            cache.put(url, b'x' * 100, {})
+            os.utime(cache._path(url) + '.body', (num, num))
+        self.assertEqual(['b', 'c'], [url for url in 'abc' if cache.get(url)])
+        os.utime(cache._path('b') + '.body', (10, 10))
+        cache.put('d', b'x' * 100, {'Last-Modified': 'Thu, 19 Oct 2017 00:00:00 GMT'})
+        self.assertEqual(['c', 'd'], [url for url in 'abcd' if cache.get(url)])
+        self.assertEqual({'If-Modified-Since': 'Thu, 19 Oct 2017 00:00:00 GMT'},
+                         cache.validators('d'))
+        self.assertEqual(4, len(os.listdir(self.directory)))
+
+    def test_evict_over_limit(self):
+        """
+        Confirms that the directory is only listed when a page takes the
+        cache over its limit, and that replacing a page counts its new size
+        :return: None
+        """
+        cache = ResponseCache(self.directory, 250)
+        with mock.patch('cache.os.scandir', side_effect=os.scandir) as scandir:
+            for url in ['a', 'b', 'a', 'b']:
+                cache.put(url, b'x' * 100, {})
+            self.assertEqual(1, scandir.call_count)
+            cache.put('a', b'x' * 150, {})
+            self.assertEqual(1, scandir.call_count)
+            cache.put('c', b'x' * 100, {})
+            self.assertEqual(2, scandir.call_count)
+        self.assertEqual(1, [cache.get(url) for url in 'abc'].count(None))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves court roll pages like the court website, except that it answers
+    429 once more than throttle_above requests are in flight, 503 for
+    /broken, and takes slow_delay seconds per request after the first
+    slow_after requests
+    """
+    lock = threading.Lock()
+    active = peak = requests = throttled = 0
+    throttle_above = None
+    slow_after = None
+    slow_delay = 0.2
+
+    def do_GET(self):
+        handler = StandInHandler
+        with handler.lock:
+            handler.active += 1
+            handler.requests += 1
+            handler.peak = max(handler.peak, handler.active)
+            throttle = (handler.throttle_above is not None and
+                        handler.active > handler.throttle_above)
+            slow = handler.slow_after is not None and handler.requests > handler.slow_after
+            handler.throttled += throttle
+        try:
+            time.sleep(handler.slow_delay if slow else 0.005)
+            if throttle or self.path == '/broken':
+                self.send_response(429 if throttle else 503)
+                self.send_header('Retry-After', '0')
+                self.end_headers()
+                return
+            body = roll_page(3)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with handler.lock:
+                handler.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestThrottle(unittest.TestCase):
+    """
+    Tests for FetchController, against a local stand-in for the court website
+    """
+
+    def setUp(self):
+        for name, value in [('active', 0), ('peak', 0), ('requests', 0),
+                            ('throttled', 0), ('throttle_above', None),
+                            ('slow_after', None)]:
+            setattr(StandInHandler, name, value)
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f'http://127.0.0.1:{self.server.server_address[1]}'
+        patch = mock.patch.multiple(Config, fetch_rate=1000, fetch_burst=1000,
+                                    fetch_max_concurrency=4, fetch_retries=10,
+                                    fetch_backoff=0.01)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fetch_all(self, paths):
+        """
+        :param paths: list of str
+        :return: 2-tuple, the host's HostLimiter & the results, pages or
+        exceptions
+        """
+        async def run():
+            controller = FetchController()
+            results = await asyncio.gather(
+                *(controller.fetch(Feed._fetch, self.base + path) for path in paths),
+                return_exceptions=True)
+            return controller.limiter(self.base), results
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_ramp_up(self):
+        """
+        Confirms that a server which keeps up gets more connections, but
+        never more than fetch_max_concurrency
+        :return: None
+        """
+        limiter, results = self.fetch_all([f'/issue/{num}' for num in range(40)])
+        self.assertTrue(all(result == roll_page(3) for result in results))
+        self.assertEqual(4, limiter.limit)
+        self.assertGreater(StandInHandler.peak, 1)
+        self.assertLessEqual(StandInHandler.peak, 4)
+
+    def test_throttled(self):
+        """
+        Confirms that 429 responses are retried and bring the number of
+        connections down to what the server allows
+        :return: None
+        """
+        StandInHandler.throttle_above = 2
+        throttled = metrics.FETCH_THROTTLED.value
+        _, results = self.fetch_all([f'/issue/{num}' for num in range(40)])
+        self.assertTrue(all(result == roll_page(3) for result in results))
+        self.assertGreater(StandInHandler.throttled, 0)
+        self.assertLess(StandInHandler.throttled, 20)
+        self.assertGreater(metrics.FETCH_THROTTLED.value, throttled)
+
+    def test_slowdown(self):
+        """
+        Confirms that connections are cut back when the server slows down
+        :return: None
+        """
+        StandInHandler.slow_after = 20
+        limiter, results = self.fetch_all([f'/issue/{num}' for num in range(30)])
+        self.assertTrue(all(result == roll_page(3) for result in results))
+        self.assertEqual(1, limiter.limit)
+
+    def test_give_up(self):
+        """
+        Confirms that a failing page is retried fetch_retries times, then
+        raises, without holding up other pages
+        :return: None
+        """
+        with mock.patch.object(Config, 'fetch_retries', 2):
+            _, results = self.fetch_all(['/broken', '/issue/1'])
+        self.assertIsInstance(results[0], requests.HTTPError)
+        self.assertEqual(roll_page(3), results[1])
+        self.assertEqual(4, StandInHandler.requests)
+
+    def test_limit(self):
+        """
+        Confirms that the limit grows by one per limit's worth of fast
+        responses, and that congestion halves it once per generation
+        :return: None
+        """
+        async def run():
+            limiter = HostLimiter(asyncio.get_event_loop())
+            limits = []
+            for _ in range(4):
+                await limiter.release(await limiter.acquire(), 0.1)
+                limits.append(limiter.limit)
+            first, second = await limiter.acquire(), await limiter.acquire()
+            for generation in (first, second):
+                await limiter.release(generation, 0.1, congested=True)
+                limits.append(limiter.limit)
+            await limiter.release(await limiter.acquire(), 0.5)
+            limits.append(limiter.limit)
+            return limits
+
+        loop = asyncio.new_event_loop()
+        try:
+            limits = loop.run_until_complete(run())
+        finally:
+            loop.close()
+        self.assertEqual([2, 2.5, 2.9, 3.2448, 1.6224, 1.6224, 1],
+                         [round(limit, 4) for limit in limits])
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, burst=2)
+        self.assertEqual([0, 0, 0.5, 1.0], [bucket.reserve(0) for _ in range(4)])
+        self.assertEqual([0, 0, 0.5], [bucket.reserve(2.0) for _ in range(3)])
+
+
+class TestRss(unittest.TestCase):
+    """
+    Tests for the feed parser
+    """
+    RSS = b"""<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom"><channel>
+<title>Court Rolls</title><link>https://www.scotcourts.gov.uk</link>
+<atom:link href="https://www.scotcourts.gov.uk/feed" rel="self"/>
+<item><title>Rolls 2</title><link> https://example.com/issue/2 </link>
+<guid isPermaLink="false">2</guid><pubDate>Fri, 20 Oct 2017 00:00:00 GMT</pubDate></item>
+<item><title>Rolls 1</title><link>https://example.com/issue/1</link></item>
+</channel></rss>"""
+    ATOM = b"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>Court Rolls</title>
+<entry><id>urn:1</id><link rel="self" href="https://example.com/self/1"/>
+<link href="https://example.com/issue/1"/><updated>2017-10-19T09:00:00Z</updated></entry>
+</feed>"""
+
+    def test_rss(self):
+        self.assertEqual([Entry('https://example.com/issue/2', '2', '2017-10-20'),
+                          Entry('https://example.com/issue/1',
+                                'https://example.com/issue/1', None)],
+                         parse_feed(self.RSS))
+
+    def test_atom(self):
+        self.assertEqual([Entry('https://example.com/issue/1', 'urn:1', '2017-10-19')],
+                         parse_feed(self.ATOM))
+
+    def test_malformed(self):
+        """
+        Confirms that documents which aren't well formed XML are handed to
+        feedparser
+        :return: None
+        """
+        content = self.RSS.replace(b'Rolls 1', b'Rolls & 1')
+        with self.assertRaises(ParseError):
+            list(iterparse(BytesIO(content)))
+        self.assertEqual(['https://example.com/issue/2', 'https://example.com/issue/1'],
+                         [entry.link for entry in parse_feed(content)])
+
+
+class TestManager(unittest.TestCase):
+    """
+    Tests for manager.py's menu loop & Session
+    """
+
+    def setUp(self):
+        self.session = Session(DB)
+        self.session.feed.create_tables()
+        patcher = mock.patch('manager.clear_screen')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.session.close()
+        remove_db()
+
+    def run_menus(self, *answers):
+        """
+        Runs the menus from the main menu, answering each input() in turn
+        :return: str, everything printed
+        """
+        with mock.patch('builtins.input', side_effect=answers), \
+                mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            manager.run(self.session)
+        return stdout.getvalue()
+
+    def test_loop(self):
+        """
+        Confirms that going back & forth between menus more times than the
+        recursion limit doesn't build up the stack
+        :return: None
+        """
+        self.run_menus(*['2', '5'] * 2000, '2', '2', 'Bobby B', EMAIL.upper(),
+                       '5', '3', '1', '2', 'warhammers', '6', '4')
+        self.assertEqual([('Bobby B', EMAIL)], self.session.feed.get_users())
+        self.assertEqual(['WARHAMMERS'], self.session.feed.get_search_terms(EMAIL))
+
+    def test_cache(self):
+        """
+        Confirms that users & terms are only read again after a write
+        :return: None
+        """
+        feed = self.session.feed
+        feed.add_user('Bobby B', EMAIL)
+        with mock.patch.object(feed, 'get_users', wraps=feed.get_users) as get_users, \
+                mock.patch.object(feed, 'get_search_terms',
+                                  wraps=feed.get_search_terms) as get_terms:
+            self.assertEqual(self.session.users, self.session.users)
+            self.assertEqual([], self.session.terms(EMAIL))
+            self.session.terms(EMAIL)
+            self.assertEqual((1, 1), (get_users.call_count, get_terms.call_count))
+            self.session.add_search_term(EMAIL, 'WINE')
+            self.session.add_user('Jon Snow', 'jon@thewall.com')
+            self.assertEqual(['WINE'], self.session.terms(EMAIL))
+            self.assertEqual(2, len(self.session.users))
+            self.session.remove_user(EMAIL)
+            self.assertEqual(['jon@thewall.com'],
+                             [email_address for _, email_address in self.session.users])
+            self.assertEqual((3, 2), (get_users.call_count, get_terms.call_count))
+
+    def test_pages(self):
+        """
+        Confirms that users are listed a page at a time, and that a user on a
+        later page can be removed
+        :return: None
+        """
+        for num in range(45):
+            self.session.feed.add_user(f'User {num}', f'user{num}@example.com')
+        with mock.patch.object(Config, 'menu_page_size', 20):
+            output = self.run_menus('2', '4', 'n', 'n', 'n', 'p', '45', '5', '4')
+        self.assertIn('Users (page 3 of 3)', output)
+        self.assertIn('45) User 44 - user44@example.com', output)
+        self.assertNotIn('21) User 20', output.split('Users (page 2 of 3)')[0])
+        self.assertEqual(44, len(self.session.users))
+        self.assertNotIn(('User 44', 'user44@example.com'), self.session.feed.get_users())
+
+
+class TestMemoryBackend(unittest.TestCase):
+    """
+    Tests for MemoryBackend, checked against Database
+    """
+
+    def tearDown(self):
+        remove_db()
+
+    @staticmethod
+    def exercise(backend):
+        """
+        Runs the same calls against a backend
+        :param backend: Backend obj
+        :return: list of everything returned
+        """
+        results = []
+        backend.create_tables()
+        backend.add_user('bobby b', EMAIL)
+        backend.add_user('jon', 'jon@secret_targ.edu')
+        for call, args in ((backend.add_user, ('bobby b', EMAIL)),
+                           (backend.add_search_term, (EMAIL, '"WINE" AND ('))):
+            try:
+                call(*args)
+            except (sqlite3.IntegrityError, ValueError) as error:
+                results.append(type(error).__name__)
+        backend.add_search_term(EMAIL, 'WINE')
+        backend.add_search_term(EMAIL, 'WARHAMMERS', max_distance=2)
+        backend.add_search_term('jon@secret_targ.edu', 'WINE')
+        backend.add_search_term('nobody@example.com', 'GHOST')
+        backend.add_url_html(URL, '<p>old</p>', '2017-01-01', 'OLD')
+        backend.queue_issues([('issue/1', '2017-10-19'), ('issue/2', None), (URL, None)])
+        results.append(backend.claim_issues('a', 1, lease=-1))
+        results.append(backend.claim_issues('b', 5, lease=60))
+        results.append(backend.complete_issue('issue/1', 'a', '<p>1</p>', 'ONE'))
+        results.append(backend.complete_issue('issue/1', 'b', '<p>1</p>', 'ONE'))
+        results.append(backend.release_issues('b'))
+        results.append(backend.claim_unfinished('a', 5, lease=60))
+        results.append(backend.record_matches('issue/1', 'a', [(EMAIL, ['WINE'])]))
+        results.append(backend.get_unsent_alerts('issue/1'))
+        backend.mark_sent(EMAIL, 'issue/1')
+        results.append(backend.get_unsent_alerts('issue/1'))
+        results.append(backend.finish_issue('issue/1', 'a'))
+        backend.add_user_issue(EMAIL, 'issue/1', ['WINE'])
+        for args in ((EMAIL, 'issue/9'), ('nobody@example.com', 'issue/1')):
+            try:
+                backend.add_user_issue(*args)
+            except ValueError as error:
+                results.append(str(error))
+        results.append(backend.new_user_issues([(EMAIL, 'issue/1'), (EMAIL, URL)]))
+        results.append(backend.add_user_issues([(EMAIL, URL, ['WINE']), (EMAIL, 'issue/1'),
+                                                ('jon@secret_targ.edu', URL)]))
+        backend.record_term_hits({'WINE'})
+        backend.remove_search_term(EMAIL, 'WARHAMMERS')
+        backend.remove_user('jon@secret_targ.edu')
+        results.extend([backend.get_users(), backend.get_subscriptions(),
+                        backend.get_search_terms(EMAIL), backend.get_term_distances(),
+                        [row[:5] for row in backend.get_term_stats()],
+                        sorted(backend.get_urls()), list(backend.iter_issues()),
+                        list(backend.iter_issues(since='2017-06-01', url='issue')),
+                        backend.get_user_issues(EMAIL),
+                        backend.get_user_issues('jon@secret_targ.edu')])
+        backend.close()
+        return results
+
+    def test_matches_database(self):
+        self.assertEqual(self.exercise(Database(DB)), self.exercise(MemoryBackend()))
+
+    def test_refresh(self):
+        """
+        Refreshes a large feed with nothing written to disk
+        :return: None
+        """
+        backend = MemoryBackend()
+        backend.add_user('bobby b', EMAIL)
+        backend.add_search_term(EMAIL, 'WINE')
+        entries = [Entry(f'issue/{num}', f'issue/{num}', '2017-10-19') for num in range(300)]
+        sent = []
+        with mock.patch.object(Feed, 'new_entries', return_value=entries), \
+                mock.patch.multiple(Config, metrics_file=None, fetch_rate=1e6,
+                                    fetch_burst=1000, claim_batch_size=100), \
+                mock.patch('feed.get', lambda url, **_: FakeResponse(
+                    TestRefresh.PAGES['issue/1' if url.endswith('0') else 'issue/2'])), \
+                mock.patch('feed.AlertBatch.send',
+                           per_recipient(lambda user, hits, url, _: sent.append(url))):
+            with Feed(backend) as feed:
+                feed.refresh()
+        self.assertEqual([f'issue/{num}' for num in range(0, 300, 10)], sent)
+        self.assertEqual(sent, backend.get_user_issues(EMAIL))
+        self.assertEqual(300, len(list(backend.iter_issues())))
+        self.assertFalse(os.path.exists(DB))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,194 @@
+"""
+This module contains FetchController, which decides how many downloads may
+run at once against each host, and how quickly they may start.  Each host
+gets a token bucket, limiting the request rate, and a concurrency limit which
+grows by about one for every limit's worth of fast responses and is halved
+whenever the server answers 429 or 5xx, times out, or responds much more
+slowly than the fastest response seen so far.
+"""
+import asyncio
+from urllib.parse import urlsplit
+
+from requests.exceptions import HTTPError, Timeout
+
+from configuration import Config
+import metrics
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, in bursts of up to burst
+    """
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: float, tokens added per second
+        :param burst: int, most tokens the bucket holds
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = None
+
+    def reserve(self, now):
+        """
+        Takes a token, going into debt if there are none left, so that
+        requests queue up in the order they asked
+        :param now: float, current time in seconds
+        :return: float, seconds to wait before using the token
+        """
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class HostLimiter:
+    """
+    Additive increase, multiplicative decrease concurrency limit & token
+    bucket for a single host.  Must be used from one event loop.
+    """
+
+    def __init__(self, loop):
+        """
+        :param loop: asyncio event loop
+        """
+        self.loop = loop
+        self.limit = 1.0
+        self.in_flight = 0
+        self.fastest = None
+        self.paused_until = 0
+        self.generation = 0  # Bumped on each decrease, see release
+        self.bucket = TokenBucket(Config.fetch_rate, Config.fetch_burst)
+        self._condition = asyncio.Condition()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(limit={self.limit:.2f}, '
+                f'in_flight={self.in_flight})')
+
+    async def acquire(self):
+        """
+        Waits for a free connection, the end of any pause & a token
+        :return: int, generation at the time, to be passed to release
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        try:
+            while self.loop.time() < self.paused_until:
+                await asyncio.sleep(self.paused_until - self.loop.time())
+            await asyncio.sleep(self.bucket.reserve(self.loop.time()))
+        except BaseException:
+            await self._free()
+            raise
+        return self.generation
+
+    async def release(self, generation, latency, congested=False, pause=0):
+        """
+        :param generation: int, returned by acquire
+        :param latency: float, seconds the request took
+        :param congested: bool, the server throttled, failed or timed out
+        :param pause: float, seconds to stop sending requests for
+        :return: None
+        """
+        slow = (self.fastest is not None and
+                latency > Config.fetch_slow_factor * max(self.fastest, 0.01))
+        if not congested:
+            self.fastest = latency if self.fastest is None else min(self.fastest, latency)
+        if congested or slow:
+            # Responses to requests sent before the last decrease reflect the
+            # old limit, so they mustn't halve it again
+            if generation == self.generation:
+                self.limit = max(1.0, self.limit / 2)
+                self.generation += 1
+                metrics.FETCH_THROTTLED.inc()
+        else:
+            self.limit = min(Config.fetch_max_concurrency, self.limit + 1 / self.limit)
+        self.paused_until = max(self.paused_until, self.loop.time() + pause)
+        await self._free()
+
+    async def _free(self):
+        """
+        Gives a connection back & wakes up the requests waiting for one
+        :return: None
+        """
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+
+class FetchController:
+    """
+    Runs blocking downloads in the event loop's executor, through a
+    HostLimiter per host
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_event_loop()
+        self.hosts = {}
+
+    def limiter(self, url):
+        """
+        :param url: str
+        :return: HostLimiter obj for url's host
+        """
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = HostLimiter(self.loop)
+        return self.hosts[host]
+
+    async def fetch(self, download, url, timeout=None):
+        """
+        Calls download(url) once the host allows it.  429 & 5xx responses are
+        retried up to Config.fetch_retries times, after the server's
+        Retry-After, or Config.fetch_backoff seconds doubling each time.
+        :param download: callable taking a url, run in the executor
+        :param url: str
+        :param timeout: float, seconds after which each attempt is abandoned
+        with asyncio.TimeoutError, not counting time spent waiting for the
+        host to allow it.  None for no limit.
+        :return: whatever download returns
+        """
+        limiter = self.limiter(url)
+        for attempt in range(Config.fetch_retries + 1):
+            generation = await limiter.acquire()
+            start = self.loop.time()
+            try:
+                result = await asyncio.wait_for(
+                    self.loop.run_in_executor(None, download, url), timeout)
+            except HTTPError as error:
+                latency = self.loop.time() - start
+                status = error.response.status_code if error.response is not None else 0
+                if status != 429 and status < 500:
+                    await limiter.release(generation, latency)
+                    raise
+                pause = _retry_after(error.response)
+                if pause is None:
+                    pause = Config.fetch_backoff * 2 ** attempt
+                await limiter.release(generation, latency, congested=True, pause=pause)
+                if attempt == Config.fetch_retries:
+                    raise
+                continue
+            except (Timeout, asyncio.TimeoutError):
+                await limiter.release(generation, self.loop.time() - start, congested=True)
+                raise
+            except BaseException:
+                await limiter.release(generation, self.loop.time() - start)
+                raise
+            latency = self.loop.time() - start
+            metrics.FETCH_SECONDS.observe(latency)
+            await limiter.release(generation, latency)
+            return result
+
+
+def _retry_after(response):
+    """
+    :param response: requests.Response obj
+    :return: float, seconds asked for by a Retry-After header given in
+    seconds, or None if there isn't one
+    """
+    try:
+        return max(0.0, float(response.headers['Retry-After']))
+    except (AttributeError, KeyError, ValueError):
+        return None